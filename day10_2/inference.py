@@ -8,9 +8,11 @@ from argparse import ArgumentParser
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff  
 from src.facerender.animate import AnimateFromCoeff
-from src.generate_batch import get_data
-from src.generate_facerender_batch import get_facerender_data
+from src.generate_batch import get_data, AudioChunks
+from src.generate_facerender_batch import get_facerender_data, FacerenderChunks
 from src.utils.init_path import init_path
+from src.utils.motion_templates import MotionTemplateLibrary
+from src.utils.onnx_helper import onnx_model_dir
 
 def main(args):
     #torch.backends.cudnn.enabled = False
@@ -33,11 +35,15 @@ def main(args):
     sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
 
     #init model
-    preprocess_model = CropAndExtract(sadtalker_paths, device)
+    onnx_dir = onnx_model_dir(args.onnx_dir, args.size, args.preprocess) if args.onnx_dir else None
+    preprocess_model = CropAndExtract(sadtalker_paths, device, detect_interval=args.ref_detect_interval,
+                                      cache_dir=args.preprocess_cache_dir, onnx_dir=onnx_dir, onnx_threads=args.onnx_threads)
 
-    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device)
+    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device, onnx_dir=onnx_dir, onnx_threads=args.onnx_threads)
     
-    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+    compile_cache_dir = os.path.join(args.checkpoint_dir, 'compiled') if args.compiled else None
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device, compile_cache_dir=compile_cache_dir,
+                                          onnx_dir=onnx_dir, onnx_threads=args.onnx_threads)
 
     #crop image and extract 3dmm from image
     first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
@@ -49,16 +55,24 @@ def main(args):
         print("Can't get the coeffs of the input")
         return
 
-    if ref_eyeblink is not None:
+    # ref_eyeblink / ref_pose may name a precomputed motion template instead of a video
+    templates = MotionTemplateLibrary(args.motion_templates) if args.motion_templates is not None else None
+
+    if templates is not None and ref_eyeblink in templates:
+        ref_eyeblink_coeff_path = templates[ref_eyeblink]
+    elif ref_eyeblink is not None:
         ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[0]
         ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
         os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
         print('3DMM Extraction for the reference video providing eye blinking')
-        ref_eyeblink_coeff_path, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False)
+        ref_eyeblink_coeff_path, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False,
+                                                                  stride=args.ref_stride, max_duration=args.ref_max_duration)
     else:
         ref_eyeblink_coeff_path=None
 
-    if ref_pose is not None:
+    if templates is not None and ref_pose in templates:
+        ref_pose_coeff_path = templates[ref_pose]
+    elif ref_pose is not None:
         if ref_pose == ref_eyeblink: 
             ref_pose_coeff_path = ref_eyeblink_coeff_path
         else:
@@ -66,10 +80,42 @@ def main(args):
             ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
             os.makedirs(ref_pose_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_pose_coeff_path, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False)
+            ref_pose_coeff_path, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False,
+                                                                     stride=args.ref_stride, max_duration=args.ref_max_duration)
     else:
         ref_pose_coeff_path=None
 
+    if args.pose_styles:
+        # several pose styles: cropping, 3dmm extraction, mels and audio2exp run once for all of them
+        batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
+        coeff_paths = audio_to_coeff.generate_styles(batch, save_dir, args.pose_styles, ref_pose_coeff_path)
+        data = [get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path,
+                                    batch_size, input_yaw_list, input_pitch_list, input_roll_list,
+                                    expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+                for coeff_path in coeff_paths]
+        results = animate_from_coeff.generate_styles(data, save_dir, pic_path, crop_info, \
+                                    enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size,
+                                    paste_blend=args.paste_blend, precision=args.precision)
+        for style, result in zip(args.pose_styles, results):
+            shutil.move(result, '%s_style%d.mp4' % (save_dir, style))
+            print('The generated video is named:', '%s_style%d.mp4' % (save_dir, style))
+        if not args.verbose:
+            shutil.rmtree(save_dir)
+        return
+
+    if args.chunk_size:
+        # long audio: coefficients, render and video advance chunk by chunk
+        audio_chunks = AudioChunks(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
+        coeff_chunks = audio_to_coeff.generate_chunks(audio_chunks, save_dir, pose_style, ref_pose_coeff_path, chunk_size=args.chunk_size)
+        data = FacerenderChunks(coeff_chunks, len(audio_chunks), '%s##%s' % (audio_chunks.pic_name, audio_chunks.audio_name),
+                                crop_pic_path, first_coeff_path, audio_path, batch_size, input_yaw_list, input_pitch_list, input_roll_list,
+                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+        result = animate_from_coeff.generate_chunks(data, save_dir, pic_path, crop_info, \
+                                    enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size,
+                                    paste_blend=args.paste_blend, precision=args.precision)
+        finish(result, save_dir, args.verbose)
+        return
+
     #audio2ceoff
     batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
     coeff_path = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
@@ -82,15 +128,19 @@ def main(args):
     #coeff2video
     data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, 
                                 batch_size, input_yaw_list, input_pitch_list, input_roll_list,
-                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size,
+                                save_coeff_txt=args.verbose)
     
     result = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
-                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size)
-    
+                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size,
+                                paste_blend=args.paste_blend, precision=args.precision)
+    finish(result, save_dir, args.verbose)
+
+def finish(result, save_dir, verbose=False):
     shutil.move(result, save_dir+'.mp4')
     print('The generated video is named:', save_dir+'.mp4')
 
-    if not args.verbose:
+    if not verbose:
         shutil.rmtree(save_dir)
 
     
@@ -101,11 +151,17 @@ if __name__ == '__main__':
     parser.add_argument("--source_image", default='./examples/source_image/full_body_1.png', help="path to source image")
     parser.add_argument("--ref_eyeblink", default=None, help="path to reference video providing eye blinking")
     parser.add_argument("--ref_pose", default=None, help="path to reference video providing pose")
+    parser.add_argument("--ref_stride", type=int, default=1, help="use every n-th frame of the reference videos, e.g. 2 for 50 fps videos")
+    parser.add_argument("--ref_max_duration", type=float, default=None, help="read at most this many seconds of the reference videos")
+    parser.add_argument("--ref_detect_interval", type=int, default=None, help="track the face of the reference videos, running the face detector only every n frames")
+    parser.add_argument("--motion_templates", default=None, help="motion template library, ref_eyeblink and ref_pose can then be template names")
     parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to output")
     parser.add_argument("--result_dir", default='./results', help="path to output")
     parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
+    parser.add_argument("--pose_styles", nargs='+', type=int, default=None,  help="render one video per pose style, sharing the preprocessing and the audio pass (not with --chunk_size)")
     parser.add_argument("--batch_size", type=int, default=2,  help="the batch size of facerender")
     parser.add_argument("--size", type=int, default=256,  help="the image size of the facerender")
+    parser.add_argument("--chunk_size", type=int, default=None,  help="generate long audio chunk_size frames at a time, memory stays flat with the audio length (no --face3dvis)")
     parser.add_argument("--expression_scale", type=float, default=1.,  help="the batch size of facerender")
     parser.add_argument('--input_yaw', nargs='+', type=int, default=None, help="the input yaw degree of the user ")
     parser.add_argument('--input_pitch', nargs='+', type=int, default=None, help="the input pitch degree of the user")
@@ -116,8 +172,14 @@ if __name__ == '__main__':
     parser.add_argument("--face3dvis", action="store_true", help="generate 3d face and 3d landmarks") 
     parser.add_argument("--still", action="store_true", help="can crop back to the original videos for the full body aniamtion") 
     parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images" ) 
+    parser.add_argument("--paste_blend", default='feather', choices=['feather', 'seamless'], help="how full/extfull paste the face back, seamless solves seamlessClone for every frame" ) 
+    parser.add_argument("--precision", default='fp32', choices=['fp32', 'fp16', 'bf16', 'half'], help="precision of the face renderer, half is bf16 on cpu and fp16 on cuda" ) 
+    parser.add_argument("--compiled", action="store_true", help="run the face renderer as TorchScript, traced once and cached in checkpoint_dir/compiled" ) 
+    parser.add_argument("--onnx_dir", default=None, help="run the networks with onnxruntime, exported by python -m src.utils.onnx_helper, see requirements_onnx.txt" ) 
+    parser.add_argument("--onnx_threads", type=int, default=None, help="intra op threads of every onnxruntime session" ) 
     parser.add_argument("--verbose",action="store_true", help="saving the intermedia output or not" ) 
     parser.add_argument("--old_version",action="store_true", help="use the pth other than safetensor version" ) 
+    parser.add_argument("--preprocess_cache_dir", default=None, help="reuse the preprocessing of source images seen before" ) 
 
 
     # net structure and parameters
@@ -135,6 +197,8 @@ if __name__ == '__main__':
     parser.add_argument('--z_far', type=float, default=15.)
 
     args = parser.parse_args()
+    if args.pose_styles and args.chunk_size:
+        parser.error('--pose_styles cannot be combined with --chunk_size')
 
     if torch.cuda.is_available() and not args.cpu:
         args.device = "cuda"
@@ -10,7 +10,13 @@ class Audio2Exp(nn.Module):
         self.device = device
         self.netG = netG.to(device)
 
-    def test(self, batch):
+    def test(self, batch, chunk_size=200):
+        """
+        The frames are independent, so instead of one netG pass per 10 frame slice all the frames go
+        into the batch dimension, chunk_size frames at a time to bound the memory; the last chunk takes
+        the ragged tail. chunk_size=10 runs the original slices, other sizes only differ by the float
+        rounding of the batched convolutions.
+        """
 
         mel_input = batch['indiv_mels']                         # bs T 1 80 16
         bs = mel_input.shape[0]
@@ -18,15 +24,15 @@ class Audio2Exp(nn.Module):
 
         exp_coeff_pred = []
 
-        for i in tqdm(range(0, T, 10),'audio2exp:'): # every 10 frames
-            
-            current_mel_input = mel_input[:,i:i+10]
+        for i in tqdm(range(0, T, chunk_size),'audio2exp:'): # every chunk_size frames
+
+            current_mel_input = mel_input[:,i:i+chunk_size]
 
             #ref = batch['ref'][:, :, :64].repeat((1,current_mel_input.shape[1],1))           #bs T 64
-            ref = batch['ref'][:, :, :64][:, i:i+10]
-            ratio = batch['ratio_gt'][:, i:i+10]                               #bs T
+            ref = batch['ref'][:, :, :64][:, i:i+chunk_size]
+            ratio = batch['ratio_gt'][:, i:i+chunk_size]                       #bs T
 
-            audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
+            audiox = current_mel_input.reshape(-1, 1, 80, 16)               # bs*T 1 80 16
 
             curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
 
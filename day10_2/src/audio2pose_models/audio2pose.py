@@ -5,19 +5,20 @@ from src.audio2pose_models.discriminator import PoseSequenceDiscriminator
 from src.audio2pose_models.audio_encoder import AudioEncoder
 
 class Audio2Pose(nn.Module):
-    def __init__(self, cfg, wav2lip_checkpoint, device='cuda'):
+    def __init__(self, cfg, wav2lip_checkpoint, device='cuda', audio_encoder=None, netG=None):
         super().__init__()
         self.cfg = cfg
         self.seq_len = cfg.MODEL.CVAE.SEQ_LEN
         self.latent_dim = cfg.MODEL.CVAE.LATENT_SIZE
         self.device = device
 
-        self.audio_encoder = AudioEncoder(wav2lip_checkpoint, device)
+        # audio_encoder / netG replace the torch networks, e.g. the onnxruntime ones of src/utils/onnx_helper.py
+        self.audio_encoder = AudioEncoder(wav2lip_checkpoint, device) if audio_encoder is None else audio_encoder
         self.audio_encoder.eval()
         for param in self.audio_encoder.parameters():
             param.requires_grad = False
 
-        self.netG = CVAE(cfg)
+        self.netG = CVAE(cfg) if netG is None else netG
         self.netD_motion = PoseSequenceDiscriminator(cfg)
         
         
@@ -45,13 +46,48 @@ class Audio2Pose(nn.Module):
 
         return batch
 
-    def test(self, x):
+    def test_window(self, batch, indiv_mels):
+        """ pose motion (bs seq_len 6) of one window of at most seq_len frames, with a fresh latent """
+        return self.test_windows(batch, [indiv_mels])[0]
+
+    def test_windows(self, batch, mel_windows):
+        """
+        pose motion (n bs seq_len 6) of n windows (bs T_i 1 80 16) of at most seq_len frames, the
+        frames of all the windows go through the audio encoder and the windows through the decoder
+        in one batch. The latents are drawn one window after the other like test_window() does, so
+        a seed gives the same poses however the windows are batched.
+        batch['class'] may hold one pose style per batch item; windows of a single sequence are then
+        encoded once and decoded for all the styles, which makes bs the number of styles.
+        """
+        n = len(mel_windows)
+        bs = max(mel_windows[0].shape[0], batch['class'].numel())
+        z = torch.stack([torch.randn(bs, self.latent_dim) for _ in mel_windows]).to(mel_windows[0].device)
+
+        audio_emb = self.audio_encoder(torch.cat(mel_windows, dim=1)) #bs sum(T_i) 512
+        audio_emb_list = []
+        for emb in audio_emb.split([mels.shape[1] for mels in mel_windows], dim=1):
+            if emb.shape[1] != self.seq_len:
+                pad_dim = self.seq_len-emb.shape[1]
+                pad_audio_emb = emb[:, :1].repeat(1, pad_dim, 1) 
+                emb = torch.cat([pad_audio_emb, emb], 1) 
+            audio_emb_list.append(emb)
+
+        # window major, row i*bs+b is window i of batch item b
+        audio_emb = torch.stack(audio_emb_list)                      #n bs|1 seq_len 512
+        window_batch = {'z': z.reshape(n*bs, -1),
+                        'class': batch['class'].reshape(-1).expand(bs).repeat(n),
+                        'ref': batch['ref'].expand(bs, -1).repeat(n, 1),
+                        'audio_emb': audio_emb.expand(n, bs, -1, -1).reshape(n*bs, self.seq_len, -1)}
+        window_batch = self.netG.test(window_batch)
+        return window_batch['pose_motion_pred'].reshape(n, bs, self.seq_len, -1)
+
+    def test(self, x, window_batch=8):
 
         batch = {}
         ref = x['ref']                            #bs 1 70
         batch['ref'] = x['ref'][:,0,-6:]  
         batch['class'] = x['class']  
-        bs = ref.shape[0]
+        bs = max(ref.shape[0], batch['class'].numel())   # one pose track per style
         
         indiv_mels= x['indiv_mels']               # bs T 1 80 16
         indiv_mels_use = indiv_mels[:, 1:]        # we regard the ref as the first frame
@@ -62,28 +98,20 @@ class Audio2Pose(nn.Module):
         div = num_frames//self.seq_len
         re = num_frames%self.seq_len
         audio_emb_list = []
-        pose_motion_pred_list = [torch.zeros(batch['ref'].unsqueeze(1).shape, dtype=batch['ref'].dtype, 
+        pose_motion_pred_list = [torch.zeros((bs,) + batch['ref'].unsqueeze(1).shape[1:], dtype=batch['ref'].dtype, 
                                                 device=batch['ref'].device)]
 
-        for i in range(div):
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len,:,:,:]) #bs seq_len 512
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'])  #list of bs seq_len 6
-        
+        windows = [indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len,:,:,:] for i in range(div)]
+        if re != 0:
+            windows.append(indiv_mels_use[:, -1*self.seq_len:,:,:,:])
+
+        # window_batch windows per pass bounds the memory of the audio encoder
+        for i in range(0, len(windows), window_batch):
+            pose_motion_pred = self.test_windows(batch, windows[i:i+window_batch])
+            pose_motion_pred_list.extend(pose_motion_pred.unbind(0))  #list of bs seq_len 6
+
         if re != 0:
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, -1*self.seq_len:,:,:,:]) #bs seq_len  512
-            if audio_emb.shape[1] != self.seq_len:
-                pad_dim = self.seq_len-audio_emb.shape[1]
-                pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1) 
-                audio_emb = torch.cat([pad_audio_emb, audio_emb], 1) 
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'][:,-1*re:,:])   
+            pose_motion_pred_list[-1] = pose_motion_pred_list[-1][:,-1*re:,:]
         
         pose_motion_pred = torch.cat(pose_motion_pred_list, dim = 1)
         batch['pose_motion_pred'] = pose_motion_pred
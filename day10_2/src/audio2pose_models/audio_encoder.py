@@ -1,4 +1,3 @@
-import torch
 from torch import nn
 from torch.nn import functional as F
 
@@ -55,7 +54,8 @@ class AudioEncoder(nn.Module):
         # audio_sequences = (B, T, 1, 80, 16)
         B = audio_sequences.size(0)
 
-        audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
+        # all the frames in one batch, row b*T+t is frame t of sequence b
+        audio_sequences = audio_sequences.reshape((-1,) + audio_sequences.shape[2:])
 
         audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
         dim = audio_embedding.shape[1]
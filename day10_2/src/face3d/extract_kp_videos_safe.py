@@ -1,13 +1,14 @@
 import os
-import cv2
 import time
 import glob
 import argparse
+import types
+from collections import deque
 import numpy as np
 from PIL import Image
 import torch
 from tqdm import tqdm
-from itertools import cycle
+from itertools import cycle, islice
 from torch.multiprocessing import Pool, Process, set_start_method
 
 from facexlib.alignment import landmark_98_to_68
@@ -15,6 +16,7 @@ from facexlib.detection import init_detection_model
 
 from facexlib.utils import load_file_from_url
 from src.face3d.util.my_awing_arch import FAN
+from src.utils.videoio import VideoFrames
 
 def init_alignment_model(model_name, half=False, device='cuda', model_rootpath=None):
     if model_name == 'awing_fan':
@@ -45,23 +47,79 @@ class KeypointExtractor():
         self.detector = init_alignment_model('awing_fan',device=device, model_rootpath=root_path)   
         self.det_net = init_detection_model('retinaface_resnet50', half=False,device=device, model_rootpath=root_path)
 
-    def extract_keypoint(self, images, name=None, info=True):
-        if isinstance(images, list):
-            keypoints = []
-            if info:
-                i_range = tqdm(images,desc='landmark Det:')
-            else:
-                i_range = images
-
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
-                # current_kp = self.detector.get_landmarks(np.array(image))
-                if np.mean(current_kp) == -1 and keypoints:
-                    keypoints.append(keypoints[-1])
-                else:
-                    keypoints.append(current_kp[None])
-
-            keypoints = np.concatenate(keypoints, 0)
+    def detect_face(self, image):
+        with torch.no_grad():
+            bboxes = self.det_net.detect_faces(image, 0.97)
+        if bboxes is None or len(bboxes) == 0:
+            return None
+        return [int(v) for v in bboxes[0][:4]]
+
+    def track_keypoints(self, images, detect_interval=10, batch_size=16, min_confidence_ratio=0.7, info=True):
+        """ Video mode: run the face detector only every `detect_interval` frames, or when the
+        landmark confidence drops below `min_confidence_ratio` of the one at the last detection,
+        and reuse its box in between. The crops sharing a box go through FAN in batches.
+        images is read lazily, yields (image, keypoints) in order with -1 keypoints where no face was found. """
+        images = iter(images)
+        pending = deque()           # read, not landmarked yet
+        bbox, since_det, ref_confidence = None, 0, None
+        pbar = tqdm(desc='landmark Det:', disable=not info)
+
+        while True:
+            for image in islice(images, batch_size - len(pending)):
+                pending.append(image)
+            if not pending:
+                break
+
+            if bbox is None or since_det >= detect_interval:
+                bbox = self.detect_face(np.array(pending[0]))
+                since_det, ref_confidence = 0, None
+                if bbox is None:
+                    print('No face detected in this image')
+                    yield pending.popleft(), -1. * np.ones([68, 2])
+                    pbar.update(1)
+                    continue
+
+            batch = list(islice(pending, min(len(pending), detect_interval - since_det)))
+            crops = [np.array(image)[bbox[1]:bbox[3], bbox[0]:bbox[2], :] for image in batch]
+            with torch.no_grad():
+                preds, confidence = self.detector.get_landmarks_batch(crops)
+
+            if ref_confidence is None:
+                ref_confidence = confidence[0]
+            for pred, conf in zip(preds, confidence):
+                if since_det != 0 and conf < min_confidence_ratio * ref_confidence:
+                    # the face moved away from the box, detect again from this frame on
+                    bbox = None
+                    break
+                current_kp = landmark_98_to_68(pred)
+                #### keypoints to the original location
+                current_kp[:,0] += bbox[0]
+                current_kp[:,1] += bbox[1]
+                yield pending.popleft(), current_kp
+                since_det += 1
+                pbar.update(1)
+        pbar.close()
+
+    def iter_keypoints(self, images, info=True, detect_interval=None, batch_size=16):
+        """ (image, keypoints) of every image, read one at a time. A frame without a face gets the
+        keypoints of the frame before, -1 for the first one. detect_interval tracks the face box
+        between detections, see track_keypoints. """
+        if detect_interval is not None:
+            landmarked = self.track_keypoints(images, detect_interval=detect_interval, batch_size=batch_size, info=info)
+        else:
+            landmarked = ((image, self.extract_keypoint(image)) for image in tqdm(images, desc='landmark Det:', disable=not info))
+
+        last_kp = None
+        for image, current_kp in landmarked:
+            if np.mean(current_kp) == -1 and last_kp is not None:
+                current_kp = last_kp
+            last_kp = current_kp
+            yield image, current_kp
+
+    def extract_keypoint(self, images, name=None, info=True, detect_interval=None, batch_size=16):
+        if isinstance(images, (list, types.GeneratorType)):
+            keypoints = np.stack([current_kp for _, current_kp in self.iter_keypoints(
+                images, info=info, detect_interval=detect_interval, batch_size=batch_size)])
             np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
@@ -99,18 +157,9 @@ class KeypointExtractor():
             return keypoints
 
 def read_video(filename):
-    frames = []
-    cap = cv2.VideoCapture(filename)
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = Image.fromarray(frame)
-            frames.append(frame)
-        else:
-            break
-    cap.release()
-    return frames
+    # frames are decoded lazily, one at a time
+    for frame in VideoFrames(filename):
+        yield Image.fromarray(frame)
 
 def run(data):
     filename, opt, device = data
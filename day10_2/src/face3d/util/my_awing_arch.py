@@ -376,3 +376,31 @@ class FAN(nn.Module):
         pred += offset[-2:]
 
         return pred
+
+    def get_landmarks_batch(self, imgs):
+        """ landmarks for a list of face crops in one forward pass,
+        also returns the mean heatmap peak of every crop as a confidence score """
+        offsets, inps = [], []
+        for img in imgs:
+            H, W, _ = img.shape
+            offsets.append((W / 64, H / 64))
+            img = cv2.resize(img, (256, 256))
+            inps.append(np.ascontiguousarray(img[..., ::-1].transpose((2, 0, 1))))
+
+        inp = torch.from_numpy(np.stack(inps)).float()
+        inp = inp.to(self.device)
+        inp.div_(255.0)
+
+        outputs, _ = self.forward(inp)
+        out = outputs[-1][:, :-1, :, :]
+        heatmaps = out.detach().cpu().numpy()
+        confidence = heatmaps.reshape(heatmaps.shape[0], heatmaps.shape[1], -1).max(axis=2).mean(axis=1)
+
+        preds = []
+        for heatmap, offset in zip(heatmaps, offsets):
+            # one frame at a time, calculate_points treats the border cases batch-wide
+            pred = calculate_points(heatmap[None]).reshape(-1, 2)
+            pred *= offset
+            preds.append(pred)
+
+        return preds, confidence
@@ -1,15 +1,12 @@
 import os
 import cv2
+from functools import partial
+from tqdm import tqdm
 import yaml
-import numpy as np
 import warnings
-from skimage import img_as_ubyte
-import safetensors
-import safetensors.torch 
 warnings.filterwarnings('ignore')
 
 
-import imageio
 import torch
 import torchvision
 
@@ -17,12 +14,18 @@ import torchvision
 from src.facerender.modules.keypoint_detector import HEEstimator, KPDetector
 from src.facerender.modules.mapping import MappingNet
 from src.facerender.modules.generator import OcclusionAwareGenerator, OcclusionAwareSPADEGenerator
-from src.facerender.modules.make_animation import make_animation 
+from src.facerender.modules.make_animation import iter_animation, resolve_precision, autocast, \
+    driving_keypoints, prepare_source
+from src.facerender.compiled import compile_facerender, CompiledGenerator, CompiledKPDetector, CompiledMapping
+from src.facerender.scheduler import RenderScheduler, iter_scheduled_animation
+from src.utils.onnx_helper import OnnxModule
 
 from pydub import AudioSegment 
-from src.utils.face_enhancer import enhancer_generator_with_len, enhancer_list
-from src.utils.paste_pic import paste_pic
-from src.utils.videoio import save_video_with_watermark
+from src.utils.face_enhancer import FaceEnhancer
+from src.utils.paste_pic import PasteBack
+from src.utils.videoio import VideoWriter
+from src.utils.pipeline import fan_out
+from src.utils.safetensor_helper import load_safetensor, load_x_from_safetensor
 
 try:
     import webui  # in webui
@@ -32,8 +35,32 @@ except:
 
 class AnimateFromCoeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, compile_cache_dir=None, onnx_dir=None, onnx_threads=None,
+                 render_batch_size=None, render_deadline=0.02):
 
+        self.device = device
+
+        # onnxruntime backend exported by src/utils/onnx_helper.py, the torch networks are not built
+        self.onnx = None
+        if onnx_dir is not None:
+            onnx_module = lambda name: OnnxModule(os.path.join(onnx_dir, name + '.onnx'), device, onnx_threads)
+            self.onnx = (CompiledGenerator(onnx_module('encode_source'), onnx_module('render_frame')),
+                         CompiledKPDetector(onnx_module('kp_detector')),
+                         CompiledMapping(onnx_module('mapping')))
+            self.kp_extractor = self.generator = self.he_estimator = self.mapping = None
+        else:
+            self.load_torch_models(sadtalker_path, device)
+
+        # opt-in TorchScript networks, traced per size/batch and kept in compile_cache_dir
+        self.compile_cache_dir = compile_cache_dir
+        self.compiled = None
+
+        # concurrent generate() calls share generator batches of render_batch_size frames
+        self.scheduler = None
+        if render_batch_size is not None:
+            self.scheduler = RenderScheduler(self.facerender_models, render_batch_size, render_deadline)
+    
+    def load_torch_models(self, sadtalker_path, device):
         with open(sadtalker_path['facerender_yaml']) as f:
             config = yaml.safe_load(f)
 
@@ -80,33 +107,19 @@ class AnimateFromCoeff():
         self.generator.eval()
         self.he_estimator.eval()
         self.mapping.eval()
-         
-        self.device = device
-    
+
     def load_cpk_facevid2vid_safetensor(self, checkpoint_path, generator=None, 
                         kp_detector=None, he_estimator=None,  
                         device="cpu"):
 
-        checkpoint = safetensors.torch.load_file(checkpoint_path)
+        checkpoint = load_safetensor(checkpoint_path)
 
         if generator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'generator' in k:
-                    x_generator[k.replace('generator.', '')] = v
-            generator.load_state_dict(x_generator)
+            generator.load_state_dict(load_x_from_safetensor(checkpoint, 'generator'))
         if kp_detector is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'kp_extractor' in k:
-                    x_generator[k.replace('kp_extractor.', '')] = v
-            kp_detector.load_state_dict(x_generator)
+            kp_detector.load_state_dict(load_x_from_safetensor(checkpoint, 'kp_extractor'))
         if he_estimator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'he_estimator' in k:
-                    x_generator[k.replace('he_estimator.', '')] = v
-            he_estimator.load_state_dict(x_generator)
+            he_estimator.load_state_dict(load_x_from_safetensor(checkpoint, 'he_estimator'))
         
         return None
 
@@ -154,11 +167,111 @@ class AnimateFromCoeff():
 
         return checkpoint['epoch']
 
-    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256):
+    def facerender_models(self, precision='fp32'):
+        if self.onnx is not None:
+            return self.onnx
+        # the traces are fp32, reduced precision runs the eager networks under autocast
+        if self.compile_cache_dir is None or resolve_precision(precision, self.device) != 'fp32':
+            return self.generator, self.kp_extractor, self.mapping
+        if self.compiled is None:
+            self.compiled = compile_facerender(self.generator, self.kp_extractor, self.mapping, self.compile_cache_dir)
+        return self.compiled
+
+    @staticmethod
+    def interleave_frames(seq):
+        if seq is None:
+            return None
+        if hasattr(seq, 'interleave'):
+            return seq.interleave()
+        bs = seq.shape[0]
+        seq = seq.reshape((-1,) + seq.shape[2:])
+        return seq.reshape((-1, bs) + seq.shape[1:]).transpose(0, 1)
+
+    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, paste_blend='feather', precision='fp32'):
+        frames = self.render_frames(x, crop_info, img_size=img_size, precision=precision)
+        return self.encode_video(frames, x, video_save_dir, pic_path, crop_info, enhancer=enhancer, background_enhancer=background_enhancer,
+                                 preprocess=preprocess, paste_blend=paste_blend)
+
+    def generate_chunks(self, chunks, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, paste_blend='feather', precision='fp32'):
+        """ generate() for the render data chunks of a FacerenderChunks, every chunk is rendered when it arrives
+        and its frames go straight into the video """
+        def frames():
+            # all the chunks have the same source image, it is encoded for the first one only
+            source = None
+            for x in chunks:
+                if source is None:
+                    source = self.render_source(x, precision)
+                yield from self.render_frames(x, crop_info, img_size=img_size, precision=precision, source=source)
+
+        return self.encode_video(frames(), chunks.info, video_save_dir, pic_path, crop_info, enhancer=enhancer, background_enhancer=background_enhancer,
+                                 preprocess=preprocess, paste_blend=paste_blend)
+
+    def render_source(self, x, precision='fp32'):
+        """ prepare_source() for the source image of x, to be shared by several render_frames() calls """
+        generator, kp_extractor, mapping = self.facerender_models(precision)
+        source_image = x['source_image'].type(torch.FloatTensor).to(self.device)
+        source_semantics = x['source_semantics'].type(torch.FloatTensor).to(self.device)
+        return prepare_source(source_image, source_semantics, generator, kp_extractor, mapping, precision)
+
+    def generate_styles(self, xs, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, paste_blend='feather', precision='fp32'):
+        """ generate() for the render data of several coefficient tracks of the same source image and audio,
+        e.g. pose styles; the frames of all the tracks are rendered together (render_styles) and every
+        video is encoded by its own thread. Returns the video paths in the order of xs. """
+        consumers = [partial(self.encode_video, x=x, video_save_dir=video_save_dir, pic_path=pic_path, crop_info=crop_info,
+                             enhancer=enhancer, background_enhancer=background_enhancer, preprocess=preprocess,
+                             paste_blend=paste_blend) for x in xs]
+        return fan_out(self.render_styles(xs, crop_info, img_size=img_size, precision=precision), consumers)
+
+    def render_styles(self, xs, crop_info, img_size=256, precision='fp32'):
+        """ for every frame, the list of its uint8 RGB frames in the tracks of xs. The source image is
+        encoded once, and frame t of all the tracks goes through the generator in one batch. """
+        device = self.device
+        generator, kp_extractor, mapping = self.facerender_models(precision)
+        source_image = xs[0]['source_image'][:1].type(torch.FloatTensor).to(device)
+        source_semantics = xs[0]['source_semantics'][:1].type(torch.FloatTensor).to(device)
+        source_feature, kp_canonical, kp_source = prepare_source(source_image, source_semantics,
+                                                                 generator, kp_extractor, mapping, precision)
+
+        # driving keypoints of every track in frame order, (frame_num, num_kp, 3) each
+        kp_driving = []
+        for x in xs:
+            target_semantics = self.interleave_frames(x['target_semantics_list'].to(device))
+            camera_seqs = [self.interleave_frames(x[key].to(device)) if key in x else None
+                           for key in ('yaw_c_seq', 'pitch_c_seq', 'roll_c_seq')]
+            bs = target_semantics.shape[0]
+            kp_value = kp_canonical['value'].expand((bs,) + kp_canonical['value'].shape[1:])
+            with torch.no_grad():
+                kp = driving_keypoints({'value': kp_value}, target_semantics, mapping, *camera_seqs, precision=precision)
+            # frame f is at [f % bs, f // bs]
+            kp_driving.append(kp.transpose(0, 1).reshape((-1,) + kp.shape[2:])[:x['frame_num']])
+
+        original_size = crop_info[0]
+        if original_size:
+            out_size = (img_size, int(img_size * original_size[1]/original_size[0]))
+        else:
+            out_size = None
+
+        n = len(xs)
+        source_feature = source_feature.expand((n,) + source_feature.shape[1:])
+        kp_source = {'value': kp_source['value'].expand((n,) + kp_source['value'].shape[1:])}
+        with torch.no_grad():
+            for frame_idx in tqdm(range(xs[0]['frame_num']), 'Face Renderer:'):
+                kp_norm = {'value': torch.stack([kp[frame_idx] for kp in kp_driving])}
+                with autocast(device, precision):
+                    out = generator.forward_with_feature(source_feature, kp_source=kp_source, kp_driving=kp_norm)
+                # to uint8 on device, same rounding as img_as_ubyte
+                predictions = (out['prediction'].float().clamp(0, 1) * 255).round().to(torch.uint8)
+                predictions = predictions.permute(0, 2, 3, 1).cpu().numpy()
+                yield [cv2.resize(image, out_size) if out_size is not None else image for image in predictions]
+
+    def render_frames(self, x, crop_info, img_size=256, precision='fp32', source=None):
+        """ the uint8 RGB frames of the video, rendered while they are read; source as in prepare_animation() """
 
         source_image=x['source_image'].type(torch.FloatTensor)
         source_semantics=x['source_semantics'].type(torch.FloatTensor)
-        target_semantics=x['target_semantics_list'].type(torch.FloatTensor) 
+        target_semantics=x['target_semantics_list']
+        if torch.is_tensor(target_semantics):
+            target_semantics=target_semantics.type(torch.FloatTensor)
         source_image=source_image.to(self.device)
         source_semantics=source_semantics.to(self.device)
         target_semantics=target_semantics.to(self.device)
@@ -180,78 +293,79 @@ class AnimateFromCoeff():
 
         frame_num = x['frame_num']
 
-        predictions_video = make_animation(source_image, source_semantics, target_semantics,
-                                        self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
-                                        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True)
-
-        predictions_video = predictions_video.reshape((-1,)+predictions_video.shape[2:])
-        predictions_video = predictions_video[:frame_num]
-
-        video = []
-        for idx in range(predictions_video.shape[0]):
-            image = predictions_video[idx]
-            image = np.transpose(image.data.cpu().numpy(), [1, 2, 0]).astype(np.float32)
-            video.append(image)
-        result = img_as_ubyte(video)
+        # frame f is stored at [f//T, f%T]; lay the frames out as [f%bs, f//bs] instead
+        # so that every render step produces bs consecutive frames which can be streamed out.
+        target_semantics = self.interleave_frames(target_semantics)
+        yaw_c_seq = self.interleave_frames(yaw_c_seq)
+        pitch_c_seq = self.interleave_frames(pitch_c_seq)
+        roll_c_seq = self.interleave_frames(roll_c_seq)
 
         ### the generated video is 256x256, so we keep the aspect ratio, 
         original_size = crop_info[0]
         if original_size:
-            result = [ cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) )) for result_i in result ]
-        
-        video_name = x['video_name']  + '.mp4'
-        path = os.path.join(video_save_dir, 'temp_'+video_name)
-        
-        imageio.mimsave(path, result,  fps=float(25))
+            out_size = (img_size, int(img_size * original_size[1]/original_size[0]))
+        else:
+            out_size = None
+
+        generator, kp_extractor, mapping = self.facerender_models(precision)
+
+        def rendered_frames():
+            num_frames = 0
+            if self.scheduler is not None:
+                animation = partial(iter_scheduled_animation, self.scheduler)
+            else:
+                animation = iter_animation
+            for predictions in animation(source_image, source_semantics, target_semantics,
+                                         generator, kp_extractor, mapping,
+                                         yaw_c_seq, pitch_c_seq, roll_c_seq, precision=precision, source=source):
+                # to uint8 on device, same rounding as img_as_ubyte
+                predictions = (predictions.clamp(0, 1) * 255).round().to(torch.uint8)
+                predictions = predictions.permute(0, 2, 3, 1).cpu().numpy()
+                for image in predictions[:frame_num - num_frames]:
+                    num_frames += 1
+                    yield cv2.resize(image, out_size) if out_size is not None else image
+                if num_frames >= frame_num:
+                    return
+
+        return rendered_frames()
+
+    def encode_video(self, frames, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', paste_blend='feather'):
+        """ paste back, enhance and encode the frames with the audio of x, returns the video path """
+
+        frame_num = x['frame_num']
 
-        av_path = os.path.join(video_save_dir, video_name)
-        return_path = av_path 
-        
         audio_path =  x['audio_path'] 
-        audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
-        new_audio_path = os.path.join(video_save_dir, audio_name+'.wav')
+        # named after the video, several videos of the same audio may be encoded at once
+        new_audio_path = os.path.join(video_save_dir, x['video_name']+'.wav')
         start_time = 0
         # cog will not keep the .mp3 filename
         sound = AudioSegment.from_file(audio_path)
-        frames = frame_num 
-        end_time = start_time + frames*1/25*1000
+        end_time = start_time + frame_num*1/25*1000
         word1=sound.set_frame_rate(16000)
         word = word1[start_time:end_time]
         word.export(new_audio_path, format="wav")
 
-        save_video_with_watermark(path, new_audio_path, av_path, watermark= False)
-        print(f'The generated video is named {video_save_dir}/{video_name}') 
-
+        # paste back and enhancer run on the frames in memory, the video is encoded only once
+        frame_stages = []
+        video_name = x['video_name']  + '.mp4'
         if 'full' in preprocess.lower():
-            # only add watermark to the full image.
-            video_name_full = x['video_name']  + '_full.mp4'
-            full_video_path = os.path.join(video_save_dir, video_name_full)
-            return_path = full_video_path
-            paste_pic(path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop= True if 'ext' in preprocess.lower() else False)
-            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
-        else:
-            full_video_path = av_path 
-
-        #### paste back then enhancers
+            video_name = x['video_name']  + '_full.mp4'
+            frame_stages.append(PasteBack(pic_path, crop_info, extended_crop= True if 'ext' in preprocess.lower() else False, blend=paste_blend))
         if enhancer:
-            video_name_enhancer = x['video_name']  + '_enhanced.mp4'
-            enhanced_path = os.path.join(video_save_dir, 'temp_'+video_name_enhancer)
-            av_path_enhancer = os.path.join(video_save_dir, video_name_enhancer) 
-            return_path = av_path_enhancer
+            video_name = x['video_name']  + '_enhanced.mp4'
+            frame_stages.append(FaceEnhancer(method=enhancer, bg_upsampler=background_enhancer))
+        return_path = os.path.join(video_save_dir, video_name)
+
+        # every stage consumes the frame stream of the previous one
+        for stage in frame_stages:
+            frames = stage.stream(frames)
+
+        with VideoWriter(return_path, fps=25, audio_path=new_audio_path) as writer:
+            for image in frames:
+                writer.write(image)
+
+        print(f'The generated video is named {return_path}') 
 
-            try:
-                enhanced_images_gen_with_len = enhancer_generator_with_len(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            except:
-                enhanced_images_gen_with_len = enhancer_list(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            
-            save_video_with_watermark(enhanced_path, new_audio_path, av_path_enhancer, watermark= False)
-            print(f'The generated video is named {video_save_dir}/{video_name_enhancer}')
-            os.remove(enhanced_path)
-
-        os.remove(path)
         os.remove(new_audio_path)
 
         return return_path
-
@@ -0,0 +1,109 @@
+""" Speed and PSNR of the reduced precision face renderer against fp32.
+
+    python -m src.facerender.benchmark_precision --precision half --num_frames 50
+
+--random_weights runs without the checkpoints, for the speed only.
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import cv2
+import yaml
+import numpy as np
+import torch
+
+from src.facerender.modules.keypoint_detector import KPDetector
+from src.facerender.modules.mapping import MappingNet
+from src.facerender.modules.generator import OcclusionAwareSPADEGenerator
+from src.facerender.modules.make_animation import iter_animation, resolve_precision
+
+
+def load_models(args):
+    if not args.random_weights:
+        if not (os.path.isdir(args.checkpoint_dir) and os.listdir(args.checkpoint_dir)):
+            raise SystemExit('no checkpoints in %s, pass --random_weights to benchmark randomly initialized networks'
+                             % args.checkpoint_dir)
+        from src.facerender.animate import AnimateFromCoeff
+        from src.utils.init_path import init_path
+        config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config')
+        sadtalker_paths = init_path(args.checkpoint_dir, config_dir, args.size, False, 'crop')
+        animate = AnimateFromCoeff(sadtalker_paths, args.device)
+        return animate.generator, animate.kp_extractor, animate.mapping
+
+    # speed only, the PSNR of random weights says little about the real networks
+    print('benchmarking randomly initialized networks')
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'facerender.yaml')
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+    torch.manual_seed(0)
+    generator = OcclusionAwareSPADEGenerator(**config['model_params']['generator_params'],
+                                             **config['model_params']['common_params'])
+    kp_extractor = KPDetector(**config['model_params']['kp_detector_params'],
+                              **config['model_params']['common_params'])
+    mapping = MappingNet(**config['model_params']['mapping_params'])
+    return [m.to(args.device).eval() for m in (generator, kp_extractor, mapping)]
+
+
+def render(models, inputs, precision):
+    generator, kp_extractor, mapping = models
+    source_image, source_semantics, target_semantics = inputs
+    start = time.time()
+    predictions = list(iter_animation(source_image, source_semantics, target_semantics,
+                                      generator, kp_extractor, mapping, precision=precision))
+    if source_image.is_cuda:
+        torch.cuda.synchronize()
+    return torch.stack(predictions, dim=1), time.time() - start
+
+
+def psnr(x, y):
+    mse = ((x - y) ** 2).mean().item()
+    return float('inf') if mse == 0 else 10 * np.log10(1. / mse)
+
+
+def main(args):
+    models = load_models(args)
+
+    image = cv2.imread(args.source_image)[..., ::-1]
+    image = cv2.resize(image, (args.size, args.size)).astype(np.float32) / 255.
+    source_image = torch.from_numpy(image).permute(2, 0, 1)[None].repeat(args.batch_size, 1, 1, 1)
+    # small random motions around the source coefficients
+    generator = torch.Generator().manual_seed(0)
+    source_semantics = torch.randn(args.batch_size, 70, 27, generator=generator) * 0.1
+    target_semantics = source_semantics[:, None] + torch.randn(args.batch_size, args.num_frames, 70, 27, generator=generator) * 0.05
+    inputs = [t.to(args.device) for t in (source_image, source_semantics, target_semantics)]
+
+    precision = resolve_precision(args.precision, args.device)
+    # warm up both paths before timing
+    for p in ('fp32', precision):
+        render(models, [inputs[0], inputs[1], inputs[2][:, :2]], p)
+
+    reference, fp32_time = render(models, inputs, 'fp32')
+    prediction, reduced_time = render(models, inputs, precision)
+
+    frames = args.batch_size * args.num_frames
+    print('fp32: %.2f frames/s' % (frames / fp32_time))
+    print('%s: %.2f frames/s, speedup %.2fx' % (precision, frames / reduced_time, fp32_time / reduced_time))
+    print('PSNR %s vs fp32: %.2f dB' % (precision, psnr(prediction, reference)))
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--source_image", default='./examples/source_image/full_body_1.png', help="path to source image")
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--random_weights", action="store_true", help="benchmark randomly initialized networks instead of the checkpoints")
+    parser.add_argument("--precision", default='half', choices=['fp16', 'bf16', 'half'], help="half is bf16 on cpu and fp16 on cuda")
+    parser.add_argument("--size", type=int, default=256, help="the image size of the facerender")
+    parser.add_argument("--batch_size", type=int, default=2, help="the batch size of facerender")
+    parser.add_argument("--num_frames", type=int, default=25, help="rendered frames per batch item")
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+
+    args = parser.parse_args()
+
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
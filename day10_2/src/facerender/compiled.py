@@ -0,0 +1,237 @@
+""" TorchScript versions of the face renderer networks.
+
+Every network is traced once per input shape (render size and batch size), frozen, and saved to
+cache_dir, so that new workers load the artifacts instead of tracing again. The mapping net runs on
+blocks of a fixed number of rows, so that one trace serves every job length. cache_dir keeps the
+max_cached most recently used artifacts of each network. The traces are fp32, reduced precision
+keeps using the eager networks under autocast.
+
+    python -m src.facerender.compiled --size 256 --batch_size 2      # warm up the cache and check against eager
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+import torch
+from torch import nn
+
+
+class _EncodeSource(nn.Module):
+    def __init__(self, generator):
+        super(_EncodeSource, self).__init__()
+        self.generator = generator
+
+    def forward(self, source_image):
+        return self.generator.encode_source(source_image)
+
+
+class _RenderFrame(nn.Module):
+    def __init__(self, generator):
+        super(_RenderFrame, self).__init__()
+        self.generator = generator
+
+    def forward(self, feature_3d, kp_driving, kp_source):
+        out = self.generator.forward_with_feature(feature_3d, {'value': kp_driving}, {'value': kp_source})
+        return out['prediction']
+
+
+class _KPDetector(nn.Module):
+    def __init__(self, kp_detector):
+        super(_KPDetector, self).__init__()
+        self.kp_detector = kp_detector
+
+    def forward(self, x):
+        return self.kp_detector(x)['value']
+
+
+class _Mapping(nn.Module):
+    keys = ('yaw', 'pitch', 'roll', 't', 'exp')
+
+    def __init__(self, mapping):
+        super(_Mapping, self).__init__()
+        self.mapping = mapping
+
+    def forward(self, input_3dmm):
+        out = self.mapping(input_3dmm)
+        return tuple(out[key] for key in self.keys)
+
+
+def weights_digest(module):
+    sha = hashlib.sha1()
+    for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+class TracedModule():
+    """ Calls module through torch.jit.trace, with one frozen trace per input shape and dtype """
+
+    def __init__(self, name, module, cache_dir, max_cached=8):
+        self.name = name
+        self.module = module.eval()
+        self.cache_dir = cache_dir
+        self.max_cached = max_cached
+        self.digest = weights_digest(module)
+        self.traces = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, inputs):
+        device = inputs[0].device
+        shapes = '_'.join('x'.join(str(s) for s in x.shape) + str(x.dtype).replace('torch.', '') for x in inputs)
+        key = '%s_%s_%s_%s_%s' % (self.name, self.digest, shapes, device.type, torch.__version__.split('+')[0])
+        return os.path.join(self.cache_dir, key + '.pt')
+
+    def trace(self, inputs):
+        path = self.path(inputs)
+        if os.path.isfile(path):
+            try:
+                traced = torch.jit.load(path, map_location=inputs[0].device)
+                os.utime(path)
+                return traced
+            except (FileNotFoundError, ValueError):
+                pass    # pruned by another worker in between
+
+        print('tracing %s for %s' % (self.name, [tuple(x.shape) for x in inputs]))
+        with torch.no_grad():
+            traced = torch.jit.trace(self.module, tuple(inputs), check_trace=False)
+        traced = torch.jit.freeze(traced.eval())
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.pt')
+        os.close(fd)
+        torch.jit.save(traced, tmp_path)
+        os.replace(tmp_path, path)
+        self.prune()
+        return traced
+
+    def prune(self):
+        """ drop all but the max_cached most recently used artifacts of this network, stale weights included """
+        paths = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                 if f.startswith(self.name + '_') and f.endswith('.pt')]
+        def last_used(path):
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                return 0
+        for path in sorted(paths, key=last_used, reverse=True)[self.max_cached:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __call__(self, *inputs):
+        key = tuple((tuple(x.shape), x.dtype, x.device) for x in inputs)
+        with self.lock:
+            if key not in self.traces:
+                self.traces[key] = self.trace(inputs)
+            traced = self.traces[key]
+        with torch.no_grad():
+            return traced(*inputs)
+
+
+class CompiledGenerator():
+    """ drop-in for OcclusionAwareSPADEGenerator in iter_animation, encode and render take and return tensors """
+
+    def __init__(self, encode, render):
+        self.encode = encode
+        self.render = render
+
+    def encode_source(self, source_image):
+        return self.encode(source_image)
+
+    def forward_with_feature(self, feature_3d, kp_driving, kp_source):
+        return {'prediction': self.render(feature_3d, kp_driving['value'], kp_source['value'])}
+
+    def __call__(self, source_image, kp_driving, kp_source):
+        return self.forward_with_feature(self.encode_source(source_image), kp_driving, kp_source)
+
+
+class CompiledKPDetector():
+
+    def __init__(self, kp_detector):
+        self.kp_detector = kp_detector
+
+    def __call__(self, x):
+        return {'value': self.kp_detector(x)}
+
+
+class CompiledMapping():
+    """ with step, mapping is called on blocks of step rows, the last one zero padded, and sees a single shape """
+
+    def __init__(self, mapping, step=None):
+        self.mapping = mapping
+        self.step = step
+
+    def __call__(self, input_3dmm):
+        if self.step is None:
+            return dict(zip(_Mapping.keys, self.mapping(input_3dmm)))
+
+        # the rows are independent, the padding rows are dropped again
+        blocks = []
+        for start in range(0, input_3dmm.shape[0], self.step):
+            block = input_3dmm[start:start + self.step]
+            n = block.shape[0]
+            if n < self.step:
+                block = torch.cat([block, block.new_zeros((self.step - n,) + block.shape[1:])])
+            blocks.append([out[:n] for out in self.mapping(block)])
+        return {key: torch.cat(outs) for key, outs in zip(_Mapping.keys, zip(*blocks))}
+
+
+def compile_facerender(generator, kp_detector, mapping, cache_dir, mapping_step=64):
+    return (CompiledGenerator(TracedModule('encode_source', _EncodeSource(generator), cache_dir),
+                              TracedModule('render_frame', _RenderFrame(generator), cache_dir)),
+            CompiledKPDetector(TracedModule('kp_detector', _KPDetector(kp_detector), cache_dir)),
+            CompiledMapping(TracedModule('mapping', _Mapping(mapping), cache_dir), step=mapping_step))
+
+
+def main(args):
+    from src.facerender.animate import AnimateFromCoeff
+    from src.facerender.modules.make_animation import make_animation
+    from src.utils.init_path import init_path
+
+    config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config')
+    sadtalker_paths = init_path(args.checkpoint_dir, config_dir, args.size, args.old_version, args.preprocess)
+    animate = AnimateFromCoeff(sadtalker_paths, args.device)
+    compiled = compile_facerender(animate.generator, animate.kp_extractor, animate.mapping, args.cache_dir)
+
+    generator = torch.Generator().manual_seed(0)
+    coeff_nc = animate.mapping.first[0].in_channels     # 73 for the full mapping
+    source_image = torch.rand(args.batch_size, 3, args.size, args.size, generator=generator).to(args.device)
+    source_semantics = (torch.randn(args.batch_size, coeff_nc, 27, generator=generator) * 0.1).to(args.device)
+    target_semantics = source_semantics[:, None] + (torch.randn(args.batch_size, args.num_frames, coeff_nc, 27, generator=generator) * 0.05).to(args.device)
+
+    eager = make_animation(source_image, source_semantics, target_semantics, animate.generator,
+                           animate.kp_extractor, None, animate.mapping)
+    traced = make_animation(source_image, source_semantics, target_semantics, compiled[0],
+                            compiled[1], None, compiled[2])
+
+    max_diff = (eager - traced).abs().max().item()
+    print('compiled artifacts in %s, max abs difference to eager: %.2e' % (args.cache_dir, max_diff))
+    if max_diff > args.atol:
+        raise SystemExit('compiled face renderer does not match eager (atol %.1e)' % args.atol)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--cache_dir", default='./checkpoints/compiled', help="where the compiled artifacts are kept")
+    parser.add_argument("--size", type=int, default=256, help="the image size of the facerender")
+    parser.add_argument("--batch_size", type=int, default=2, help="the batch size of facerender")
+    parser.add_argument("--num_frames", type=int, default=2, help="frames rendered for the check")
+    parser.add_argument("--preprocess", default='crop', choices=['crop', 'full'], help="full uses another mapping checkpoint")
+    parser.add_argument("--old_version", action="store_true", help="use the pth other than safetensor version")
+    parser.add_argument("--atol", type=float, default=1e-3, help="allowed difference to the eager output")
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+
+    args = parser.parse_args()
+
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
@@ -1,7 +1,7 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
-from src.facerender.modules.util import Hourglass, make_coordinate_grid, kp2gaussian
+from src.facerender.modules.util import Hourglass, make_coordinate_grid, kp2gaussian, grid_sample_fp32, softmax_fp32
 
 from src.facerender.sync_batchnorm import SynchronizedBatchNorm3d as BatchNorm3d
 
@@ -61,7 +61,7 @@ class DenseMotionNetwork(nn.Module):
         feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
         feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
         sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3) !!!!
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
+        sparse_deformed = grid_sample_fp32(feature_repeat, sparse_motions)
         sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
         return sparse_deformed
 
@@ -99,7 +99,7 @@ class DenseMotionNetwork(nn.Module):
 
 
         mask = self.mask(prediction)
-        mask = F.softmax(mask, dim=1)
+        mask = softmax_fp32(mask, dim=1)
         out_dict['mask'] = mask
         mask = mask.unsqueeze(2)                                   # (bs, num_kp+1, 1, d, h, w)
         
@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from src.facerender.modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, ResBlock3d, SPADEResnetBlock
+from src.facerender.modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, ResBlock3d, SPADEResnetBlock, grid_sample_fp32
 from src.facerender.modules.dense_motion import DenseMotionNetwork
 
 
@@ -62,13 +62,13 @@ class OcclusionAwareGenerator(nn.Module):
         _, d_old, h_old, w_old, _ = deformation.shape
         _, _, d, h, w = inp.shape
         if d_old != d or h_old != h or w_old != w:
-            deformation = deformation.permute(0, 4, 1, 2, 3)
+            deformation = deformation.float().permute(0, 4, 1, 2, 3)
             deformation = F.interpolate(deformation, size=(d, h, w), mode='trilinear')
             deformation = deformation.permute(0, 2, 3, 4, 1)
-        return F.grid_sample(inp, deformation)
+        return grid_sample_fp32(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        # Encoding (downsampling) part, only depends on the source image
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -77,7 +77,13 @@ class OcclusionAwareGenerator(nn.Module):
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.forward_with_feature(feature_3d, kp_driving, kp_source)
 
+    def forward_with_feature(self, feature_3d, kp_driving, kp_source):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
@@ -202,13 +208,13 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         _, d_old, h_old, w_old, _ = deformation.shape
         _, _, d, h, w = inp.shape
         if d_old != d or h_old != h or w_old != w:
-            deformation = deformation.permute(0, 4, 1, 2, 3)
+            deformation = deformation.float().permute(0, 4, 1, 2, 3)
             deformation = F.interpolate(deformation, size=(d, h, w), mode='trilinear')
             deformation = deformation.permute(0, 2, 3, 4, 1)
-        return F.grid_sample(inp, deformation)
+        return grid_sample_fp32(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        # Encoding (downsampling) part, only depends on the source image
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -217,7 +223,13 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.forward_with_feature(feature_3d, kp_driving, kp_source)
 
+    def forward_with_feature(self, feature_3d, kp_driving, kp_source):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
@@ -3,7 +3,7 @@ import torch
 import torch.nn.functional as F
 
 from src.facerender.sync_batchnorm import SynchronizedBatchNorm2d as BatchNorm2d
-from src.facerender.modules.util import KPHourglass, make_coordinate_grid, AntiAliasInterpolation2d, ResBottleneck
+from src.facerender.modules.util import KPHourglass, make_coordinate_grid, AntiAliasInterpolation2d, ResBottleneck, softmax_fp32
 
 
 class KPDetector(nn.Module):
@@ -62,7 +62,7 @@ class KPDetector(nn.Module):
 
         final_shape = prediction.shape
         heatmap = prediction.view(final_shape[0], final_shape[1], -1)
-        heatmap = F.softmax(heatmap / self.temperature, dim=2)
+        heatmap = softmax_fp32(heatmap / self.temperature, dim=2)
         heatmap = heatmap.view(*final_shape)
 
         out = self.gaussian2kp(heatmap)
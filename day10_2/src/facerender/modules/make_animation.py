@@ -1,4 +1,5 @@
 from scipy.spatial import ConvexHull
+import contextlib
 import torch
 import torch.nn.functional as F
 import numpy as np
@@ -30,7 +31,7 @@ def headpose_pred_to_degree(pred):
     device = pred.device
     idx_tensor = [idx for idx in range(66)]
     idx_tensor = torch.FloatTensor(idx_tensor).type_as(pred).to(device)
-    pred = F.softmax(pred)
+    pred = F.softmax(pred, dim=1)
     degree = torch.sum(pred*idx_tensor, 1) * 3 - 99
     return degree
 
@@ -99,33 +100,106 @@ def keypoint_transformation(kp_canonical, he, wo_exp=False):
 
 
 
-def make_animation(source_image, source_semantics, target_semantics,
-                            generator, kp_detector, he_estimator, mapping, 
-                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
-                            use_exp=True, use_half=False):
+def resolve_precision(precision, device):
+    """ 'half' is bf16 on cpu and fp16 on cuda """
+    if precision == 'half':
+        return 'bf16' if torch.device(device).type == 'cpu' else 'fp16'
+    return precision
+
+def autocast(device, precision='fp32'):
+    """
+    Autocast context for the facerender networks. The keypoint and head pose math around them
+    runs outside of it in fp32; grid_sample and softmax inside the networks stay in fp32 as well.
+    """
+    precision = resolve_precision(precision, device)
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+def to_fp32(out):
+    return {k: v.float() for k, v in out.items()}
+
+def driving_keypoints(kp_canonical, target_semantics, mapping,
+                      yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, chunk_size=1024, precision='fp32'):
+    """
+    Run the mapping net and the keypoint transformation over the whole sequence,
+    chunk_size frames at a time.
+    target_semantics: (bs, T, 70, 27) -> driving keypoints (bs, T, num_kp, 3)
+    """
+    bs, num_frames = target_semantics.shape[:2]
+    step = max(1, chunk_size // bs)
+    camera_seq = {'yaw_in': yaw_c_seq, 'pitch_in': pitch_c_seq, 'roll_in': roll_c_seq}
+
+    kp_driving = []
+    for start in range(0, num_frames, step):
+        semantics = target_semantics[:, start:start+step]              # bs n 70 27
+        n = semantics.shape[1]
+        with autocast(target_semantics.device, precision):
+            he_driving = mapping(semantics.reshape((bs*n,) + semantics.shape[2:]))
+        he_driving = to_fp32(he_driving)
+        for key, seq in camera_seq.items():
+            if seq is not None:
+                he_driving[key] = seq[:, start:start+step].reshape(-1)
+        # row b*n+i belongs to batch item b
+        kp_value = kp_canonical['value'].repeat_interleave(n, dim=0)
+        kp = keypoint_transformation({'value': kp_value}, he_driving)['value']
+        kp_driving.append(kp.view((bs, n) + kp.shape[1:]))
+
+    return torch.cat(kp_driving, dim=1)
+
+
+def prepare_animation(source_image, source_semantics, target_semantics,
+                      generator, kp_detector, mapping,
+                      yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, precision='fp32', source=None):
+    """
+    Everything but the per frame generator pass: the encoded source image, the source keypoints
+    and the driving keypoints (bs, T, num_kp, 3) of all the frames.
+    source: the prepare_source() output of source_image, when it was already computed
+    """
+    if source is None:
+        source = prepare_source(source_image, source_semantics, generator, kp_detector, mapping, precision)
+    source_feature, kp_canonical, kp_source = source
     with torch.no_grad():
-        predictions = []
+        # mapping net and head pose for all the frames, only the generator runs per frame
+        kp_driving_seq = driving_keypoints(kp_canonical, target_semantics, mapping,
+                                           yaw_c_seq, pitch_c_seq, roll_c_seq, precision=precision)
+    return source_feature, kp_source, kp_driving_seq
 
-        kp_canonical = kp_detector(source_image)
-        he_source = mapping(source_semantics)
-        kp_source = keypoint_transformation(kp_canonical, he_source)
-    
+
+def prepare_source(source_image, source_semantics, generator, kp_detector, mapping, precision='fp32'):
+    """ the encoded source image, its canonical and its posed keypoints """
+    device = source_image.device
+    with torch.no_grad():
+        with autocast(device, precision):
+            kp_canonical = kp_detector(source_image)
+            he_source = mapping(source_semantics)
+            # the source image is the same for every frame, encode it only once
+            source_feature = generator.encode_source(source_image)
+        kp_canonical = to_fp32(kp_canonical)
+        kp_source = keypoint_transformation(kp_canonical, to_fp32(he_source))
+    return source_feature, kp_canonical, kp_source
+
+
+def iter_animation(source_image, source_semantics, target_semantics,
+                            generator, kp_detector, mapping, 
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, precision='fp32', source=None):
+    """
+    Yield the rendered batch (bs, 3, H, W) of every frame step, so the caller
+    does not have to keep the whole video on device.
+    precision: 'fp32', 'fp16', 'bf16' or 'half', the networks run under autocast
+    """
+    device = source_image.device
+    source_feature, kp_source, kp_driving_seq = prepare_animation(source_image, source_semantics, target_semantics,
+                                                                  generator, kp_detector, mapping,
+                                                                  yaw_c_seq, pitch_c_seq, roll_c_seq, precision, source)
+    with torch.no_grad():
         for frame_idx in tqdm(range(target_semantics.shape[1]), 'Face Renderer:'):
-            # still check the dimension
-            # print(target_semantics.shape, source_semantics.shape)
-            target_semantics_frame = target_semantics[:, frame_idx]
-            he_driving = mapping(target_semantics_frame)
-            if yaw_c_seq is not None:
-                he_driving['yaw_in'] = yaw_c_seq[:, frame_idx]
-            if pitch_c_seq is not None:
-                he_driving['pitch_in'] = pitch_c_seq[:, frame_idx] 
-            if roll_c_seq is not None:
-                he_driving['roll_in'] = roll_c_seq[:, frame_idx] 
-            
-            kp_driving = keypoint_transformation(kp_canonical, he_driving)
+            kp_driving = {'value': kp_driving_seq[:, frame_idx]}
                 
             kp_norm = kp_driving
-            out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
+            with autocast(device, precision):
+                out = generator.forward_with_feature(source_feature, kp_source=kp_source, kp_driving=kp_norm)
             '''
             source_image_new = out['prediction'].squeeze(1)
             kp_canonical_new =  kp_detector(source_image_new)
@@ -134,8 +208,19 @@ def make_animation(source_image, source_semantics, target_semantics,
             kp_driving_new = keypoint_transformation(kp_canonical_new, he_driving, wo_exp=True)
             out = generator(source_image_new, kp_source=kp_source_new, kp_driving=kp_driving_new)
             '''
-            predictions.append(out['prediction'])
-        predictions_ts = torch.stack(predictions, dim=1)
+            yield out['prediction'].float()
+
+
+def make_animation(source_image, source_semantics, target_semantics,
+                            generator, kp_detector, he_estimator, mapping, 
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
+                            use_exp=True, use_half=False, precision=None):
+    if precision is None:
+        precision = 'half' if use_half else 'fp32'
+    predictions = list(iter_animation(source_image, source_semantics, target_semantics,
+                                      generator, kp_detector, mapping,
+                                      yaw_c_seq, pitch_c_seq, roll_c_seq, precision=precision))
+    predictions_ts = torch.stack(predictions, dim=1)
     return predictions_ts
 
 class AnimateModel(torch.nn.Module):
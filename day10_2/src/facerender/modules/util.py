@@ -32,6 +32,17 @@ def kp2gaussian(kp, spatial_size, kp_variance):
 
     return out
 
+def grid_sample_fp32(inp, grid):
+    """
+    grid_sample with the sampling coordinates kept in fp32, also under autocast
+    """
+    with torch.autocast(device_type=inp.device.type, enabled=False):
+        return F.grid_sample(inp.float(), grid.float())
+
+def softmax_fp32(x, dim):
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        return F.softmax(x.float(), dim=dim)
+
 def make_coordinate_grid_2d(spatial_size, type):
     """
     Create a meshgrid [-1,1] x [-1,1] of given spatial_size.
@@ -0,0 +1,189 @@
+""" Frame batching across the jobs sharing one AnimateFromCoeff.
+
+Every job prepares its source feature and keypoints itself (prepare_animation) and submits the
+driving keypoints of its frames in chunks. A single worker packs the pending frames of all the jobs
+with the same render size and precision into batches of batch_size, each frame carrying the index
+of its source, and hands every chunk its own predictions back. A batch is rendered as soon as it is
+full, or once the oldest pending frames waited `deadline` seconds; short batches are padded so that
+the traced / exported generators always see the same shape.
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+from src.facerender.modules.make_animation import autocast, prepare_animation
+
+
+class RenderChunk():
+
+    def __init__(self, source_feature, kp_source, kp_driving, source_index, precision):
+        self.source_feature = source_feature    # bs C D H W
+        self.kp_source = kp_source              # bs num_kp 3
+        self.kp_driving = kp_driving            # n num_kp 3
+        self.source_index = source_index        # n, the source_feature row of every frame
+        self.precision = precision
+        self.key = (tuple(source_feature.shape[1:]), str(source_feature.device), precision)
+        self.arrival = time.monotonic()        # since when the remaining frames are pending
+        self.future = Future()
+        self.started = False
+        self.next = 0                           # frames handed to a batch
+        self.outputs = []
+
+    def __len__(self):
+        return self.kp_driving.shape[0]
+
+    @property
+    def remaining(self):
+        return len(self) - self.next
+
+
+class RenderScheduler():
+    """ facerender_models: precision -> (generator, kp_detector, mapping), e.g. AnimateFromCoeff.facerender_models """
+
+    def __init__(self, facerender_models, batch_size=16, deadline=0.02):
+        self.facerender_models = facerender_models
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def submit(self, source_feature, kp_source, kp_driving, source_index, precision='fp32'):
+        """ returns a Future of the predictions (n, 3, H, W) of the n frames in kp_driving """
+        chunk = RenderChunk(source_feature, kp_source, kp_driving, source_index, precision)
+        with self.cond:
+            self.pending.append(chunk)
+            # the worker only lives while there are frames to render
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return chunk.future
+
+    def run(self):
+        while True:
+            segments = self.next_batch()
+            if segments is None:
+                return
+            if not segments:
+                continue
+            try:
+                self.render(segments)
+            except Exception as e:
+                chunks = {id(chunk): chunk for chunk, _, _ in segments}.values()
+                with self.cond:
+                    self.pending = [chunk for chunk in self.pending if chunk not in chunks]
+                for chunk in chunks:
+                    chunk.future.set_exception(e)
+
+    def next_batch(self):
+        """ [(chunk, start, stop)] frames of one size and precision, at most batch_size of them """
+        with self.cond:
+            while True:
+                # jobs that stopped reading drop their chunks
+                self.pending = [chunk for chunk in self.pending if chunk.started or not chunk.future.cancelled()]
+                if not self.pending:
+                    self.thread = None
+                    return None
+
+                groups = {}
+                for chunk in self.pending:
+                    groups.setdefault(chunk.key, []).append(chunk)
+                full = [chunks for chunks in groups.values() if sum(chunk.remaining for chunk in chunks) >= self.batch_size]
+                oldest = min(self.pending, key=lambda chunk: chunk.arrival)
+                wait = oldest.arrival + self.deadline - time.monotonic()
+                if full or wait <= 0:
+                    chunks = full[0] if full else groups[oldest.key]
+                    break
+                self.cond.wait(wait)
+
+            segments = []
+            size = 0
+            for chunk in chunks:
+                if not chunk.started:
+                    if not chunk.future.set_running_or_notify_cancel():
+                        self.pending.remove(chunk)
+                        continue
+                    chunk.started = True
+                n = min(chunk.remaining, self.batch_size - size)
+                segments.append((chunk, chunk.next, chunk.next + n))
+                chunk.next += n
+                size += n
+                if chunk.remaining == 0:
+                    self.pending.remove(chunk)
+                else:
+                    # the rest of a split chunk waits for other frames to fill its batch again
+                    chunk.arrival = time.monotonic()
+                if size == self.batch_size:
+                    break
+            return segments
+
+    def render(self, segments):
+        precision = segments[0][0].precision
+        generator = self.facerender_models(precision)[0]
+
+        index = [chunk.source_index[start:stop] for chunk, start, stop in segments]
+        source_feature = torch.cat([chunk.source_feature[i] for (chunk, _, _), i in zip(segments, index)])
+        kp_source = torch.cat([chunk.kp_source[i] for (chunk, _, _), i in zip(segments, index)])
+        kp_driving = torch.cat([chunk.kp_driving[start:stop] for chunk, start, stop in segments])
+
+        num_frames = kp_driving.shape[0]
+        pad = self.batch_size - num_frames
+        if pad > 0:
+            source_feature, kp_source, kp_driving = [torch.cat([x, x[-1:].expand((pad,) + x.shape[1:])])
+                                                     for x in (source_feature, kp_source, kp_driving)]
+
+        with torch.no_grad():
+            with autocast(kp_driving.device, precision):
+                out = generator.forward_with_feature(source_feature, kp_source={'value': kp_source},
+                                                     kp_driving={'value': kp_driving})
+        predictions = out['prediction'][:num_frames].float()
+
+        offset = 0
+        for chunk, start, stop in segments:
+            chunk.outputs.append(predictions[offset:offset + stop - start])
+            offset += stop - start
+            if stop == len(chunk):
+                chunk.future.set_result(torch.cat(chunk.outputs))
+                chunk.outputs = []
+
+
+def iter_scheduled_animation(scheduler, source_image, source_semantics, target_semantics,
+                             generator, kp_detector, mapping,
+                             yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, precision='fp32',
+                             chunk_size=None, in_flight=2, source=None):
+    """
+    iter_animation with the generator passes going through the scheduler: the frame steps are
+    submitted chunk_size frames (batch_size by default) at a time, keeping in_flight chunks queued.
+    """
+    source_feature, kp_source, kp_driving_seq = prepare_animation(source_image, source_semantics, target_semantics,
+                                                                  generator, kp_detector, mapping,
+                                                                  yaw_c_seq, pitch_c_seq, roll_c_seq, precision, source)
+    bs, num_steps = kp_driving_seq.shape[:2]
+    steps = max(1, (chunk_size or scheduler.batch_size) // bs)
+    # frames are submitted step major, bs consecutive frames per step
+    source_index = torch.arange(bs, device=source_feature.device).repeat(steps)
+
+    futures = deque()
+    try:
+        for start in range(0, num_steps, steps):
+            kp_driving = kp_driving_seq[:, start:start+steps].transpose(0, 1)
+            n = kp_driving.shape[0]
+            futures.append(scheduler.submit(source_feature, kp_source['value'],
+                                            kp_driving.reshape((n * bs,) + kp_driving.shape[2:]),
+                                            source_index[:n * bs], precision))
+            if len(futures) < in_flight:
+                continue
+            predictions = futures.popleft().result()
+            for step in predictions.view((-1, bs) + predictions.shape[1:]):
+                yield step
+        while futures:
+            predictions = futures.popleft().result()
+            for step in predictions.view((-1, bs) + predictions.shape[1:]):
+                yield step
+    finally:
+        for future in futures:
+            future.cancel()
@@ -1,11 +1,12 @@
 import os
 
-from tqdm import tqdm
 import torch
 import numpy as np
 import random
 import scipy.io as scio
 import src.utils.audio as audio
+from src.utils.hparams import hparams as hp
+from src.utils.motion_templates import load_ref_coeff, loop_coeff
 
 def crop_pad_audio(wav, audio_length):
     if len(wav) > audio_length:
@@ -48,6 +49,31 @@ def generate_blink_seq_randomly(num_frames):
             break
     return ratio
 
+def mel_window_index(frame_ids, num_spec_frames, fps=25, syncnet_mel_step_size=16):
+    # mel window of video frame i starts at int(80 * (i-2) / fps), clamped to the spectrogram
+    start_frame_num = frame_ids - 2
+    start_idx = (80. * (start_frame_num / float(fps))).astype(np.int64)   # truncates towards zero like int()
+    seq = start_idx[:, None] + np.arange(syncnet_mel_step_size)[None, :]
+    return np.clip(seq, 0, num_spec_frames-1)                            # T 16
+
+def get_mel_windows(spec, num_frames, fps=25, syncnet_mel_step_size=16):
+    seq = mel_window_index(np.arange(num_frames), spec.shape[0], fps, syncnet_mel_step_size)
+
+    indiv_mels = np.empty((num_frames, spec.shape[1], syncnet_mel_step_size), dtype=np.float32)
+    indiv_mels[...] = spec[seq].transpose(0, 2, 1)
+    return indiv_mels
+
+def chunk_melspectrogram(wav, start, stop, offset=0):
+    """ frames [start, stop) of audio.melspectrogram(wav).T, computed from the samples around them only.
+    wav may be the tail of a longer waveform starting at sample offset. """
+    hop = audio.get_hop_size()
+    # n_fft covers the half window on both sides of a frame and the preemphasis sample before it
+    context = hp.n_fft // hop
+    first = max(start - context, 0)
+    begin, end = first * hop, min((stop - 1 + context) * hop + 1, offset + len(wav))
+    spec = audio.melspectrogram(wav[begin - offset:end - offset]).T
+    return spec[start - first:stop - first].astype(np.float32)
+
 def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True):
 
     syncnet_mel_step_size = 16
@@ -59,24 +85,14 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
     
     if idlemode:
         num_frames = int(length_of_audio * 25)
-        indiv_mels = np.zeros((num_frames, 80, 16))
+        indiv_mels = np.zeros((num_frames, 80, 16), dtype=np.float32)
     else:
         wav = audio.load_wav(audio_path, 16000) 
         wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
         wav = crop_pad_audio(wav, wav_length)
         orig_mel = audio.melspectrogram(wav).T
-        spec = orig_mel.copy()         # nframes 80
-        indiv_mels = []
-
-        for i in tqdm(range(num_frames), 'mel:'):
-            start_frame_num = i-2
-            start_idx = int(80. * (start_frame_num / float(fps)))
-            end_idx = start_idx + syncnet_mel_step_size
-            seq = list(range(start_idx, end_idx))
-            seq = [ min(max(item, 0), orig_mel.shape[0]-1) for item in seq ]
-            m = spec[seq, :]
-            indiv_mels.append(m.T)
-        indiv_mels = np.asarray(indiv_mels)         # T 80 16
+        spec = orig_mel.astype(np.float32)         # nframes 80
+        indiv_mels = get_mel_windows(spec, num_frames, fps, syncnet_mel_step_size)         # T 80 16
 
     ratio = generate_blink_seq_randomly(num_frames)      # T
     source_semantics_path = first_coeff_path
@@ -86,20 +102,10 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
 
     if ref_eyeblink_coeff_path is not None:
         ratio[:num_frames] = 0
-        refeyeblink_coeff_dict = scio.loadmat(ref_eyeblink_coeff_path)
-        refeyeblink_coeff = refeyeblink_coeff_dict['coeff_3dmm'][:,:64]
-        refeyeblink_num_frames = refeyeblink_coeff.shape[0]
-        if refeyeblink_num_frames<num_frames:
-            div = num_frames//refeyeblink_num_frames
-            re = num_frames%refeyeblink_num_frames
-            refeyeblink_coeff_list = [refeyeblink_coeff for i in range(div)]
-            refeyeblink_coeff_list.append(refeyeblink_coeff[:re, :64])
-            refeyeblink_coeff = np.concatenate(refeyeblink_coeff_list, axis=0)
-            print(refeyeblink_coeff.shape[0])
-
-        ref_coeff[:, :64] = refeyeblink_coeff[:num_frames, :64] 
+        refeyeblink_coeff = loop_coeff(load_ref_coeff(ref_eyeblink_coeff_path)[:, :64], num_frames)
+        ref_coeff[:, :64] = refeyeblink_coeff
     
-    indiv_mels = torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0) # bs T 1 80 16
+    indiv_mels = torch.from_numpy(indiv_mels).unsqueeze(1).unsqueeze(0) # bs T 1 80 16
 
     if use_blink:
         ratio = torch.FloatTensor(ratio).unsqueeze(0)                       # bs T
@@ -118,3 +124,138 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
             'ratio_gt': ratio,
             'audio_name': audio_name, 'pic_name': pic_name}
 
+
+
+class AudioChunks():
+    """
+    get_data() for long audio, batch(start, stop) returns its dict for the frames [start, stop).
+    Only the waveform and a few floats per frame (blink ratio) are kept for the whole audio,
+    the mel windows are computed for the frames of each batch.
+    """
+
+    def __init__(self, first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True):
+        fps = 25
+        self.device = device
+        self.pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
+        self.audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
+
+        if idlemode:
+            self.wav = None
+            self.num_frames = int(length_of_audio * 25)
+        else:
+            wav = audio.load_wav(audio_path, 16000)
+            wav_length, self.num_frames = parse_audio_length(len(wav), 16000, fps)
+            self.wav = crop_pad_audio(wav, wav_length).astype(np.float32)
+            self.wav_offset = 0
+            # center padded stft frames
+            self.num_spec_frames = 1 + len(self.wav) // audio.get_hop_size()
+
+        self.ratio = generate_blink_seq_randomly(self.num_frames)                  # T 1
+        self.source_coeff = scio.loadmat(first_coeff_path)['coeff_3dmm'][:1,:70]   # 1 70
+        self.eyeblink_coeff = None
+        if ref_eyeblink_coeff_path is not None:
+            self.ratio[:] = 0
+            self.eyeblink_coeff = load_ref_coeff(ref_eyeblink_coeff_path)[:, :64]
+        if not use_blink:
+            self.ratio[:] = 0
+
+    def __len__(self):
+        return self.num_frames
+
+    def mel_windows(self, start, stop):
+        if self.wav is None:
+            return np.zeros((stop - start, 80, 16), dtype=np.float32)
+        seq = mel_window_index(np.arange(start, stop), self.num_spec_frames)
+        first = seq.min()
+        spec = chunk_melspectrogram(self.wav, first, seq.max() + 1, self.wav_offset)
+        return spec[seq - first].transpose(0, 2, 1)                                # T 80 16
+
+    def batch(self, start, stop):
+        num_frames = stop - start
+        indiv_mels = self.mel_windows(start, stop)
+
+        ref_coeff = np.repeat(self.source_coeff, num_frames, axis=0)
+        if self.eyeblink_coeff is not None:
+            ref_coeff[:, :64] = self.eyeblink_coeff[np.arange(start, stop) % self.eyeblink_coeff.shape[0]]
+
+        indiv_mels = torch.from_numpy(np.ascontiguousarray(indiv_mels)).unsqueeze(1).unsqueeze(0)  # bs T 1 80 16
+        ratio = torch.FloatTensor(self.ratio[start:stop]).unsqueeze(0)             # bs T
+        ref_coeff = torch.FloatTensor(ref_coeff).unsqueeze(0)                      # bs T 70
+
+        return {'indiv_mels': indiv_mels.to(self.device),
+                'ref': ref_coeff.to(self.device),
+                'num_frames': num_frames,
+                'ratio_gt': ratio.to(self.device),
+                'audio_name': self.audio_name, 'pic_name': self.pic_name}
+
+
+class StreamingAudio(AudioChunks):
+    """
+    AudioChunks of audio that arrives in pieces: push() appends 16 kHz mono samples, finish() ends the
+    stream. ready() is the number of frames whose mel windows are final, i.e. do not depend on samples
+    that have not arrived yet; that is 4 frames (160 ms) after the audio of a frame. The samples no
+    frame from trim(frame) on needs are dropped.
+    """
+
+    def __init__(self, first_coeff_path, device, ref_eyeblink_coeff_path=None, use_blink=True, name='stream'):
+        self.device = device
+        self.pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
+        self.audio_name = name
+        self.wav = np.zeros(0, dtype=np.float32)
+        self.wav_offset = 0
+        self.num_samples = 0
+        self.finished = False
+        self.num_frames = 0
+        # unknown until finish(), no window is clamped at the end before
+        self.num_spec_frames = np.iinfo(np.int64).max
+        self.use_blink = use_blink and ref_eyeblink_coeff_path is None
+
+        self.ratio = np.zeros((0, 1))
+        self.source_coeff = scio.loadmat(first_coeff_path)['coeff_3dmm'][:1,:70]   # 1 70
+        self.eyeblink_coeff = None
+        if ref_eyeblink_coeff_path is not None:
+            self.eyeblink_coeff = load_ref_coeff(ref_eyeblink_coeff_path)[:, :64]
+
+    def push(self, pcm):
+        pcm = np.asarray(pcm)
+        if pcm.dtype == np.int16:
+            pcm = pcm / 32768.
+        self.wav = np.concatenate([self.wav, pcm.astype(np.float32).reshape(-1)])
+        self.num_samples += pcm.size
+        self.num_frames = self.ready()
+        self.extend_ratio()
+
+    def finish(self):
+        # like get_data: the audio is cut to whole frames
+        self.num_frames = self.num_samples // 640
+        self.wav = self.wav[:max(0, self.num_frames * 640 - self.wav_offset)]
+        self.num_spec_frames = 1 + self.num_frames * 640 // audio.get_hop_size()
+        self.finished = True
+        self.extend_ratio()
+
+    def ready(self):
+        if self.finished:
+            return self.num_frames
+        hop = audio.get_hop_size()
+        context = hp.n_fft // hop
+        # the last mel frame of video frame i is int(3.2 * (i - 2)) + 15, it needs the samples up to
+        # (m + context) * hop; one frame of margin keeps the samples get_data would cut off out of it
+        num_mels = (self.num_samples - 1 - 640) // hop - context + 1
+        # the window of frame num_mels // 3 always ends past the final mel frames
+        frames = np.arange(self.num_frames, max(self.num_frames, num_mels // 3) + 1)
+        last_mel = mel_window_index(frames, self.num_spec_frames)[:, -1]
+        return self.num_frames + int(np.searchsorted(last_mel, num_mels))
+
+    def extend_ratio(self):
+        while self.ratio.shape[0] < self.num_frames:
+            block = generate_blink_seq_randomly(140) if self.use_blink else np.zeros((140, 1))
+            self.ratio = np.concatenate([self.ratio, block])
+
+    def trim(self, frame):
+        """ the frames before frame will not be asked for again """
+        hop = audio.get_hop_size()
+        first = max(0, mel_window_index(np.array([frame]), self.num_spec_frames)[0, 0] - hp.n_fft // hop)
+        drop = first * hop - self.wav_offset
+        if drop > 0:
+            self.wav = self.wav[drop:]
+            self.wav_offset += drop
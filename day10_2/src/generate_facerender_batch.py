@@ -1,20 +1,53 @@
 import os
+import copy
 import numpy as np
 from PIL import Image
 from skimage import io, img_as_float32, transform
 import torch
 import scipy.io as scio
 
-def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
-                        batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
-                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256):
-
-    semantic_radius = 13
-    video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
-    txt_path = os.path.splitext(coeff_path)[0]
-
-    data={}
-
+class SemanticWindows():
+    """
+    Lazy stand-in for the (batch_size, T, 70, semantic_radius*2+1) target semantics tensor.
+    The windows are a strided view over the edge-padded coefficients and are only
+    materialized for the frames that are indexed, e.g. one render chunk at a time.
+    """
+
+    def __init__(self, coeff_3dmm, semantic_radius, batch_size, start=0, stop=None):
+        self.coeff_3dmm = np.pad(coeff_3dmm.astype(np.float32), ((semantic_radius, semantic_radius), (0, 0)), mode='edge')
+        # [t, c, k] = coeff_3dmm[clamp(t - semantic_radius + k), c]
+        self.windows = np.lib.stride_tricks.sliding_window_view(self.coeff_3dmm, semantic_radius*2+1, axis=0)
+        self.batch_size = batch_size
+        self.device = 'cpu'
+
+        # the frames [start, stop) of coeff_3dmm, the rows around them only serve as context.
+        # the last frame is repeated to fill up the batches, frame f lives at [f // T, f % T]
+        stop = coeff_3dmm.shape[0] if stop is None else stop
+        frame_num = stop - start
+        padded_num = frame_num + (-frame_num) % batch_size
+        self.frame_ids = start + np.minimum(np.arange(padded_num), frame_num-1).reshape(batch_size, -1)
+
+    @property
+    def shape(self):
+        return self.frame_ids.shape + self.windows.shape[1:]
+
+    def __getitem__(self, index):
+        frame_ids = self.frame_ids[index]
+        return torch.from_numpy(self.windows[frame_ids]).to(self.device)
+
+    def to(self, device):
+        windows = copy.copy(self)
+        windows.device = device
+        return windows
+
+    def interleave(self):
+        """ frame f at [f % batch_size, f // batch_size], so each column holds consecutive frames """
+        windows = copy.copy(self)
+        windows.frame_ids = self.frame_ids.reshape(-1, self.batch_size).T
+        return windows
+
+
+def load_source(pic_path, first_coeff_path, batch_size, preprocess='crop', size=256, semantic_radius=13):
     img1 = Image.open(pic_path)
     source_image = np.array(img1)
     source_image = img_as_float32(source_image)
@@ -22,25 +55,21 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
     source_image = source_image.transpose((2, 0, 1))
     source_image_ts = torch.FloatTensor(source_image).unsqueeze(0)
     source_image_ts = source_image_ts.repeat(batch_size, 1, 1, 1)
-    data['source_image'] = source_image_ts
  
     source_semantics_dict = scio.loadmat(first_coeff_path)
-    generated_dict = scio.loadmat(coeff_path)
 
     if 'full' not in preprocess.lower():
         source_semantics = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
-
     else:
         source_semantics = source_semantics_dict['coeff_3dmm'][:1,:73]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
 
     source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
     source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
     source_semantics_ts = source_semantics_ts.repeat(batch_size, 1, 1)
-    data['source_semantics'] = source_semantics_ts
+    return source_image_ts, source_semantics_ts, source_semantics
 
-    # target 
+def transform_target(generated_3dmm, source_semantics, expression_scale=1.0, still_mode=False, preprocess='crop'):
+    generated_3dmm = generated_3dmm[:, :70].copy()
     generated_3dmm[:, :64] = generated_3dmm[:, :64] * expression_scale
 
     if 'full' in preprocess.lower():
@@ -48,28 +77,38 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
 
     if still_mode:
         generated_3dmm[:, 64:] = np.repeat(source_semantics[:, 64:], generated_3dmm.shape[0], axis=0)
+    return generated_3dmm
 
-    with open(txt_path+'.txt', 'w') as f:
-        for coeff in generated_3dmm:
-            for i in coeff:
-                f.write(str(i)[:7]   + '  '+'\t')
-            f.write('\n')
+def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
+                        batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
+                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256, save_coeff_txt=False):
 
-    target_semantics_list = [] 
-    frame_num = generated_3dmm.shape[0]
-    data['frame_num'] = frame_num
-    for frame_idx in range(frame_num):
-        target_semantics = transform_semantic_target(generated_3dmm, frame_idx, semantic_radius)
-        target_semantics_list.append(target_semantics)
+    semantic_radius = 13
+    video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
+    txt_path = os.path.splitext(coeff_path)[0]
 
-    remainder = frame_num%batch_size
-    if remainder!=0:
-        for _ in range(batch_size-remainder):
-            target_semantics_list.append(target_semantics)
+    data={}
+
+    source_image_ts, source_semantics_ts, source_semantics = load_source(pic_path, first_coeff_path, batch_size,
+                                                                        preprocess, size, semantic_radius)
+    data['source_image'] = source_image_ts
+    data['source_semantics'] = source_semantics_ts
+
+    # target 
+    generated_dict = scio.loadmat(coeff_path)
+    generated_3dmm = transform_target(generated_dict['coeff_3dmm'], source_semantics, expression_scale, still_mode, preprocess)
+
+    if save_coeff_txt:
+        with open(txt_path+'.txt', 'w') as f:
+            for coeff in generated_3dmm:
+                for i in coeff:
+                    f.write(str(i)[:7]   + '  '+'\t')
+                f.write('\n')
 
-    target_semantics_np = np.array(target_semantics_list)             #frame_num 70 semantic_radius*2+1
-    target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
-    data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
+    frame_num = generated_3dmm.shape[0]
+    data['frame_num'] = frame_num
+    # batch_size x frame_num/batch_size x 70 x semantic_radius*2+1, built per render chunk
+    data['target_semantics_list'] = SemanticWindows(generated_3dmm, semantic_radius, batch_size)
     data['video_name'] = video_name
     data['audio_path'] = audio_path
     
@@ -85,6 +124,78 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
  
     return data
 
+
+class FacerenderChunks():
+    """
+    get_facerender_data() for the coefficient chunks of Audio2Coeff.generate_chunks(), iterating yields
+    the render data of consecutive frames. The last semantic_radius frames of a chunk are held back until
+    the coefficients after them arrived, only the rows the next windows reach back to are kept.
+    add() takes the coefficients as they come instead, for streams of unknown length (frame_num None).
+    `info` has the frame_num, audio_path and video_name of the whole video for AnimateFromCoeff.encode_video.
+    """
+
+    def __init__(self, coeff_chunks, frame_num, video_name, pic_path, first_coeff_path, audio_path,
+                 batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None,
+                 expression_scale=1.0, still_mode=False, preprocess='crop', size=256):
+        self.semantic_radius = 13
+        self.coeff_chunks = coeff_chunks
+        self.batch_size = batch_size
+        self.expression_scale = expression_scale
+        self.still_mode = still_mode
+        self.preprocess = preprocess
+        self.info = {'frame_num': frame_num, 'audio_path': audio_path, 'video_name': video_name}
+        self.coeff_3dmm = None
+        self.offset = 0         # frame of coeff_3dmm[0]
+        self.done = 0
+
+        self.source_image, self.source_semantics_ts, self.source_semantics = load_source(pic_path, first_coeff_path, batch_size,
+                                                                                         preprocess, size, self.semantic_radius)
+        # one degree per frame for the whole video
+        self.camera_seqs = {}
+        for key, degree_list in (('yaw_c_seq', input_yaw_list), ('pitch_c_seq', input_pitch_list), ('roll_c_seq', input_roll_list)):
+            if degree_list is not None:
+                self.camera_seqs[key] = gen_camera_pose(degree_list, frame_num, 1)[0]
+
+    def chunk(self, coeff_3dmm, start, stop, offset):
+        """ render data of the frames [start, stop), coeff_3dmm holds the frames from offset on """
+        frame_num = stop - start
+        data = {'source_image': self.source_image, 'source_semantics': self.source_semantics_ts,
+                'frame_num': frame_num, 'video_name': self.info['video_name'], 'audio_path': self.info['audio_path']}
+        data['target_semantics_list'] = SemanticWindows(coeff_3dmm, self.semantic_radius, self.batch_size,
+                                                        start - offset, stop - offset)
+        for key, seq in self.camera_seqs.items():
+            seq = seq[start:stop]
+            seq = np.concatenate([seq, np.repeat(seq[-1:], (-frame_num) % self.batch_size)])
+            data[key] = torch.FloatTensor(seq.reshape(self.batch_size, -1))
+        return data
+
+    def add(self, coeffs, final=False):
+        """ render data of the frames that are ready once coeffs, the next frames, arrived, or None """
+        if len(coeffs):
+            coeffs = transform_target(coeffs, self.source_semantics, self.expression_scale, self.still_mode, self.preprocess)
+            self.coeff_3dmm = coeffs if self.coeff_3dmm is None else np.concatenate([self.coeff_3dmm, coeffs])
+        if self.coeff_3dmm is None:
+            return None
+        available = self.offset + self.coeff_3dmm.shape[0]
+        stop = available if final else available - self.semantic_radius
+        if stop <= self.done:
+            return None
+        # the windows of the first and last frames are clamped at the edges of coeff_3dmm
+        data = self.chunk(self.coeff_3dmm, self.done, stop, self.offset)
+        self.done = stop
+
+        keep = max(0, self.done - self.semantic_radius) - self.offset
+        self.coeff_3dmm, self.offset = self.coeff_3dmm[keep:], self.offset + keep
+        return data
+
+    def __iter__(self):
+        received = 0
+        for coeffs in self.coeff_chunks:
+            received += len(coeffs)
+            data = self.add(coeffs, final=received >= self.info['frame_num'])
+            if data is not None:
+                yield data
+
 def transform_semantic_1(semantic, semantic_radius):
     semantic_list =  [semantic for i in range(0, semantic_radius*2+1)]
     coeff_3dmm = np.concatenate(semantic_list, 0)
@@ -1,5 +1,7 @@
 import torch, uuid
-import os, sys, shutil
+import os, sys, shutil, gc, threading, inspect
+from collections import OrderedDict
+from concurrent.futures import Future
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff  
 from src.facerender.animate import AnimateFromCoeff
@@ -7,6 +9,7 @@ from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 
 from src.utils.init_path import init_path
+from src.utils.pipeline import StagePipeline, Stage, streaming
 
 from pydub import AudioSegment
 
@@ -16,9 +19,122 @@ def mp3_to_wav(mp3_filename,wav_filename,frame_rate):
     mp3_file.set_frame_rate(frame_rate).export(wav_filename,format="wav")
 
 
+def _model_bytes(obj, seen=None, depth=0):
+    """ rough size of the weights reachable from a model wrapper """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or depth > 3:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, torch.nn.Module):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    if isinstance(obj, dict):
+        children = obj.values()
+    elif hasattr(obj, '__dict__'):
+        children = vars(obj).values()
+    else:
+        return 0
+    return sum(_model_bytes(v, seen, depth+1) for v in children)
+
+
+class ModelPool():
+    """ Long-lived CropAndExtract / Audio2Coeff / AnimateFromCoeff instances keyed by (size, preprocess).
+    Entries are evicted in LRU order once their weights exceed `max_memory` bytes. """
+
+    def __init__(self, checkpoint_path, config_path, device, max_memory=None, preprocess_cache_dir=None,
+                 render_batch_size=None, render_deadline=0.02):
+        self.checkpoint_path = checkpoint_path
+        self.preprocess_cache_dir = preprocess_cache_dir
+        # concurrent requests of one entry share face renderer batches, see src/facerender/scheduler.py
+        self.render_batch_size = render_batch_size
+        self.render_deadline = render_deadline
+        self.config_path = config_path
+        self.device = device
+        self.max_memory = max_memory
+        self.models = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(size, preprocess):
+        # only 'full' changes the mapping checkpoint and the facerender yaml in init_path
+        return (int(size), 'full' if 'full' in preprocess.lower() else 'crop')
+
+    def get(self, size, preprocess):
+        key = self.key(size, preprocess)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            # the first request of a key loads it, concurrent ones wait on its future
+            future = self.loading.get(key)
+            if future is None:
+                future = self.loading[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+
+        try:
+            entry = self.load(*key)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self.models[key] = entry
+            self._evict()
+        future.set_result(entry)
+        return entry
+
+    def load(self, size, preprocess):
+        sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
+        print(sadtalker_paths)
+        entry = {
+            'sadtalker_paths': sadtalker_paths,
+            'audio_to_coeff': Audio2Coeff(sadtalker_paths, self.device),
+            'preprocess_model': CropAndExtract(sadtalker_paths, self.device, cache_dir=self.preprocess_cache_dir),
+            'animate_from_coeff': AnimateFromCoeff(sadtalker_paths, self.device,
+                                                   render_batch_size=self.render_batch_size,
+                                                   render_deadline=self.render_deadline),
+        }
+        entry['nbytes'] = _model_bytes(entry)
+        return entry
+
+    def warm_up(self, configs):
+        for size, preprocess in configs:
+            self.get(size, preprocess)
+
+    def _evict(self):
+        if self.max_memory is None:
+            return
+        # never drop the entry that was just requested
+        while len(self.models) > 1 and sum(m['nbytes'] for m in self.models.values()) > self.max_memory:
+            key, _ = self.models.popitem(last=False)
+            print('evict models of', key)
+            self.clear_cache()
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.clear_cache()
+
+    @staticmethod
+    def clear_cache():
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
 class SadTalker():
 
-    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', lazy_load=False):
+    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', lazy_load=False,
+                 max_memory_gb=None, warm_up=None, preprocess_cache_dir=None,
+                 render_batch_size=None, render_deadline=0.02):
 
         if torch.cuda.is_available() :
             device = "cuda"
@@ -31,6 +147,14 @@ class SadTalker():
 
         self.checkpoint_path = checkpoint_path
         self.config_path = config_path
+
+        max_memory = None if max_memory_gb is None else int(max_memory_gb * 1024**3)
+        self.model_pool = ModelPool(checkpoint_path, config_path, device, max_memory=max_memory,
+                                    preprocess_cache_dir=preprocess_cache_dir,
+                                    render_batch_size=render_batch_size, render_deadline=render_deadline)
+        # models are loaded on first use, `warm_up` lists the (size, preprocess) entries to load now
+        if warm_up:
+            self.model_pool.warm_up(warm_up)
       
 
     def test(self, source_image, driven_audio, preprocess='crop', 
@@ -41,14 +165,46 @@ class SadTalker():
         ref_info = None,
         use_idle_mode = False,
         length_of_audio = 0, use_blink=True,
-        result_dir='./results/'):
+        result_dir='./results/', precision='fp32', ref_stride=1, ref_max_duration=None):
+
+        job = dict(locals())
+        del job['self']
+        for stage in (self.preprocess_stage, self.audio_stage, self.render_stage, self.encode_stage):
+            job = stage(job)
+        return job['return_path']
+
+    def job(self, *args, **kwargs):
+        """ the arguments of test() as a job for pipeline() """
+        arguments = inspect.signature(self.test).bind(*args, **kwargs)
+        arguments.apply_defaults()
+        return dict(arguments.arguments)
+
+    def pipeline(self, queue_size=2, workers=None):
+        """ test() with every stage in its own workers, so that consecutive jobs overlap:
 
-        self.sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
-        print(self.sadtalker_paths)
-            
-        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
-        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
-        self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
+            with sad_talker.pipeline(workers={'render': 1}) as pipeline:
+                futures = [pipeline.submit(sad_talker.job(image, audio)) for image, audio in inputs]
+                paths = [future.result()['return_path'] for future in futures]
+
+        the encode stage reads the frames while the render stage produces them. """
+        workers = workers or {}
+        return StagePipeline([Stage('preprocess', self.preprocess_stage, workers.get('preprocess', 1)),
+                              Stage('audio', self.audio_stage, workers.get('audio', 1)),
+                              Stage('render', streaming(self.render_stage), workers.get('render', 1)),
+                              Stage('encode', self.encode_stage, workers.get('encode', 1))],
+                             queue_size=queue_size)
+
+    def preprocess_stage(self, job):
+        """ inputs, crop and 3DMM extraction """
+        source_image, driven_audio = job['source_image'], job['driven_audio']
+        preprocess, size = job['preprocess'], job['size']
+        use_ref_video, ref_video, ref_info = job['use_ref_video'], job['ref_video'], job['ref_info']
+        use_idle_mode, length_of_audio = job['use_idle_mode'], job['length_of_audio']
+        result_dir = job['result_dir']
+
+        models = self.model_pool.get(size, preprocess)
+        self.sadtalker_paths = models['sadtalker_paths']
+        preprocess_model = models['preprocess_model']
 
         time_tag = str(uuid.uuid4())
         save_dir = os.path.join(result_dir, time_tag)
@@ -85,7 +241,9 @@ class SadTalker():
             audio_path = os.path.join(save_dir, ref_video_videoname+'.wav')
             print('new audiopath:',audio_path)
             # if ref_video contains audio, set the audio from ref_video.
-            cmd = r"ffmpeg -y -hide_banner -loglevel error -i %s %s"%(ref_video, audio_path)
+            # the audio is cut like the frames read from the video
+            duration = '' if job['ref_max_duration'] is None else '-t %s ' % job['ref_max_duration']
+            cmd = r"ffmpeg -y -hide_banner -loglevel error -i %s %s%s"%(ref_video, duration, audio_path)
             os.system(cmd)        
 
         os.makedirs(save_dir, exist_ok=True)
@@ -93,7 +251,7 @@ class SadTalker():
         #crop image and extract 3dmm from image
         first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
         os.makedirs(first_frame_dir, exist_ok=True)
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
+        first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
         
         if first_coeff_path is None:
             raise AttributeError("No face is detected")
@@ -104,7 +262,8 @@ class SadTalker():
             ref_video_frame_dir = os.path.join(save_dir, ref_video_videoname)
             os.makedirs(ref_video_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_video_coeff_path, _, _ =  self.preprocess_model.generate(ref_video, ref_video_frame_dir, preprocess, source_image_flag=False)
+            ref_video_coeff_path, _, _ =  preprocess_model.generate(ref_video, ref_video_frame_dir, preprocess, source_image_flag=False,
+                                                                 stride=job['ref_stride'], max_duration=job['ref_max_duration'])
         else:
             ref_video_coeff_path = None
 
@@ -127,29 +286,43 @@ class SadTalker():
             ref_pose_coeff_path = None
             ref_eyeblink_coeff_path = None
 
+        job.update(models=models, save_dir=save_dir, pic_path=pic_path, audio_path=audio_path,
+                   first_coeff_path=first_coeff_path, crop_pic_path=crop_pic_path, crop_info=crop_info,
+                   ref_video_coeff_path=ref_video_coeff_path, ref_pose_coeff_path=ref_pose_coeff_path,
+                   ref_eyeblink_coeff_path=ref_eyeblink_coeff_path)
+        return job
+
+    def audio_stage(self, job):
+        """ audio to coefficients and the face render batch """
+        audio_to_coeff = job['models']['audio_to_coeff']
+        use_ref_video, ref_info, still_mode = job['use_ref_video'], job['ref_info'], job['still_mode']
+        save_dir, audio_path, first_coeff_path = job['save_dir'], job['audio_path'], job['first_coeff_path']
+
         #audio2ceoff
         if use_ref_video and ref_info == 'all':
-            coeff_path = ref_video_coeff_path # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            coeff_path = job['ref_video_coeff_path'] # audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
         else:
-            batch = get_data(first_coeff_path, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff_path, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
-            coeff_path = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            batch = get_data(first_coeff_path, audio_path, self.device, ref_eyeblink_coeff_path=job['ref_eyeblink_coeff_path'], still=still_mode, idlemode=job['use_idle_mode'], length_of_audio=job['length_of_audio'], use_blink=job['use_blink']) # longer audio?
+            coeff_path = audio_to_coeff.generate(batch, save_dir, job['pose_style'], job['ref_pose_coeff_path'])
 
         #coeff2video
-        data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
-        return_path = self.animate_from_coeff.generate(data, save_dir,  pic_path, crop_info, enhancer='gfpgan' if use_enhancer else None, preprocess=preprocess, img_size=size)
-        video_name = data['video_name']
-        print(f'The generated video is named {video_name} in {save_dir}')
+        job['data'] = get_facerender_data(coeff_path, job['crop_pic_path'], first_coeff_path, audio_path, job['batch_size'], still_mode=still_mode, preprocess=job['preprocess'], size=job['size'], expression_scale = job['exp_scale'])
+        return job
 
-        del self.preprocess_model
-        del self.audio_to_coeff
-        del self.animate_from_coeff
+    def render_stage(self, job):
+        """ the face render frames, produced while the encode stage reads them """
+        animate_from_coeff = job['models']['animate_from_coeff']
+        job['frames'] = animate_from_coeff.render_frames(job['data'], job['crop_info'], img_size=job['size'], precision=job['precision'])
+        return job
 
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            
-        import gc; gc.collect()
-        
-        return return_path
+    def encode_stage(self, job):
+        """ paste back, enhancer and the video """
+        animate_from_coeff = job['models']['animate_from_coeff']
+        save_dir, data = job['save_dir'], job['data']
+        job['return_path'] = animate_from_coeff.encode_video(job['frames'], data, save_dir, job['pic_path'], job['crop_info'],
+                                                             enhancer='gfpgan' if job['use_enhancer'] else None, preprocess=job['preprocess'])
+        video_name = data['video_name']
+        print(f'The generated video is named {video_name} in {save_dir}')
+        return job
 
     
\ No newline at end of file
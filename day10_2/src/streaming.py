@@ -0,0 +1,210 @@
+""" Streaming talking head: PCM audio in, rendered frames out, while the audio is still arriving.
+
+    talker = StreamingTalker(audio_to_coeff, animate_from_coeff, first_coeff_path, crop_pic_path, crop_info)
+    for pcm in tts_chunks:
+        for frame in talker.push(pcm):      # 16 kHz mono, float in [-1, 1] or int16
+            show(frame)
+    for frame in talker.finish():
+        show(frame)
+
+The frames come out in order, frame i covering the audio [640 i, 640 (i+1)). A frame is rendered
+as soon as everything it depends on is known, which bounds its lookahead, the audio that has to
+arrive after its own before it can be emitted, to `StreamingTalker.lookahead` frames of 40 ms:
+
+    mel windows       4   the 16 mel frames of frame i reach 3 frames past it, plus one frame of
+                          margin for the samples get_data cuts off at the end of the audio
+    pose              pose_window - 1 + 6
+                          a pose window is predicted once its last frame is known, the savgol
+                          smoothing then needs the 6 poses after a frame; none in still mode
+    semantic_radius  13   the mapping net reads the coefficients of the 13 frames after a frame
+
+that is 17 frames (680 ms) in still mode and pose_window + 22 frames otherwise, 30 frames (1.2 s)
+with the default pose_window of 8, 54 frames with the 32 frame windows of the offline path. The
+compute time on top of it is measured by the harness:
+
+    python -m src.streaming --source_image face.png --driven_audio speech.wav --increment_ms 40
+
+which feeds the audio in real time and reports the glass-to-glass latency, from the moment the
+audio of a frame arrived to the moment its frame was out.
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+import torch
+
+from src.generate_batch import StreamingAudio
+from src.generate_facerender_batch import FacerenderChunks
+from src.test_audio2coeff import CoeffStream
+from src.facerender.modules.make_animation import autocast, driving_keypoints, prepare_source
+from src.utils.paste_pic import PasteBack
+
+
+class StreamingTalker():
+    """
+    push() takes the next piece of the audio and returns the frames (uint8 RGB) that became ready,
+    finish() ends the audio and returns the rest. pose_window trades the pose network context for
+    latency, see CoeffStream. The face enhancer is not run on the stream.
+    """
+
+    def __init__(self, audio_to_coeff, animate_from_coeff, first_coeff_path, pic_path, crop_pic_path, crop_info,
+                 pose_style=0, pose_window=8, ref_eyeblink_coeff_path=None, ref_pose_coeff_path=None,
+                 still_mode=False, expression_scale=1.0, use_blink=True, preprocess='crop', size=256,
+                 render_batch=4, precision='fp32', paste_blend='feather'):
+        self.device = animate_from_coeff.device
+        self.render_batch = render_batch
+        self.precision = precision
+
+        self.audio = StreamingAudio(first_coeff_path, audio_to_coeff.device, ref_eyeblink_coeff_path, use_blink)
+        self.coeffs = CoeffStream(audio_to_coeff, self.audio, pose_style, ref_pose_coeff_path, pose_window, still_mode)
+        self.facerender = FacerenderChunks(None, None, 'stream', crop_pic_path, first_coeff_path, None, 1,
+                                           expression_scale=expression_scale, still_mode=still_mode,
+                                           preprocess=preprocess, size=size)
+        pose_lookahead = 0 if still_mode else self.coeffs.pose_window - 1 + 6
+        self.lookahead = 4 + pose_lookahead + self.facerender.semantic_radius
+
+        self.generator, kp_detector, self.mapping = animate_from_coeff.facerender_models(precision)
+        self.source_feature, self.kp_canonical, self.kp_source = prepare_source(
+            self.facerender.source_image.to(self.device), self.facerender.source_semantics_ts.to(self.device),
+            self.generator, kp_detector, self.mapping, precision)
+
+        # same output geometry as AnimateFromCoeff.encode_video, without the enhancer
+        original_size = crop_info[0]
+        self.out_size = (size, int(size * original_size[1]/original_size[0])) if original_size else None
+        self.paste_back = None
+        if 'full' in preprocess.lower():
+            self.paste_back = PasteBack(pic_path, crop_info, extended_crop='ext' in preprocess.lower(), blend=paste_blend)
+
+    def push(self, pcm):
+        self.audio.push(pcm)
+        return self.step(final=False)
+
+    def finish(self):
+        self.audio.finish()
+        return self.step(final=True)
+
+    def step(self, final):
+        coeffs = self.coeffs.advance(len(self.audio), final)
+        self.audio.trim(self.coeffs.oldest_frame)
+        data = self.facerender.add(coeffs, final)
+        if data is None:
+            return []
+        return self.render(data['target_semantics_list'][0:1].to(self.device))
+
+    def render(self, target_semantics):
+        """ the frames of target_semantics (1, n, 70, 27) """
+        frames = []
+        with torch.no_grad():
+            kp_driving = driving_keypoints(self.kp_canonical, target_semantics, self.mapping,
+                                           precision=self.precision)[0]          # n num_kp 3
+            for start in range(0, kp_driving.shape[0], self.render_batch):
+                kp = kp_driving[start:start + self.render_batch]
+                n = kp.shape[0]
+                with autocast(self.device, self.precision):
+                    out = self.generator.forward_with_feature(
+                        self.source_feature.expand((n,) + self.source_feature.shape[1:]),
+                        kp_source={'value': self.kp_source['value'].expand((n,) + self.kp_source['value'].shape[1:])},
+                        kp_driving={'value': kp})
+                # to uint8 on device, same rounding as img_as_ubyte
+                predictions = (out['prediction'].float().clamp(0, 1) * 255).round().to(torch.uint8)
+                for image in predictions.permute(0, 2, 3, 1).cpu().numpy():
+                    if self.out_size is not None:
+                        image = cv2.resize(image, self.out_size)
+                    frames.append(self.paste_back(image) if self.paste_back is not None else image)
+        return frames
+
+
+def main(args):
+    import src.utils.audio as audio
+    from src.utils.preprocess import CropAndExtract
+    from src.test_audio2coeff import Audio2Coeff
+    from src.facerender.animate import AnimateFromCoeff
+    from src.utils.init_path import init_path
+    from src.utils.videoio import VideoWriter
+
+    config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+    sadtalker_paths = init_path(args.checkpoint_dir, config_dir, args.size, args.old_version, args.preprocess)
+    preprocess_model = CropAndExtract(sadtalker_paths, args.device)
+    audio_to_coeff = Audio2Coeff(sadtalker_paths, args.device)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, args.device)
+
+    first_frame_dir = os.path.join(args.result_dir, 'first_frame_dir')
+    os.makedirs(first_frame_dir, exist_ok=True)
+    first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(args.source_image, first_frame_dir, args.preprocess,
+                                                                           source_image_flag=True, pic_size=args.size)
+    if first_coeff_path is None:
+        print("Can't get the coeffs of the input")
+        return
+
+    talker = StreamingTalker(audio_to_coeff, animate_from_coeff, first_coeff_path, args.source_image, crop_pic_path, crop_info,
+                             pose_style=args.pose_style, pose_window=args.pose_window, still_mode=args.still,
+                             expression_scale=args.expression_scale, preprocess=args.preprocess, size=args.size,
+                             render_batch=args.render_batch, precision=args.precision)
+
+    wav = audio.load_wav(args.driven_audio, 16000)
+    increment = int(16000 * args.increment_ms / 1000)
+    num_frames = len(wav) // 640
+    arrival = np.zeros(num_frames)      # when the audio of a frame was complete
+    emitted = np.zeros(num_frames)      # when its frame was out
+    frames = []
+
+    def emit(new_frames):
+        now = time.monotonic()
+        emitted[len(frames):len(frames) + len(new_frames)] = now
+        frames.extend(new_frames)
+
+    start = time.monotonic()
+    for offset in range(0, len(wav), increment):
+        if args.realtime:
+            # the audio of this increment is only complete once it was spoken
+            time.sleep(max(0., start + (offset + increment) / 16000 - time.monotonic()))
+        pushed = min(offset + increment, len(wav))
+        now = time.monotonic()
+        arrival[offset // 640:min(pushed // 640, num_frames)] = now
+        emit(talker.push(wav[offset:pushed]))
+    emit(talker.finish())
+    total = time.monotonic() - start
+
+    latency = (emitted - arrival) * 1000
+    print('frames: %d in %.2fs (%.1f fps), audio %.2fs' % (len(frames), total, len(frames) / total, len(wav) / 16000))
+    print('lookahead bound: %d frames (%d ms)' % (talker.lookahead, talker.lookahead * 40))
+    print('glass-to-glass latency: p50 %.0f ms, p95 %.0f ms, max %.0f ms' % (
+        np.percentile(latency, 50), np.percentile(latency, 95), latency.max()))
+
+    if args.output is not None:
+        with VideoWriter(args.output, fps=25, audio_path=args.driven_audio) as writer:
+            for frame in frames:
+                writer.write(frame)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--driven_audio", default='./examples/driven_audio/bus_chinese.wav', help="path to driven audio")
+    parser.add_argument("--source_image", default='./examples/source_image/full_body_1.png', help="path to source image")
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--result_dir", default='./results/streaming', help="where the preprocessed source image goes")
+    parser.add_argument("--output", default=None, help="write the streamed frames to this video as well")
+    parser.add_argument("--increment_ms", type=int, default=40, help="size of the audio pieces pushed")
+    parser.add_argument("--no_realtime", dest="realtime", action="store_false", help="push the audio as fast as possible instead of in real time")
+    parser.add_argument("--pose_style", type=int, default=0, help="input pose style from [0, 46)")
+    parser.add_argument("--pose_window", type=int, default=8, help="frames per pose prediction, up to 32; shorter windows lower the latency")
+    parser.add_argument("--render_batch", type=int, default=4, help="frames per generator pass")
+    parser.add_argument("--size", type=int, default=256, help="the image size of the facerender")
+    parser.add_argument("--expression_scale", type=float, default=1.)
+    parser.add_argument("--still", action="store_true", help="keep the source pose, lowest latency")
+    parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images")
+    parser.add_argument("--precision", default='fp32', choices=['fp32', 'fp16', 'bf16', 'half'], help="precision of the face renderer")
+    parser.add_argument("--old_version", action="store_true", help="use the pth other than safetensor version")
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+
+    args = parser.parse_args()
+
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
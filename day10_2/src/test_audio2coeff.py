@@ -1,17 +1,16 @@
 import os 
 import torch
 import numpy as np
-from scipy.io import savemat, loadmat
+from scipy.io import savemat
 from yacs.config import CfgNode as CN
 from scipy.signal import savgol_filter
 
-import safetensors
-import safetensors.torch 
-
 from src.audio2pose_models.audio2pose import Audio2Pose
 from src.audio2exp_models.networks import SimpleWrapperV2 
 from src.audio2exp_models.audio2exp import Audio2Exp
-from src.utils.safetensor_helper import load_x_from_safetensor  
+from src.utils.safetensor_helper import load_safetensor, load_x_from_safetensor
+from src.utils.motion_templates import load_ref_coeff
+from src.utils.onnx_helper import OnnxModule, OnnxCVAE
 
 def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
     checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
@@ -24,7 +23,7 @@ def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
 
 class Audio2Coeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, onnx_dir=None, onnx_threads=None):
         #load config
         fcfg_pose = open(sadtalker_path['audio2pose_yaml_path'])
         cfg_pose = CN.load_cfg(fcfg_pose)
@@ -33,16 +32,31 @@ class Audio2Coeff():
         cfg_exp = CN.load_cfg(fcfg_exp)
         cfg_exp.freeze()
 
+        if onnx_dir is not None:
+            # onnxruntime backend, see src/utils/onnx_helper.py, the torch audio encoder and CVAE are not built
+            audio_encoder = OnnxModule(os.path.join(onnx_dir, 'audio2pose_encoder.onnx'), device, onnx_threads)
+            netG = OnnxCVAE(OnnxModule(os.path.join(onnx_dir, 'audio2pose_decoder.onnx'), device, onnx_threads))
+            self.audio2pose_model = Audio2Pose(cfg_pose, None, device=device, audio_encoder=audio_encoder, netG=netG)
+            self.audio2pose_model.eval()
+            netG = OnnxModule(os.path.join(onnx_dir, 'audio2exp.onnx'), device, onnx_threads)
+            self.audio2exp_model = Audio2Exp(netG, cfg_exp, device=device, prepare_training_loss=False)
+            self.audio2exp_model.eval()
+            self.device = device
+            return
+
         # load audio2pose_model
         self.audio2pose_model = Audio2Pose(cfg_pose, None, device=device)
         self.audio2pose_model = self.audio2pose_model.to(device)
         self.audio2pose_model.eval()
         for param in self.audio2pose_model.parameters():
             param.requires_grad = False 
-        
+
+        if sadtalker_path['use_safetensor']:
+            # one shared mmap for both audio2pose and audio2exp
+            checkpoints = load_safetensor(sadtalker_path['checkpoint'])
+
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
                 self.audio2pose_model.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2pose'))
             else:
                 load_cpk(sadtalker_path['audio2pose_checkpoint'], model=self.audio2pose_model, device=device)
@@ -57,7 +71,6 @@ class Audio2Coeff():
         netG.eval()
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
                 netG.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2exp'))
             else:
                 load_cpk(sadtalker_path['audio2exp_checkpoint'], model=netG, device=device)
@@ -84,13 +97,7 @@ class Audio2Coeff():
             batch['class'] = torch.LongTensor([pose_style]).to(self.device)
             results_dict_pose = self.audio2pose_model.test(batch) 
             pose_pred = results_dict_pose['pose_pred']                        #bs T 6
-
-            pose_len = pose_pred.shape[1]
-            if pose_len<13: 
-                pose_len = int((pose_len-1)/2)*2+1
-                pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), pose_len, 2, axis=1)).to(self.device)
-            else:
-                pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)).to(self.device) 
+            pose_pred = self.smooth_pose(pose_pred)
             
             coeffs_pred = torch.cat((exp_pred, pose_pred), dim=-1)            #bs T 70
 
@@ -104,20 +111,180 @@ class Audio2Coeff():
 
             return os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name']))
     
-    def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff_path):
+    def smooth_pose(self, pose_pred):
+        pose_len = pose_pred.shape[1]
+        if pose_len<13: 
+            pose_len = int((pose_len-1)/2)*2+1
+            pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), pose_len, 2, axis=1)).to(self.device)
+        else:
+            pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)).to(self.device) 
+        return pose_pred
+
+    def generate_styles(self, batch, coeff_save_dir, pose_styles, ref_pose_coeff_path=None):
+        """
+        generate() for several pose styles of the same audio, returns one coefficient path per style.
+        The expression is predicted once and Audio2Pose runs the styles as its batch, the audio
+        encoded once for all of them.
+        """
+        with torch.no_grad():
+            exp_pred = self.audio2exp_model.test(batch)['exp_coeff_pred']     #1 T 64
+
+            batch['class'] = torch.LongTensor(pose_styles).to(self.device)
+            pose_pred = self.audio2pose_model.test(batch)['pose_pred']        #styles T 6
+            pose_pred = self.smooth_pose(pose_pred)
+
+            coeff_paths = []
+            for pose_style, pose in zip(pose_styles, pose_pred):
+                coeffs_pred_numpy = torch.cat((exp_pred[0], pose), dim=-1).cpu().numpy()   #T 70
+                if ref_pose_coeff_path is not None:
+                    coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
+
+                coeff_path = os.path.join(coeff_save_dir, '%s##%s_style%d.mat'%(batch['pic_name'], batch['audio_name'], pose_style))
+                savemat(coeff_path, {'coeff_3dmm': coeffs_pred_numpy})
+                coeff_paths.append(coeff_path)
+            return coeff_paths
+
+    def generate_chunks(self, audio_chunks, coeff_save_dir, pose_style, ref_pose_coeff_path=None, chunk_size=250):
+        """
+        generate() for long audio, audio_chunks is a src.generate_batch.AudioChunks. Yields the
+        coefficients (n, 70) of consecutive frames about chunk_size frames at a time and saves the
+        whole track like generate() once the last chunk is out.
+        """
+        num_frames = len(audio_chunks)
+        stream = CoeffStream(self, audio_chunks, pose_style, ref_pose_coeff_path)
+        coeffs = []
+        for stop in range(chunk_size, num_frames + chunk_size, chunk_size):
+            stop = min(stop, num_frames)
+            coeffs_pred_numpy = stream.advance(stop, final=stop == num_frames)
+            if len(coeffs_pred_numpy):
+                coeffs.append(coeffs_pred_numpy)
+                yield coeffs_pred_numpy
+
+        savemat(os.path.join(coeff_save_dir, '%s##%s.mat'%(audio_chunks.pic_name, audio_chunks.audio_name)),
+                {'coeff_3dmm': np.concatenate(coeffs)})
+
+    def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff_path, start=0):
         num_frames = coeffs_pred_numpy.shape[0]
-        refpose_coeff_dict = loadmat(ref_pose_coeff_path)
-        refpose_coeff = refpose_coeff_dict['coeff_3dmm'][:,64:70]
-        refpose_num_frames = refpose_coeff.shape[0]
-        if refpose_num_frames<num_frames:
-            div = num_frames//refpose_num_frames
-            re = num_frames%refpose_num_frames
-            refpose_coeff_list = [refpose_coeff for i in range(div)]
-            refpose_coeff_list.append(refpose_coeff[:re, :])
-            refpose_coeff = np.concatenate(refpose_coeff_list, axis=0)
+        # a .mat path or the coeff_3dmm array already loaded from it
+        refpose = load_ref_coeff(ref_pose_coeff_path)[:, 64:70]
+        # frames [start, start + num_frames) of the looped reference track
+        refpose_coeff = refpose[np.arange(start, start + num_frames) % refpose.shape[0]]
 
         #### relative head pose
-        coeffs_pred_numpy[:, 64:70] = coeffs_pred_numpy[:, 64:70] + ( refpose_coeff[:num_frames, :] - refpose_coeff[0:1, :] )
+        coeffs_pred_numpy[:, 64:70] = coeffs_pred_numpy[:, 64:70] + ( refpose_coeff - refpose[0:1, :] )
         return coeffs_pred_numpy
 
 
+class CoeffStream():
+    """
+    The coefficient track of Audio2Coeff.generate() over audio whose frames become known a range at a
+    time. advance(stop) takes the frames up to stop of audio_chunks (an AudioChunks or StreamingAudio)
+    and returns the coefficients (n, 70) of the frames that became final, possibly none.
+
+    The expression runs on the frames as they come and the pose on the same seq_len windows as in
+    generate(), drawing the CVAE latents in the same order; the pose smoothing holds back its last
+    6 frames until the next frames arrived. With the default pose_window this gives the track
+    generate() returns, up to float rounding: the expression batches are sized differently.
+
+    A shorter pose_window predicts windows of that many frames, each from the seq_len mel windows
+    ending with it, so that a pose is known pose_window - 1 frames after its audio instead of
+    seq_len - 1. In still_mode the source pose is kept and nothing is held back, like the facerender
+    does with it.
+    """
+
+    def __init__(self, audio_to_coeff, audio_chunks, pose_style, ref_pose_coeff_path=None, pose_window=None, still_mode=False,
+                 window_batch=8):
+        self.audio_to_coeff = audio_to_coeff
+        self.audio_chunks = audio_chunks
+        # the reference pose track is read once, not for every emitted range
+        self.ref_pose_coeff = load_ref_coeff(ref_pose_coeff_path) if ref_pose_coeff_path is not None else None
+        self.still_mode = still_mode
+        self.seq_len = audio_to_coeff.audio2pose_model.seq_len
+        self.pose_window = min(pose_window or self.seq_len, self.seq_len)
+        self.window_batch = window_batch
+
+        device = audio_to_coeff.device
+        ref = torch.FloatTensor(audio_chunks.source_coeff[:, -6:]).to(device)     # bs 6
+        self.source_pose = ref.unsqueeze(1)                                       # bs 1 6
+        self.pose_batch = {'ref': ref, 'class': torch.LongTensor([pose_style]).to(device)}
+
+        self.exp_pred = np.zeros((0, 64), dtype=np.float32)
+        self.pose_pred = self.source_pose[0].cpu().numpy()                        # 1 6
+        self.offset = 0         # frame of exp_pred[0] and pose_pred[0]
+        self.pose_stop = 1      # the first frame is the reference, its pose motion is zero
+        self.emitted = 0
+
+    @property
+    def exp_stop(self):
+        return self.offset + self.exp_pred.shape[0]
+
+    @property
+    def oldest_frame(self):
+        """ the first frame whose mel windows advance() may still ask for """
+        if self.still_mode:
+            return self.exp_stop
+        # the remainder window reaches seq_len frames back from the end of the audio
+        return min(self.exp_stop, self.pose_stop + self.pose_window - self.seq_len,
+                   len(self.audio_chunks) - self.seq_len)
+
+    def predict_pose(self, stop, final):
+        windows = []        # (mel windows, predicted frames)
+        # whole windows, then the remainder on the last seq_len frames like Audio2Pose.test
+        while self.pose_stop + self.pose_window <= stop:
+            window_stop = self.pose_stop + self.pose_window
+            windows.append((max(1, window_stop - self.seq_len), window_stop, self.pose_window))
+            self.pose_stop = window_stop
+        if final and self.pose_stop < stop:
+            windows.append((max(1, stop - self.seq_len), stop, stop - self.pose_stop))
+            self.pose_stop = stop
+        if not windows:
+            return
+
+        poses = []
+        # window_batch windows per pass bounds the memory of the audio encoder, like Audio2Pose.test
+        for i in range(0, len(windows), self.window_batch):
+            group = windows[i:i + self.window_batch]
+            mels = [self.audio_chunks.batch(start, window_stop)['indiv_mels'] for start, window_stop, _ in group]
+            pose_motion = self.audio_to_coeff.audio2pose_model.test_windows(self.pose_batch, mels)   # n bs seq_len 6
+            poses.extend(motion[:, -n:] for motion, (_, _, n) in zip(pose_motion, group))
+        pose = self.source_pose + torch.cat(poses, dim=1)                         # bs n 6
+        self.pose_pred = np.concatenate([self.pose_pred, pose[0].cpu().numpy()])
+
+    def advance(self, stop, final=False):
+        """ the frames before stop are known, final when stop is the end of the audio """
+        with torch.no_grad():
+            if stop > self.exp_stop:
+                batch = self.audio_chunks.batch(self.exp_stop, stop)
+                exp = self.audio_to_coeff.audio2exp_model.test(batch)['exp_coeff_pred']  # bs n 64
+                self.exp_pred = np.concatenate([self.exp_pred, exp[0].cpu().numpy()])
+
+            if self.still_mode:
+                return self.emit(self.exp_stop, np.repeat(self.pose_pred[:1], self.exp_stop - self.emitted, axis=0), 1)
+
+            self.predict_pose(stop, final)
+
+        # savgol_filter as in generate(), a frame is final once the 6 poses after it are known
+        available = min(self.exp_stop, self.pose_stop)
+        window = 13 if not final or available >= 13 else int((available-1)/2)*2+1
+        emit_stop = available if final else available - window // 2
+        if emit_stop <= self.emitted or available < window:
+            return np.zeros((0, 70), dtype=np.float32)
+
+        # smooth with the context on both sides, the track edges are fitted like in generate()
+        first = max(0, min(self.emitted - window // 2, available - window))
+        pose = savgol_filter(self.pose_pred[first - self.offset:available - self.offset], window, 2, axis=0)
+        return self.emit(emit_stop, pose[self.emitted - first:emit_stop - first], window)
+
+    def emit(self, emit_stop, pose, window):
+        emitted = self.emitted
+        coeffs_pred_numpy = np.concatenate([self.exp_pred[emitted - self.offset:emit_stop - self.offset], pose], axis=1).astype(np.float32)
+        if self.ref_pose_coeff is not None:
+            coeffs_pred_numpy = self.audio_to_coeff.using_refpose(coeffs_pred_numpy, self.ref_pose_coeff, start=emitted)
+
+        # keep the frames the next smoothing window reaches back to
+        keep = max(0, emit_stop - window) - self.offset
+        self.exp_pred, self.offset = self.exp_pred[keep:], self.offset + keep
+        if not self.still_mode:
+            self.pose_pred = self.pose_pred[keep:]
+        self.emitted = emit_stop
+        return coeffs_pred_numpy
@@ -123,6 +123,27 @@ class Preprocesser:
         # Save aligned image.
         return rsize, crop, [lx, ly, rx, ry]
     
+    def get_crop(self, img_np, still=False, xsize=512):
+        """ same crop as `crop`, but returned as a box (x1, y1, x2, y2) in the pixels of img_np,
+        so that the frames can be cropped before they are resized """
+        lm = self.get_landmark(img_np)
+
+        if lm is None:
+            raise 'can not detect the landmark from source image'
+        rsize, crop, quad = self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        clx, cly, crx, cry = crop
+        lx, ly, rx, ry = quad
+        lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+        if still:
+            box = [clx, cly, crx, cry]
+        else:
+            box = [clx+lx, cly+ly, min(clx+rx, crx), min(cly+ry, cry)]
+
+        # crop and quad live in the (possibly shrunk) rsize image
+        sx, sy = img_np.shape[1] / rsize[0], img_np.shape[0] / rsize[1]
+        roi = (int(round(box[0]*sx)), int(round(box[1]*sy)), int(round(box[2]*sx)), int(round(box[3]*sy)))
+        return roi, crop, quad
+
     def crop(self, img_np_list, still=False, xsize=512):    # first frame for all video
         img_np = img_np_list[0]
         lm = self.get_landmark(img_np)
@@ -1,11 +1,15 @@
 import os
+import copy
+import threading
+import numpy as np
 import torch 
 
 from gfpgan import GFPGANer
 
 from tqdm import tqdm
 
-from src.utils.videoio import load_video_to_cv2
+from src.utils.videoio import VideoFrames
+from src.utils.pipeline import background
 
 import cv2
 
@@ -23,31 +27,7 @@ class GeneratorWithLen(object):
     def __iter__(self):
         return self.gen
 
-def enhancer_list(images, method='gfpgan', bg_upsampler='realesrgan'):
-    gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
-    return list(gen)
-
-def enhancer_generator_with_len(images, method='gfpgan', bg_upsampler='realesrgan'):
-    """ Provide a generator with a __len__ method so that it can passed to functions that
-    call len()"""
-
-    if os.path.isfile(images): # handle video to images
-        # TODO: Create a generator version of load_video_to_cv2
-        images = load_video_to_cv2(images)
-
-    gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
-    gen_with_len = GeneratorWithLen(gen, len(images))
-    return gen_with_len
-
-def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'):
-    """ Provide a generator function so that all of the enhanced images don't need
-    to be stored in memory at the same time. This can save tons of RAM compared to
-    the enhancer function. """
-
-    print('face enhancer....')
-    if not isinstance(images, list) and os.path.isfile(images): # handle video to images
-        images = load_video_to_cv2(images)
-
+def init_restorer(method='gfpgan', bg_upsampler='realesrgan'):
     # ------------------------ set up GFPGAN restorer ------------------------
     if  method == 'gfpgan':
         arch = 'clean'
@@ -100,24 +80,158 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
         # download pre-trained models from url
         model_path = url
 
-    restorer = GFPGANer(
+    return GFPGANer(
         model_path=model_path,
         upscale=2,
         arch=arch,
         channel_multiplier=channel_multiplier,
         bg_upsampler=bg_upsampler)
 
+
+_restorers = {}
+_restorers_lock = threading.Lock()
+
+
+def get_restorer(method='gfpgan', bg_upsampler='realesrgan'):
+    """ the restorer is built once per (method, bg_upsampler) and process """
+    key = (method, bg_upsampler)
+    with _restorers_lock:
+        if key not in _restorers:
+            _restorers[key] = init_restorer(method=method, bg_upsampler=bg_upsampler)
+        return _restorers[key]
+
+
+def enhance_image(restorer, image):
+    """ restore a single RGB frame """
+    img = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    # restore faces and background if necessary
+    cropped_faces, restored_faces, r_img = restorer.enhance(
+        img,
+        has_aligned=False,
+        only_center_face=False,
+        paste_back=True)
+
+    return cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
+
+
+class FaceEnhancer():
+    """ Frame stage applying the face enhancer to RGB frames in memory.
+
+    Same steps as GFPGANer.enhance, but the aligned faces of several frames go through the
+    restoration network as one batch, and stream() overlaps face detection, restoration and
+    paste back in worker threads. """
+
+    def __init__(self, method='gfpgan', bg_upsampler='realesrgan', batch_size=8, weight=0.5):
+        print('face enhancer....')
+        self.restorer = get_restorer(method=method, bg_upsampler=bg_upsampler)
+        self.batch_size = batch_size
+        self.weight = weight
+        # detection and paste back keep per-image state, each gets its own helper sharing the models
+        self.detect_helper = copy.copy(self.restorer.face_helper)
+        self.detect_helper.clean_all()
+        self.paste_helper = copy.copy(self.restorer.face_helper)
+        self.paste_helper.clean_all()
+
+    def align(self, image):
+        img = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        helper = self.detect_helper
+        helper.clean_all()
+        helper.read_image(img)
+        helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+        helper.align_warp_face()
+        return img, list(helper.cropped_faces), list(helper.affine_matrices)
+
+    def restore_faces(self, faces):
+        restored = []
+        for start in range(0, len(faces), self.batch_size):
+            batch = np.stack(faces[start:start+self.batch_size])[..., ::-1]      # BGR -> RGB
+            batch = torch.from_numpy(np.ascontiguousarray(batch)).permute(0, 3, 1, 2)
+            batch = (batch.float() / 255. - 0.5) / 0.5
+            try:
+                with torch.no_grad():
+                    output = self.restorer.gfpgan(batch.to(self.restorer.device), return_rgb=False, weight=self.weight)[0]
+                output = ((output.float().clamp(-1, 1) + 1) / 2 * 255.).round()
+                output = output.permute(0, 2, 3, 1).flip(-1).to(torch.uint8).cpu().numpy()
+                restored.extend(output)
+            except RuntimeError as error:
+                print(f'\tFailed inference for GFPGAN: {error}.')
+                restored.extend(faces[start:start+self.batch_size])
+        return restored
+
+    def restore(self, aligned):
+        """ restore the faces of aligned frames in batches, yields (aligned, restored faces) """
+        pending = []
+        for item in aligned:
+            pending.append(item)
+            if sum(len(faces) for _, faces, _ in pending) >= self.batch_size:
+                yield from self._restore_pending(pending)
+                pending = []
+        yield from self._restore_pending(pending)
+
+    def _restore_pending(self, pending):
+        restored = self.restore_faces([face for _, faces, _ in pending for face in faces])
+        for item in pending:
+            n = len(item[1])
+            yield item, restored[:n]
+            restored = restored[n:]
+
+    def paste(self, restored):
+        (img, _, affine_matrices), restored_faces = restored
+        helper = self.paste_helper
+        helper.clean_all()
+        helper.read_image(img)
+        helper.affine_matrices = affine_matrices
+        for face in restored_faces:
+            helper.add_restored_face(face.astype('uint8'))
+
+        # upsample the background
+        if self.restorer.bg_upsampler is not None:
+            bg_img = self.restorer.bg_upsampler.enhance(img, outscale=self.restorer.upscale)[0]
+        else:
+            bg_img = None
+
+        helper.get_inverse_affine(None)
+        r_img = helper.paste_faces_to_input_image(upsample_img=bg_img)
+        return cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
+
+    def map(self, images):
+        return [self.paste(item) for item in self.restore(self.align(image) for image in images)]
+
+    def __call__(self, image):
+        return self.map([image])[0]
+
+    def stream(self, images):
+        """ decode/detect, restore and paste back run in their own threads, frames come out in order """
+        aligned = background(map(self.align, images))
+        restored = background(self.restore(aligned))
+        return background(map(self.paste, restored))
+
+
+def enhancer_list(images, method='gfpgan', bg_upsampler='realesrgan'):
+    gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
+    return list(gen)
+
+def enhancer_generator_with_len(images, method='gfpgan', bg_upsampler='realesrgan'):
+    """ Provide a generator with a __len__ method so that it can passed to functions that
+    call len()"""
+
+    if isinstance(images, str) and os.path.isfile(images): # handle video to images
+        images = VideoFrames(images)
+
+    gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
+    gen_with_len = GeneratorWithLen(gen, len(images))
+    return gen_with_len
+
+def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'):
+    """ Provide a generator function so that all of the enhanced images don't need
+    to be stored in memory at the same time. This can save tons of RAM compared to
+    the enhancer function. """
+
+    if isinstance(images, str) and os.path.isfile(images): # handle video to images
+        images = VideoFrames(images)
+
+    enhancer = FaceEnhancer(method=method, bg_upsampler=bg_upsampler)
+
     # ------------------------ restore ------------------------
-    for idx in tqdm(range(len(images)), 'Face Enhancer:'):
-        
-        img = cv2.cvtColor(images[idx], cv2.COLOR_RGB2BGR)
-        
-        # restore faces and background if necessary
-        cropped_faces, restored_faces, r_img = restorer.enhance(
-            img,
-            has_aligned=False,
-            only_center_face=False,
-            paste_back=True)
-        
-        r_img = cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
-        yield r_img
+    yield from enhancer.stream(tqdm(images, 'Face Enhancer:'))
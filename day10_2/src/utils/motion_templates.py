@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+from scipy.io import loadmat
+
+
+def load_ref_coeff(ref):
+    """ ref is a coeff_3dmm array (e.g. a template) or the path of a .mat written by CropAndExtract """
+    if isinstance(ref, np.ndarray):
+        return ref
+    return loadmat(ref)['coeff_3dmm']
+
+
+def loop_coeff(coeff, num_frames):
+    """ loop (or cut) a T x C coefficient track to num_frames """
+    return coeff[np.arange(num_frames) % coeff.shape[0]]
+
+
+class MotionTemplateLibrary():
+    """ Pose and eye blink tracks of reference videos, extracted once and stored in a single npz:
+    `names`, `offsets` (N+1) and `coeffs` (sum of T, 70) holding the exp + pose coefficients. """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.coeffs = np.zeros((0, 70), dtype=np.float32)
+        if os.path.isfile(path):
+            with np.load(path) as data:
+                self.names = [str(name) for name in data['names']]
+                self.offsets = data['offsets']
+                self.coeffs = data['coeffs']
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        i = self.index[name]
+        return self.coeffs[self.offsets[i]:self.offsets[i+1]]
+
+    def add(self, name, coeff):
+        coeff = np.asarray(coeff, dtype=np.float32)[:, :70]
+        if name in self:
+            # replace the existing track
+            i = self.index[name]
+            keep = np.concatenate([self.coeffs[:self.offsets[i]], self.coeffs[self.offsets[i+1]:]])
+            lengths = np.delete(np.diff(self.offsets), i)
+            self.names.pop(i)
+            self.coeffs = keep
+            self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.names.append(name)
+        self.coeffs = np.concatenate([self.coeffs, coeff])
+        self.offsets = np.append(self.offsets, self.coeffs.shape[0]).astype(np.int64)
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def save(self):
+        save_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(save_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=save_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, names=np.array(self.names, dtype=str), offsets=self.offsets, coeffs=self.coeffs)
+        os.replace(tmp_path, self.path)
+
+
+def main(args):
+    from src.utils.preprocess import CropAndExtract
+    from src.utils.init_path import init_path
+
+    config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config')
+    sadtalker_paths = init_path(args.checkpoint_dir, config_dir, 256, args.old_version, args.preprocess)
+    preprocess_model = CropAndExtract(sadtalker_paths, args.device)
+
+    library = MotionTemplateLibrary(args.library)
+    names = args.names or [os.path.splitext(os.path.split(video)[-1])[0] for video in args.videos]
+    assert len(names) == len(args.videos), 'one name is needed for each video'
+
+    for name, video in zip(names, args.videos):
+        print('3DMM Extraction for the motion template', name)
+        save_dir = tempfile.mkdtemp()
+        try:
+            coeff_path, _, _ = preprocess_model.generate(video, save_dir, args.preprocess, source_image_flag=False)
+            if coeff_path is None:
+                print("Can't get the coeffs of", video)
+                continue
+            library.add(name, loadmat(coeff_path)['coeff_3dmm'])
+        finally:
+            shutil.rmtree(save_dir, ignore_errors=True)
+
+    library.save()
+    print('%d motion templates in %s' % (len(library), args.library))
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("videos", nargs='+', help="reference videos providing pose and eye blinking")
+    parser.add_argument("--names", nargs='+', default=None, help="template names, the video names by default")
+    parser.add_argument("--library", default='./checkpoints/motion_templates.npz', help="path to the template library")
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the videos")
+    parser.add_argument("--old_version", action="store_true", help="use the pth other than safetensor version")
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+
+    args = parser.parse_args()
+
+    import torch
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
@@ -0,0 +1,173 @@
+""" ONNX export of the SadTalker networks and the onnxruntime modules that replace them.
+
+    python -m src.utils.onnx_helper --size 256 --preprocess crop --onnx_dir ./checkpoints/onnx
+
+writes one folder per (size, crop/full) configuration, see onnx_model_dir(). Export and inference
+need the optional dependencies: pip install -r requirements_onnx.txt
+"""
+import os
+import importlib.util
+from argparse import ArgumentParser
+
+import torch
+from torch import nn
+
+from src.facerender.compiled import _EncodeSource, _RenderFrame, _KPDetector, _Mapping
+
+
+def onnx_model_dir(onnx_dir, size, preprocess):
+    # the 256/512 checkpoints and the crop/full mapping nets differ
+    return os.path.join(onnx_dir, '%d_%s' % (int(size), 'full' if 'full' in preprocess.lower() else 'crop'))
+
+
+class OnnxModule(nn.Module):
+    """ onnxruntime session called like the torch module it was exported from, tensors in and out """
+
+    def __init__(self, path, device='cpu', num_threads=None):
+        super(OnnxModule, self).__init__()
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('the onnx backend needs onnxruntime, pip install -r requirements_onnx.txt')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        if 'cuda' in str(device):
+            providers = ['CUDAExecutionProvider'] + providers
+        self.session = onnxruntime.InferenceSession(path, options, providers=providers)
+        self.input_names = [x.name for x in self.session.get_inputs()]
+
+    def forward(self, *inputs):
+        device = inputs[0].device
+        feeds = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(out).to(device) for out in self.session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class _AudioEncoder(nn.Module):
+    def __init__(self, audio_encoder):
+        super(_AudioEncoder, self).__init__()
+        self.audio_encoder = audio_encoder.audio_encoder
+
+    def forward(self, audio_sequences):
+        # (B, T, 1, 80, 16) -> (B, T, 512), frames of all windows in one batch
+        bs, num_frames = audio_sequences.shape[:2]
+        audio_embedding = self.audio_encoder(audio_sequences.reshape((-1,) + audio_sequences.shape[2:]))
+        return audio_embedding.reshape(bs, num_frames, -1)
+
+
+class _PoseDecoder(nn.Module):
+    def __init__(self, decoder):
+        super(_PoseDecoder, self).__init__()
+        self.decoder = decoder
+
+    def forward(self, z, class_id, ref, audio_emb):
+        batch = {'z': z, 'class': class_id, 'ref': ref, 'audio_emb': audio_emb}
+        return self.decoder(batch)['pose_motion_pred']
+
+
+class OnnxCVAE(nn.Module):
+    """ the CVAE.test interface of Audio2Pose on top of the exported decoder """
+
+    def __init__(self, decoder):
+        super(OnnxCVAE, self).__init__()
+        self.decoder = decoder
+
+    def test(self, batch):
+        class_id = batch['class'].reshape(-1).expand(batch['z'].shape[0])
+        batch['pose_motion_pred'] = self.decoder(batch['z'], class_id, batch['ref'], batch['audio_emb'])
+        return batch
+
+
+def onnx_specs(preprocess_model, audio_to_coeff, animate_from_coeff, size):
+    """ name -> (module, example inputs, input names, output names, dynamic axes) """
+    device = animate_from_coeff.device
+    audio2pose = audio_to_coeff.audio2pose_model
+    seq_len, latent_dim = audio2pose.seq_len, audio2pose.latent_dim
+    feature_3d = animate_from_coeff.generator.encode_source(torch.zeros(2, 3, size, size, device=device))
+    # 70 coefficients for crop/resize, 73 with the crop parameters of full/extfull
+    coeff_nc = animate_from_coeff.mapping.first[0].in_channels
+    batch = {0: 'batch'}
+
+    return {
+        'net_recon': (preprocess_model.net_recon, (torch.zeros(2, 3, 224, 224),),
+                      ['image'], ['coeffs'], {'image': batch, 'coeffs': batch}),
+        'audio2exp': (audio_to_coeff.audio2exp_model.netG,
+                      (torch.zeros(20, 1, 80, 16), torch.zeros(2, 10, 64), torch.zeros(2, 10)),
+                      ['mel', 'ref', 'ratio'], ['exp'],
+                      {'mel': {0: 'frames'}, 'ref': {0: 'batch', 1: 'time'}, 'ratio': {0: 'batch', 1: 'time'},
+                       'exp': {0: 'batch', 1: 'time'}}),
+        'audio2pose_encoder': (_AudioEncoder(audio2pose.audio_encoder), (torch.zeros(2, seq_len, 1, 80, 16),),
+                               ['mel'], ['audio_emb'],
+                               {'mel': {0: 'batch', 1: 'time'}, 'audio_emb': {0: 'batch', 1: 'time'}}),
+        'audio2pose_decoder': (_PoseDecoder(audio2pose.netG.decoder),
+                               (torch.zeros(2, latent_dim), torch.zeros(2, dtype=torch.long),
+                                torch.zeros(2, 6), torch.zeros(2, seq_len, 512)),
+                               ['z', 'class', 'ref', 'audio_emb'], ['pose_motion_pred'],
+                               {'z': batch, 'class': batch, 'ref': batch, 'audio_emb': batch, 'pose_motion_pred': batch}),
+        'mapping': (_Mapping(animate_from_coeff.mapping), (torch.zeros(2, coeff_nc, 27),),
+                    ['semantics'], list(_Mapping.keys), {name: batch for name in ('semantics',) + _Mapping.keys}),
+        'kp_detector': (_KPDetector(animate_from_coeff.kp_extractor), (torch.zeros(2, 3, size, size),),
+                        ['image'], ['kp'], {'image': batch, 'kp': batch}),
+        'encode_source': (_EncodeSource(animate_from_coeff.generator), (torch.zeros(2, 3, size, size),),
+                          ['image'], ['feature_3d'], {'image': batch, 'feature_3d': batch}),
+        'render_frame': (_RenderFrame(animate_from_coeff.generator),
+                         (feature_3d.cpu(), torch.zeros(2, 15, 3), torch.zeros(2, 15, 3)),
+                         ['feature_3d', 'kp_driving', 'kp_source'], ['prediction'],
+                         {'feature_3d': batch, 'kp_driving': batch, 'kp_source': batch, 'prediction': batch}),
+    }
+
+
+def export_onnx(preprocess_model, audio_to_coeff, animate_from_coeff, size, onnx_dir, opset=20):
+    if importlib.util.find_spec('onnx') is None:
+        raise ImportError('torch.onnx.export needs onnx, pip install -r requirements_onnx.txt')
+    os.makedirs(onnx_dir, exist_ok=True)
+    device = animate_from_coeff.device
+    with torch.no_grad():
+        specs = onnx_specs(preprocess_model, audio_to_coeff, animate_from_coeff, size)
+    for name, (module, inputs, input_names, output_names, dynamic_axes) in specs.items():
+        path = os.path.join(onnx_dir, name + '.onnx')
+        print('export', path)
+        module.eval()
+        torch.onnx.export(module, tuple(x.to(device) for x in inputs), path, input_names=input_names,
+                          output_names=output_names, dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+
+
+def main(args):
+    from src.utils.preprocess import CropAndExtract
+    from src.test_audio2coeff import Audio2Coeff
+    from src.facerender.animate import AnimateFromCoeff
+    from src.utils.init_path import init_path
+
+    config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config')
+    sadtalker_paths = init_path(args.checkpoint_dir, config_dir, args.size, args.old_version, args.preprocess)
+    preprocess_model = CropAndExtract(sadtalker_paths, args.device)
+    audio_to_coeff = Audio2Coeff(sadtalker_paths, args.device)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, args.device)
+
+    export_onnx(preprocess_model, audio_to_coeff, animate_from_coeff, args.size,
+                onnx_model_dir(args.onnx_dir, args.size, args.preprocess), opset=args.opset)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--onnx_dir", default='./checkpoints/onnx', help="where the onnx models are written")
+    parser.add_argument("--size", type=int, default=256, help="the image size of the facerender")
+    parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="full uses another mapping checkpoint")
+    parser.add_argument("--old_version", action="store_true", help="use the pth other than safetensor version")
+    parser.add_argument("--opset", type=int, default=20, help="GridSample on 5D inputs needs opset 20")
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+
+    args = parser.parse_args()
+
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
@@ -2,66 +2,126 @@ import cv2, os
 import numpy as np
 from tqdm import tqdm
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from src.utils.videoio import save_video_with_watermark 
+from src.utils.videoio import save_video_with_watermark, VideoFrames
 
-def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False):
 
-    if not os.path.isfile(pic_path):
-        raise ValueError('pic_path must be a valid path to video/image file')
-    elif pic_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
-        # loader for first frame
-        full_img = cv2.imread(pic_path)
+def load_full_image(pic_path):
+    # the image itself or the first frame of a video
+    return next(iter(VideoFrames(pic_path, max_frames=1, rgb=False)))
+
+
+def crop_box(crop_info, extended_crop=False):
+    r_w, r_h = crop_info[0]
+    clx, cly, crx, cry = crop_info[1]
+    lx, ly, rx, ry = crop_info[2]
+    lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+    # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+
+    if extended_crop:
+        oy1, oy2, ox1, ox2 = cly, cry, clx, crx
     else:
-        # loader for videos
-        video_stream = cv2.VideoCapture(pic_path)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-        full_frames = [] 
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break 
-            break 
-        full_img = frame
-    frame_h = full_img.shape[0]
-    frame_w = full_img.shape[1]
-
-    video_stream = cv2.VideoCapture(video_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    crop_frames = []
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
-            video_stream.release()
-            break
-        crop_frames.append(frame)
-    
+        oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+    return oy1, oy2, ox1, ox2
+
+
+class PasteBack():
+    """ Frame stage that pastes a generated crop back into the full source image.
+    The source image is loaded once; frames go in and come out in the same color order.
+
+    blend='seamless' runs cv2.seamlessClone on every frame. blend='feather' solves it only for the
+    first frame, keeps its boundary correction and blends the later frames with a feathered alpha. """
+
+    def __init__(self, pic_path, crop_info, extended_crop=False, rgb=True, blend='feather', feather=0.05, workers=4):
+        full_img = load_full_image(pic_path)
+        if rgb:
+            full_img = cv2.cvtColor(full_img, cv2.COLOR_BGR2RGB)
+        self.full_img = full_img
+        self.oy1, self.oy2, self.ox1, self.ox2 = crop_box(crop_info, extended_crop)
+        self.blend = blend
+        self.feather = feather
+        self.workers = workers
+        self.alpha = None
+        self.base = None
+
+    def resize(self, crop_frame):
+        return cv2.resize(crop_frame.astype(np.uint8), (self.ox2-self.ox1, self.oy2 - self.oy1))
+
+    def seamless_clone(self, p):
+        oy1, oy2, ox1, ox2 = self.oy1, self.oy2, self.ox1, self.ox2
+        mask = 255*np.ones(p.shape, p.dtype)
+        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
+        return cv2.seamlessClone(p, self.full_img, mask, location, cv2.NORMAL_CLONE)
+
+    def prepare(self, p):
+        oy1, oy2, ox1, ox2 = self.oy1, self.oy2, self.ox1, self.ox2
+        full_roi = self.full_img[oy1:oy2, ox1:ox2].astype(np.float32)
+        # Poisson correction of the first frame, the background around the face hardly moves
+        correction = self.seamless_clone(p)[oy1:oy2, ox1:ox2].astype(np.float32) - p
+
+        # 1 inside the crop, falling to 0 (the source image) on its border
+        h, w = p.shape[:2]
+        radius = max(1., self.feather * min(h, w))
+        ramp_y = np.minimum(np.arange(h), np.arange(h)[::-1]) / radius
+        ramp_x = np.minimum(np.arange(w), np.arange(w)[::-1]) / radius
+        alpha = np.clip(np.minimum.outer(ramp_y, ramp_x), 0, 1).astype(np.float32)[..., None]
+
+        # out = alpha * (p + correction) + (1 - alpha) * full, with the constant terms folded in
+        self.alpha = alpha
+        self.base = alpha * correction + (1 - alpha) * full_roi + 0.5
+
+    def __call__(self, crop_frame):
+        p = self.resize(crop_frame)
+        if self.blend == 'seamless':
+            return self.seamless_clone(p)
+        if self.base is None:
+            self.prepare(p)
+
+        region = p * self.alpha
+        region += self.base
+        out = self.full_img.copy()
+        out[self.oy1:self.oy2, self.ox1:self.ox2] = np.clip(region, 0, 255).astype(np.uint8)
+        return out
+
+    def map(self, crop_frames):
+        """ paste a batch of frames, in parallel once the first frame has set up the blend """
+        crop_frames = list(crop_frames)
+        if not crop_frames:
+            return []
+        if self.workers <= 1 or self.blend == 'seamless' or len(crop_frames) == 1:
+            return [self(frame) for frame in crop_frames]
+        out = [self(crop_frames[0])]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            out.extend(pool.map(self, crop_frames[1:]))
+        return out
+
+    def stream(self, crop_frames, chunk_size=16):
+        chunk = []
+        for frame in crop_frames:
+            chunk.append(frame)
+            if len(chunk) == chunk_size:
+                yield from self.map(chunk)
+                chunk = []
+        yield from self.map(chunk)
+
+
+def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False, blend='feather'):
+
     if len(crop_info) != 3:
         print("you didn't crop the image")
         return
-    else:
-        r_w, r_h = crop_info[0]
-        clx, cly, crx, cry = crop_info[1]
-        lx, ly, rx, ry = crop_info[2]
-        lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-        # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-        # oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-
-        if extended_crop:
-            oy1, oy2, ox1, ox2 = cly, cry, clx, crx
-        else:
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+
+    paste_back = PasteBack(pic_path, crop_info, extended_crop=extended_crop, rgb=False, blend=blend)
+    frame_h, frame_w = paste_back.full_img.shape[:2]
+
+    crop_frames = VideoFrames(video_path, rgb=False)
+    fps = crop_frames.fps
 
     tmp_path = str(uuid.uuid4())+'.mp4'
     out_tmp = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*'MP4V'), fps, (frame_w, frame_h))
-    for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
-        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
-
-        mask = 255*np.ones(p.shape, p.dtype)
-        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
-        gen_img = cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
-        out_tmp.write(gen_img)
+    for full_frame in paste_back.stream(tqdm(crop_frames, 'paste back:')):
+        out_tmp.write(full_frame)
 
     out_tmp.release()
 
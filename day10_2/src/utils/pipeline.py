@@ -0,0 +1,212 @@
+""" Stage pipelined execution of independent jobs.
+
+Every stage has its own worker threads and a bounded input queue, so that while one job is rendered
+the next ones are preprocessed and the previous one is encoded. A stage function takes the job and
+returns it for the next stage. A generator function hands its first yield to the next stage and keeps
+its worker until it is exhausted, which lets one stage stream into the next (see streaming()).
+"""
+import queue
+import inspect
+import threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+
+class FrameChannel():
+    """ Bounded queue between a producing and a consuming stage; the consumer iterates it,
+    the producer put()s and close()s it, passing the exception if it failed. put() returns
+    False instead of blocking once the consumer stopped, either by leaving its loop or
+    through stop() when it will never read, e.g. because it failed before starting. """
+
+    _end = object()
+
+    def __init__(self, maxsize=64):
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+
+    def _put(self, entry):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def put(self, item):
+        """ False once the consumer stopped reading """
+        return self._put((item, None))
+
+    def close(self, error=None):
+        self._put((self._end, error))
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self.queue.get()
+                if error is not None:
+                    raise error
+                if item is self._end:
+                    return
+                yield item
+        finally:
+            self.stop()
+
+
+def background(iterable, maxsize=16):
+    """ Run an iterator in a worker thread and yield its items, so that the producer
+    and the consumer overlap. The worker stops once the returned generator is closed. """
+    channel = FrameChannel(maxsize)
+
+    def worker():
+        try:
+            for item in iterable:
+                if not channel.put(item):
+                    return
+        except BaseException as e:
+            channel.close(e)
+            return
+        channel.close()
+
+    threading.Thread(target=worker, daemon=True).start()
+    yield from channel
+
+
+def fan_out(rows, consumers, maxsize=64):
+    """
+    Hand element i of every row of rows to consumers[i], which runs in its own thread and reads its
+    items from a FrameChannel; returns the results of the consumers in order. Once a consumer fails
+    the rows stop and its exception is raised, also when it failed before reading anything.
+    """
+    channels = [FrameChannel(maxsize) for _ in consumers]
+    with ThreadPoolExecutor(max_workers=len(consumers)) as pool:
+        futures = [pool.submit(consumer, channel) for consumer, channel in zip(consumers, channels)]
+        for future, channel in zip(futures, channels):
+            # a consumer that is done reads no more, put() must not wait for it
+            future.add_done_callback(lambda _, channel=channel: channel.stop())
+
+        error = None
+        try:
+            for row in rows:
+                if any(future.done() and future.exception() is not None for future in futures):
+                    break
+                for channel, item in zip(channels, row):
+                    channel.put(item)
+        except Exception as e:
+            error = e
+        for channel in channels:
+            channel.close(error)
+        results = [future.result() for future in futures]
+    if error is not None:
+        raise error
+    return results
+
+
+def streaming(fn, key='frames', maxsize=64):
+    """ Stage running the lazy iterable fn(job)[key] in its own worker; the next stage gets the job
+    right away and reads job[key] through a FrameChannel while it is produced. """
+
+    def stage(job):
+        job = fn(job)
+        items, channel = job[key], FrameChannel(maxsize)
+        job[key] = channel
+        yield job
+        try:
+            for item in items:
+                if not channel.put(item):
+                    break
+        except Exception as e:
+            channel.close(e)
+            raise
+        channel.close()
+
+    return stage
+
+
+class Stage():
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+def _stop_channels(job):
+    # nobody is going to read the frames of a failed or dropped job, let their producers go
+    if isinstance(job, dict):
+        for value in job.values():
+            if isinstance(value, FrameChannel):
+                value.stop()
+
+
+def _fail(future, error):
+    # the job may already have failed in a stage further down
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+class StagePipeline():
+    """ submit(job) returns a Future of the job returned by the last stage """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queues = [queue.Queue(queue_size) for _ in stages]
+        self.threads = []
+        for i, stage in enumerate(stages):
+            workers = [threading.Thread(target=self.work, args=(i,), name='%s-%d' % (stage.name, n), daemon=True)
+                       for n in range(stage.workers)]
+            for worker in workers:
+                worker.start()
+            self.threads.append(workers)
+
+    def submit(self, job):
+        future = Future()
+        # blocks while the first stage is backed up
+        self.queues[0].put((job, future))
+        return future
+
+    def forward(self, i, job, future):
+        if i + 1 < len(self.stages):
+            self.queues[i + 1].put((job, future))
+        elif future.set_running_or_notify_cancel():
+            future.set_result(job)
+
+    def work(self, i):
+        stage = self.stages[i]
+        while True:
+            item = self.queues[i].get()
+            if item is None:
+                return
+            job, future = item
+            if future.done():
+                _stop_channels(job)
+                continue
+            try:
+                result = stage.fn(job)
+                if inspect.isgenerator(result):
+                    self.forward(i, next(result), future)
+                    for _ in result:
+                        pass
+                else:
+                    self.forward(i, result, future)
+            except Exception as e:
+                _stop_channels(job)
+                _fail(future, e)
+
+    def close(self):
+        """ finish the submitted jobs and stop the workers """
+        for i, workers in enumerate(self.threads):
+            for _ in workers:
+                self.queues[i].put(None)
+            for worker in workers:
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
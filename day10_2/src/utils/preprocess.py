@@ -1,22 +1,25 @@
 import numpy as np
 import cv2, os, sys, torch
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from tqdm import tqdm
 from PIL import Image 
 
 # 3dmm extraction
-import safetensors
-import safetensors.torch 
 from src.face3d.util.preprocess import align_img
 from src.face3d.util.load_mats import load_lm3d
 from src.face3d.models import networks
 
 from scipy.io import loadmat, savemat
 from src.utils.croper import Preprocesser
+from src.utils.videoio import VideoFrames
+from src.utils.preprocess_cache import PreprocessCache
+from src.utils.onnx_helper import OnnxModule
 
 
 import warnings
 
-from src.utils.safetensor_helper import load_x_from_safetensor 
+from src.utils.safetensor_helper import load_safetensor, load_x_from_safetensor
 warnings.filterwarnings("ignore")
 
 def split_coeff(coeffs):
@@ -44,23 +47,54 @@ def split_coeff(coeffs):
 
 
 class CropAndExtract():
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, recon_batch_size=16, align_workers=4, detect_interval=None,
+                 fan_batch_size=16, cache_dir=None, cache_size_gb=2, onnx_dir=None, onnx_threads=None):
 
         self.propress = Preprocesser(device)
-        self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
-        
-        if sadtalker_path['use_safetensor']:
-            checkpoint = safetensors.torch.load_file(sadtalker_path['checkpoint'])    
-            self.net_recon.load_state_dict(load_x_from_safetensor(checkpoint, 'face_3drecon'))
+        if onnx_dir is not None:
+            # onnxruntime backend, see src/utils/onnx_helper.py
+            self.net_recon = OnnxModule(os.path.join(onnx_dir, 'net_recon.onnx'), device, onnx_threads)
         else:
-            checkpoint = torch.load(sadtalker_path['path_of_net_recon_model'], map_location=torch.device(device))    
-            self.net_recon.load_state_dict(checkpoint['net_recon'])
+            self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
+        
+            if sadtalker_path['use_safetensor']:
+                checkpoint = load_safetensor(sadtalker_path['checkpoint'])
+                self.net_recon.load_state_dict(load_x_from_safetensor(checkpoint, 'face_3drecon'))
+            else:
+                checkpoint = torch.load(sadtalker_path['path_of_net_recon_model'], map_location=torch.device(device))    
+                self.net_recon.load_state_dict(checkpoint['net_recon'])
 
         self.net_recon.eval()
         self.lm3d_std = load_lm3d(sadtalker_path['dir_of_BFM_fitting'])
         self.device = device
+        self.recon_batch_size = recon_batch_size
+        self.align_workers = align_workers
+        # opt-in face tracking of reference videos: the face detector runs every detect_interval frames
+        # and FAN on fan_batch_size tracked crops at a time, see KeypointExtractor.track_keypoints
+        self.detect_interval = detect_interval
+        self.fan_batch_size = fan_batch_size
+        self.cache = PreprocessCache(cache_dir, cache_size_gb) if cache_dir is not None else None
+
+    def align(self, frame, lm1):
+        W,H = frame.size
+        lm1 = lm1.reshape([-1, 2])
+    
+        if np.mean(lm1) == -1:
+            lm1 = (self.lm3d_std[:, :2]+1)/2.
+            lm1 = np.concatenate(
+                [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
+            )
+        else:
+            lm1[:, -1] = H - 1 - lm1[:, -1]
+
+        trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
+
+        trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+        return trans_params, np.array(im1)
     
-    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256):
+    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256,
+                 stride=1, max_duration=None):
+        """ stride and max_duration (seconds) bound the frames of a reference video that are read, see VideoFrames """
 
         pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
 
@@ -71,83 +105,68 @@ class CropAndExtract():
         #load input
         if not os.path.isfile(input_path):
             raise ValueError('input_path must be a valid path to video/image file')
-        elif input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
-            # loader for first frame
-            full_frames = [cv2.imread(input_path)]
-            fps = 25
-        else:
-            # loader for videos
-            video_stream = cv2.VideoCapture(input_path)
-            fps = video_stream.get(cv2.CAP_PROP_FPS)
-            full_frames = [] 
-            while 1:
-                still_reading, frame = video_stream.read()
-                if not still_reading:
-                    video_stream.release()
-                    break 
-                full_frames.append(frame) 
-                if source_image_flag:
-                    break
-
-        x_full_frames= [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  for frame in full_frames] 
+
+        # source images are looked up in the shared preprocess cache first
+        cache_key = None
+        if self.cache is not None and source_image_flag:
+            cache_key = self.cache.key(input_path, crop_or_resize, pic_size)
+            crop_info = self.cache.load(cache_key, coeff_path, png_path, landmarks_path)
+            if crop_info is not None:
+                print(' Using cached preprocess results.')
+                return coeff_path, png_path, crop_info
+
+        first_frame = next(iter(VideoFrames(input_path, max_frames=1)), None)
+        if first_frame is None:
+            print('No face is detected in the input file')
+            return None, None, None
 
         #### crop images as the 
-        if 'crop' in crop_or_resize.lower(): # default crop
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
-            clx, cly, crx, cry = crop
-            lx, ly, rx, ry = quad
-            lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-            crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
-        elif 'full' in crop_or_resize.lower():
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
+        if 'crop' in crop_or_resize.lower() or 'full' in crop_or_resize.lower(): # default crop
+            roi, crop, quad = self.propress.get_crop(first_frame, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
             clx, cly, crx, cry = crop
             lx, ly, rx, ry = quad
             lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
             crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
         else: # resize mode
-            oy1, oy2, ox1, ox2 = 0, x_full_frames[0].shape[0], 0, x_full_frames[0].shape[1] 
+            roi = None
+            oy1, oy2, ox1, ox2 = 0, first_frame.shape[0], 0, first_frame.shape[1] 
             crop_info = ((ox2 - ox1, oy2 - oy1), None, None)
 
-        frames_pil = [Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames]
-        if len(frames_pil) == 0:
-            print('No face is detected in the input file')
-            return None, None
-
-        # save crop info
-        for frame in frames_pil:
-            cv2.imwrite(png_path, cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR))
+        # frames are decoded one by one and cropped to pic_size right away, and go through the
+        # landmarks and the 3DMM extraction one batch at a time
+        frames = VideoFrames(input_path, stride=stride, max_duration=max_duration, max_frames=1 if source_image_flag else None,
+                             roi=roi, size=(pic_size, pic_size))
+        frames_pil = (Image.fromarray(frame) for frame in frames)
 
         # 2. get the landmark according to the detected face. 
-        if not os.path.isfile(landmarks_path): 
-            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path)
+        extract_landmarks = not os.path.isfile(landmarks_path)
+        if extract_landmarks:
+            # with detect_interval videos track the face box between detections, a single image is always detected
+            detect_interval = self.detect_interval if len(frames) > 1 else None
+            landmarked = self.propress.predictor.iter_keypoints(frames_pil, detect_interval=detect_interval,
+                                                                batch_size=self.fan_batch_size)
         else:
             print(' Using saved landmarks.')
             lm = np.loadtxt(landmarks_path).astype(np.float32)
-            lm = lm.reshape([len(x_full_frames), -1, 2])
-
-        if not os.path.isfile(coeff_path):
-            # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
-            video_coeffs, full_coeffs = [],  []
-            for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
-                frame = frames_pil[idx]
-                W,H = frame.size
-                lm1 = lm[idx].reshape([-1, 2])
-            
-                if np.mean(lm1) == -1:
-                    lm1 = (self.lm3d_std[:, :2]+1)/2.
-                    lm1 = np.concatenate(
-                        [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
-                    )
-                else:
-                    lm1[:, -1] = H - 1 - lm1[:, -1]
-
-                trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
- 
-                trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-                im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
-                
+            landmarked = zip(frames_pil, lm.reshape([-1, 68, 2]))
+
+        # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
+        # align the frames in a thread pool and run net_recon on batches of aligned crops
+        extract_coeffs = not os.path.isfile(coeff_path)
+        lms, video_coeffs = [], []
+        full_coeffs, last_frame = None, None
+        with ThreadPoolExecutor(max_workers=self.align_workers) as pool:
+            for batch in tqdm(iter(lambda: list(islice(landmarked, self.recon_batch_size)), []), desc='3DMM Extraction In Video:'):
+                last_frame = batch[-1][0]
+                if extract_landmarks:
+                    lms.extend(lm for _, lm in batch)
+                if not extract_coeffs:
+                    continue
+                aligned = list(pool.map(self.align, [frame for frame, _ in batch], [lm.copy() for _, lm in batch]))
+                trans_params = np.stack([item[0] for item in aligned])
+                im_t = torch.tensor(np.stack([item[1] for item in aligned])/255., dtype=torch.float32).permute(0, 3, 1, 2).to(self.device)
+
                 with torch.no_grad():
                     full_coeff = self.net_recon(im_t)
                     coeffs = split_coeff(full_coeff)
@@ -158,13 +177,26 @@ class CropAndExtract():
                     pred_coeff['exp'], 
                     pred_coeff['angle'],
                     pred_coeff['trans'],
-                    trans_params[2:][None],
+                    trans_params[:, 2:],
                     ], 1)
                 video_coeffs.append(pred_coeff)
-                full_coeffs.append(full_coeff.cpu().numpy())
+                if full_coeffs is None:
+                    # the full coefficients are kept for the first frame only
+                    full_coeffs = full_coeff[:1].cpu().numpy()
 
-            semantic_npy = np.array(video_coeffs)[:,0] 
+        if last_frame is None:
+            print('No face is detected in the input file')
+            return None, None, None
 
-            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0]})
+        # save crop info
+        cv2.imwrite(png_path, cv2.cvtColor(np.array(last_frame), cv2.COLOR_RGB2BGR))
+        if extract_landmarks:
+            np.savetxt(landmarks_path, np.stack(lms).reshape(-1))
+        if extract_coeffs:
+            semantic_npy = np.concatenate(video_coeffs, 0)
+            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': full_coeffs})
+
+        if cache_key is not None:
+            self.cache.store(cache_key, crop_info, coeff_path, png_path, landmarks_path)
 
         return coeff_path, png_path, crop_info
@@ -0,0 +1,88 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+
+import numpy as np
+
+
+class PreprocessCache():
+    """ Persistent cache of the source image preprocessing (crop_info, cropped png, landmarks and 3dmm coeffs).
+
+    Entries are keyed by the image content hash, the preprocess mode and pic_size, are written to a
+    temporary directory and renamed into place so that several workers can share one cache_dir,
+    and the least recently used entries are removed once the cache grows over max_size_gb. """
+
+    files = {'coeff': 'coeff.mat', 'png': 'crop.png', 'landmarks': 'landmarks.txt'}
+
+    def __init__(self, cache_dir, max_size_gb=2):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024**3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_path, preprocess, pic_size):
+        sha = hashlib.sha256()
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return '%s_%s_%d' % (sha.hexdigest(), preprocess.lower(), int(pic_size))
+
+    def load(self, key, coeff_path, png_path, landmarks_path):
+        """ copy a cached entry to the given paths, returns crop_info or None on a miss """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, 'crop_info.json')) as f:
+                crop_info = json.load(f)
+            for name, path in zip(['coeff', 'png', 'landmarks'], [coeff_path, png_path, landmarks_path]):
+                shutil.copyfile(os.path.join(entry, self.files[name]), path)
+            os.utime(entry)  # mark as recently used
+        except OSError:
+            # missing, or evicted by another worker while we were reading it
+            return None
+
+        size, crop, quad = crop_info
+        return (tuple(size), None if crop is None else tuple(crop), None if quad is None else tuple(quad))
+
+    def store(self, key, crop_info, coeff_path, png_path, landmarks_path):
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_dir = os.path.join(self.cache_dir, '.tmp-' + str(uuid.uuid4()))
+        os.makedirs(tmp_dir)
+        try:
+            for name, path in zip(['coeff', 'png', 'landmarks'], [coeff_path, png_path, landmarks_path]):
+                shutil.copyfile(path, os.path.join(tmp_dir, self.files[name]))
+            size, crop, quad = crop_info
+            with open(os.path.join(tmp_dir, 'crop_info.json'), 'w') as f:
+                json.dump([[int(v) for v in size],
+                           None if crop is None else [int(v) for v in crop],
+                           None if quad is None else [float(v) for v in np.asarray(quad).reshape(-1)]], f)
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another worker stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict(keep=entry)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            # never drop the entry that was just stored
+            if name.startswith('.tmp-') or path == keep or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            total += sum(os.path.getsize(os.path.join(keep, f)) for f in os.listdir(keep))
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
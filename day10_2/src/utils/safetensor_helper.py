@@ -1,8 +1,78 @@
+import os
+import json
+import mmap
+import struct
+import threading
+
+import torch
+
+
+_SAFETENSOR_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+# process-wide registry: realpath -> {name: tensor view into the mmap}
+_checkpoint_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _mmap_safetensor(checkpoint_path):
+    with open(checkpoint_path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        # copy-on-write private mapping: the pages come straight from the page cache,
+        # so every worker on the host that maps the same file shares them.
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = _SAFETENSOR_DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        numel = 1
+        for s in info['shape']:
+            numel *= s
+        if numel == 0:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=numel,
+                                         offset=data_start + begin).view(info['shape'])
+    return tensors
+
+
+def load_safetensor(checkpoint_path):
+    """ Open a safetensors file once per process and return zero-copy views into it.
+    Later calls with the same file return the same dict. """
+    key = os.path.realpath(checkpoint_path)
+    with _registry_lock:
+        if key not in _checkpoint_registry:
+            _checkpoint_registry[key] = _mmap_safetensor(key)
+        return _checkpoint_registry[key]
+
+
+def release_safetensor(checkpoint_path=None):
+    """ Drop one (or all) checkpoints from the registry; the mapping is closed
+    once the loaded models no longer reference the views. """
+    with _registry_lock:
+        if checkpoint_path is None:
+            _checkpoint_registry.clear()
+        else:
+            _checkpoint_registry.pop(os.path.realpath(checkpoint_path), None)
 
 
 def load_x_from_safetensor(checkpoint, key):
-    x_generator = {}
-    for k,v in checkpoint.items():
-        if key in k:
-            x_generator[k.replace(key+'.', '')] = v
-    return x_generator
\ No newline at end of file
+    if isinstance(checkpoint, str):
+        checkpoint = load_safetensor(checkpoint)
+    prefix = key + '.'
+    return {k[len(prefix):]: v for k, v in checkpoint.items() if k.startswith(prefix)}
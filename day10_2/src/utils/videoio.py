@@ -1,21 +1,141 @@
 import shutil
 import uuid
+import subprocess
 
 import os
 
 import cv2
 
-def load_video_to_cv2(input_path):
-    video_stream = cv2.VideoCapture(input_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    full_frames = [] 
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
+class VideoFrames():
+    """ Lazily decoded frames of a video (or a single image file).
+
+    stride:         keep every stride-th frame, the skipped frames are grabbed but not decoded
+    max_duration:   stop after this many seconds of the source
+    max_frames:     stop after yielding this many frames
+    roi:            (x1, y1, x2, y2) in source pixels, cropped before resizing
+    size:           (w, h) to resize every (cropped) frame to
+    """
+
+    def __init__(self, path, stride=1, max_duration=None, max_frames=None, roi=None, size=None, rgb=True):
+        if not os.path.isfile(path):
+            raise ValueError('path must be a valid path to video/image file')
+        self.path = path
+        self.stride = stride
+        self.max_duration = max_duration
+        self.max_frames = max_frames
+        self.roi = roi
+        self.size = size
+        self.rgb = rgb
+        self.is_image = path.split('.')[-1].lower() in ['jpg', 'png', 'jpeg']
+
+        if self.is_image:
+            self.source_fps, self.source_frames = 25, 1
+        else:
+            video_stream = cv2.VideoCapture(path)
+            self.source_fps = video_stream.get(cv2.CAP_PROP_FPS)
+            self.source_frames = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+            video_stream.release()
+
+    @property
+    def fps(self):
+        return self.source_fps / self.stride
+
+    def _source_limit(self):
+        limit = self.source_frames
+        if self.max_duration is not None and self.source_fps:
+            limit = min(limit, int(self.max_duration * self.source_fps))
+        return limit
+
+    def __len__(self):
+        # frame count from the container header, the decoder may deliver a few less
+        num = (self._source_limit() + self.stride - 1) // self.stride
+        if self.max_frames is not None:
+            num = min(num, self.max_frames)
+        return num
+
+    def _process(self, frame):
+        if self.roi is not None:
+            x1, y1, x2, y2 = self.roi
+            frame = frame[y1:y2, x1:x2]
+        if self.size is not None:
+            frame = cv2.resize(frame, tuple(self.size))
+        if self.rgb:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return frame
+
+    def __iter__(self):
+        if self.is_image:
+            yield self._process(cv2.imread(self.path))
+            return
+
+        video_stream = cv2.VideoCapture(self.path)
+        limit = None if self.max_duration is None else self._source_limit()
+        index, yielded = 0, 0
+        try:
+            while limit is None or index < limit:
+                if self.max_frames is not None and yielded >= self.max_frames:
+                    break
+                if index % self.stride:
+                    still_reading = video_stream.grab()
+                else:
+                    still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                if index % self.stride == 0:
+                    yield self._process(frame)
+                    yielded += 1
+                index += 1
+        finally:
             video_stream.release()
-            break 
-        full_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-    return full_frames
+
+
+def load_video_to_cv2(input_path):
+    return list(VideoFrames(input_path))
+
+class VideoWriter():
+    """ Pipe uint8 RGB frames into a single ffmpeg process and mux the audio in the same pass,
+    so the frames never have to be held in memory or written to a temp file. """
+
+    def __init__(self, save_path, fps=25, audio_path=None):
+        self.save_path = save_path
+        self.fps = fps
+        self.audio_path = audio_path
+        self.process = None
+        self.num_frames = 0
+
+    def _open(self, width, height):
+        cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(self.fps), '-i', '-']
+        if self.audio_path is not None:
+            cmd += ['-i', self.audio_path, '-c:a', 'aac', '-shortest']
+        # yuv420p needs even sizes
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', self.save_path]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if self.process is None:
+            self._open(frame.shape[1], frame.shape[0])
+        self.process.stdin.write(frame.tobytes())
+        self.num_frames += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed to write %s' % self.save_path)
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.process is not None:
+            self.process.kill()
+            self.process = None
+            return False
+        self.close()
+
 
 def save_video_with_watermark(video, audio, save_path, watermark=False):
     temp_file = str(uuid.uuid4())+'.mp4'
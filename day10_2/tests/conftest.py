@@ -0,0 +1,22 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.io import savemat, wavfile
+
+# the modules are imported as src.*, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def speech(tmp_path):
+    """ 3.3 s of synthetic audio and a source coefficient file """
+    rng = np.random.RandomState(0)
+    t = np.arange(int(3.3 * 16000)) / 16000.
+    wav = 0.3 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 3 * t)) + 0.05 * rng.randn(t.size)
+    wav_path = str(tmp_path / 'speech.wav')
+    wavfile.write(wav_path, 16000, wav.astype(np.float32))
+    coeff_path = str(tmp_path / 'source.mat')
+    savemat(coeff_path, {'coeff_3dmm': rng.randn(1, 73)})
+    return wav_path, coeff_path
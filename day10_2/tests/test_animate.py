@@ -0,0 +1,26 @@
+import time
+
+import numpy as np
+import pytest
+
+animate = pytest.importorskip('src.facerender.animate')
+
+
+def test_generate_styles_raises_when_an_encoder_fails_early():
+    animate_from_coeff = object.__new__(animate.AnimateFromCoeff)
+
+    def render_styles(xs, crop_info, img_size=256, precision='fp32'):
+        for _ in range(1000):
+            yield [np.zeros((4, 4, 3), np.uint8) for _ in xs]
+
+    def encode_video(frames, x, video_save_dir, pic_path, crop_info, **kwargs):
+        if x['video_name'] == 'broken':
+            raise OSError('audio export failed')
+        return sum(1 for _ in frames)
+
+    animate_from_coeff.render_styles = render_styles
+    animate_from_coeff.encode_video = encode_video
+    start = time.monotonic()
+    with pytest.raises(OSError):
+        animate_from_coeff.generate_styles([{'video_name': 'ok'}, {'video_name': 'broken'}], '.', 'pic.png', (None,))
+    assert time.monotonic() - start < 5
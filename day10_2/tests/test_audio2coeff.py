@@ -0,0 +1,89 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+from scipy.io import loadmat
+from yacs.config import CfgNode as CN
+
+from src.audio2exp_models.audio2exp import Audio2Exp
+from src.audio2exp_models.networks import SimpleWrapperV2
+from src.audio2pose_models.audio2pose import Audio2Pose
+from src.generate_batch import AudioChunks, get_data
+from src.test_audio2coeff import Audio2Coeff, CoeffStream
+
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'config')
+
+
+@pytest.fixture(scope='module')
+def audio_to_coeff():
+    """ Audio2Coeff with random weights """
+    torch.manual_seed(0)
+    audio_to_coeff = object.__new__(Audio2Coeff)
+    audio_to_coeff.device = 'cpu'
+    audio_to_coeff.audio2pose_model = Audio2Pose(CN.load_cfg(open(os.path.join(CONFIG_DIR, 'auido2pose.yaml'))), None, device='cpu').eval()
+    audio_to_coeff.audio2exp_model = Audio2Exp(SimpleWrapperV2(), CN.load_cfg(open(os.path.join(CONFIG_DIR, 'auido2exp.yaml'))), device='cpu').eval()
+    return audio_to_coeff
+
+
+def seeded(seed=5):
+    # the blink ratio draws from random, the pose latents from torch
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+
+@pytest.mark.parametrize('chunk_size', [20, 37, 250])
+def test_generate_chunks_matches_generate(audio_to_coeff, speech, tmp_path, chunk_size):
+    wav_path, coeff_path = speech
+    seeded()
+    expected = loadmat(audio_to_coeff.generate(get_data(coeff_path, wav_path, 'cpu', None), str(tmp_path), 3))['coeff_3dmm']
+    seeded()
+    chunks = list(audio_to_coeff.generate_chunks(AudioChunks(coeff_path, wav_path, 'cpu', None), str(tmp_path), 3,
+                                                 chunk_size=chunk_size))
+
+    assert sum(len(coeffs) for coeffs in chunks) == expected.shape[0]
+    np.testing.assert_allclose(np.concatenate(chunks), expected, atol=1e-5)
+
+
+def test_coeff_stream_window_batch(audio_to_coeff, speech):
+    wav_path, coeff_path = speech
+    tracks = []
+    for window_batch in (1, 4, 8):
+        seeded()
+        stream = CoeffStream(audio_to_coeff, AudioChunks(coeff_path, wav_path, 'cpu', None), 3, pose_window=8,
+                             window_batch=window_batch)
+        tracks.append(stream.advance(len(stream.audio_chunks), final=True))
+    assert tracks[0].shape == (len(stream.audio_chunks), 70)
+    for track in tracks[1:]:
+        np.testing.assert_allclose(track, tracks[0], atol=1e-5)
+
+
+def exp_batch(num_frames):
+    torch.manual_seed(1)
+    return {'indiv_mels': torch.randn(1, num_frames, 1, 80, 16), 'ref': torch.randn(1, num_frames, 70),
+            'ratio_gt': torch.rand(1, num_frames)}
+
+
+def exp_slices(audio2exp, batch):
+    """ the original Audio2Exp.test, one netG pass per 10 frame slice """
+    exp = []
+    for i in range(0, batch['indiv_mels'].shape[1], 10):
+        mels = batch['indiv_mels'][:, i:i+10]
+        exp.append(audio2exp.netG(mels.reshape(-1, 1, 80, 16), batch['ref'][:, i:i+10, :64], batch['ratio_gt'][:, i:i+10]))
+    return torch.cat(exp, axis=1)
+
+
+@pytest.mark.parametrize('num_frames', [7, 233, 523])
+def test_audio2exp_batched_frames(audio_to_coeff, num_frames):
+    audio2exp = audio_to_coeff.audio2exp_model
+    batch = exp_batch(num_frames)
+    with torch.no_grad():
+        expected = exp_slices(audio2exp, batch)
+        batched = audio2exp.test(batch)['exp_coeff_pred']
+        sliced = audio2exp.test(batch, chunk_size=10)['exp_coeff_pred']
+
+    assert batched.shape == expected.shape == (1, num_frames, 64)
+    assert torch.allclose(batched, expected, atol=1e-5)
+    assert torch.equal(sliced, expected)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+import torch
+from yacs.config import CfgNode as CN
+
+from src.audio2pose_models.audio2pose import Audio2Pose
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'config')
+
+
+@pytest.fixture(scope='module')
+def audio2pose():
+    """ Audio2Pose with random weights """
+    torch.manual_seed(0)
+    return Audio2Pose(CN.load_cfg(open(os.path.join(CONFIG_DIR, 'auido2pose.yaml'))), None, device='cpu').eval()
+
+
+def pose_input(num_frames, pose_style=3):
+    torch.manual_seed(1)
+    return {'ref': torch.randn(1, 1, 70), 'indiv_mels': torch.randn(1, num_frames, 1, 80, 16),
+            'num_frames': num_frames, 'class': torch.LongTensor([pose_style])}
+
+
+def pose_per_window(model, x):
+    """ the original Audio2Pose.test, one encoder and decoder pass per window """
+    batch = {'ref': x['ref'][:, 0, -6:], 'class': x['class']}
+    mels = x['indiv_mels'][:, 1:]
+    div, re = divmod(int(x['num_frames']) - 1, model.seq_len)
+    windows = [mels[:, i*model.seq_len:(i+1)*model.seq_len] for i in range(div)]
+    if re != 0:
+        windows.append(mels[:, -model.seq_len:])
+
+    motion = [torch.zeros(1, 1, 6)]
+    for i, window in enumerate(windows):
+        batch['z'] = torch.randn(1, model.latent_dim)
+        audio_emb = model.audio_encoder(window)
+        if audio_emb.shape[1] != model.seq_len:
+            audio_emb = torch.cat([audio_emb[:, :1].repeat(1, model.seq_len - audio_emb.shape[1], 1), audio_emb], 1)
+        batch['audio_emb'] = audio_emb
+        pose_motion = model.netG.test(batch)['pose_motion_pred']
+        motion.append(pose_motion[:, -re:] if re != 0 and i == len(windows) - 1 else pose_motion)
+    return x['ref'][:, :1, -6:] + torch.cat(motion, dim=1)
+
+
+@pytest.mark.parametrize('num_frames', [20, 33, 230])
+def test_seed_gives_the_same_poses_however_the_windows_are_batched(audio2pose, num_frames):
+    x = pose_input(num_frames)
+    with torch.no_grad():
+        torch.manual_seed(5)
+        expected = pose_per_window(audio2pose, x)
+        for window_batch in (1, 3, 8):
+            torch.manual_seed(5)
+            pose = audio2pose.test(dict(x), window_batch=window_batch)['pose_pred']
+            assert pose.shape == expected.shape == (1, num_frames, 6)
+            assert torch.allclose(pose, expected, atol=1e-5)
+
+
+def test_audio_encoder_keeps_the_sequences_apart(audio2pose):
+    torch.manual_seed(1)
+    mels = torch.randn(3, 5, 1, 80, 16)
+    with torch.no_grad():
+        emb = audio2pose.audio_encoder(mels)
+        expected = torch.cat([audio2pose.audio_encoder(mels[b:b+1]) for b in range(3)])
+    assert emb.shape == (3, 5, 512)
+    assert torch.allclose(emb, expected, atol=1e-5)
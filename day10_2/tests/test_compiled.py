@@ -0,0 +1,63 @@
+import os
+
+import torch
+from torch import nn
+
+from src.facerender.compiled import TracedModule, CompiledMapping, compile_facerender, _Mapping
+from src.facerender.modules.generator import OcclusionAwareSPADEGenerator
+from src.facerender.modules.keypoint_detector import KPDetector
+from src.facerender.modules.make_animation import make_animation
+from src.facerender.modules.mapping import MappingNet
+
+
+def facerender(coeff_nc=70):
+    """ random weights, the checkpoint architecture with fewer blocks """
+    torch.manual_seed(0)
+    common = dict(num_kp=15, image_channel=3, feature_channel=32, estimate_jacobian=False)
+    generator = OcclusionAwareSPADEGenerator(block_expansion=64, max_features=512, num_down_blocks=2, reshape_channel=32,
+                                             reshape_depth=16, num_resblocks=1, estimate_occlusion_map=True,
+                                             dense_motion_params=dict(block_expansion=8, max_features=64, num_blocks=2,
+                                                                      reshape_depth=16, compress=4), **common)
+    kp_detector = KPDetector(temperature=0.1, block_expansion=8, max_features=64, scale_factor=0.25, num_blocks=2,
+                             reshape_channel=512, reshape_depth=16, **common)
+    mapping = MappingNet(coeff_nc, 64, 3, 15, 66)
+    return generator.eval(), kp_detector.eval(), mapping.eval()
+
+
+def test_compiled_matches_eager(tmp_path):
+    generator, kp_detector, mapping = facerender()
+    compiled = compile_facerender(generator, kp_detector, mapping, str(tmp_path))
+
+    source_image = torch.rand(1, 3, 64, 64)
+    source_semantics = torch.randn(1, 70, 27) * 0.1
+    target_semantics = source_semantics[:, None] + torch.randn(1, 3, 70, 27) * 0.05
+    eager = make_animation(source_image, source_semantics, target_semantics, generator, kp_detector, None, mapping)
+    traced = make_animation(source_image, source_semantics, target_semantics, *compiled[:2], None, compiled[2])
+
+    assert traced.shape == eager.shape
+    assert torch.allclose(traced, eager, atol=1e-4)
+
+
+def test_mapping_is_traced_once(tmp_path):
+    mapping = MappingNet(73, 64, 3, 15, 66).eval()
+    compiled = CompiledMapping(TracedModule('mapping', _Mapping(mapping), str(tmp_path)), step=16)
+
+    for rows in (5, 16, 37):
+        semantics = torch.randn(rows, 73, 27)
+        with torch.no_grad():
+            eager = mapping(semantics)
+        out = compiled(semantics)
+        for key in _Mapping.keys:
+            assert out[key].shape == eager[key].shape
+            assert torch.allclose(out[key], eager[key], atol=1e-5)
+    assert len(compiled.mapping.traces) == 1
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_cache_keeps_the_latest_artifacts(tmp_path):
+    traced = TracedModule('linear', nn.Linear(4, 2), str(tmp_path), max_cached=2)
+    for rows in (1, 2, 3, 4):
+        traced(torch.zeros(rows, 4))
+    kept = sorted(os.listdir(tmp_path))
+    assert len(kept) == 2
+    assert kept == sorted(os.path.basename(traced.path([torch.zeros(rows, 4)])) for rows in (3, 4))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import src.utils.audio as audio
+from src.generate_batch import AudioChunks, StreamingAudio, get_mel_windows, parse_audio_length, crop_pad_audio
+
+
+def mel_windows_of(wav_path):
+    """ the windows get_data() computes from the whole spectrogram """
+    wav = audio.load_wav(wav_path, 16000)
+    wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
+    wav = crop_pad_audio(wav, wav_length)
+    return get_mel_windows(audio.melspectrogram(wav).T.astype(np.float32), num_frames)
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 40, 1000])
+def test_audio_chunks_mel_windows(speech, chunk):
+    wav_path, coeff_path = speech
+    expected = mel_windows_of(wav_path)
+    chunks = AudioChunks(coeff_path, wav_path, 'cpu', None)
+    assert len(chunks) == expected.shape[0]
+
+    windows = [chunks.batch(start, min(start + chunk, len(chunks)))['indiv_mels'][0, :, 0].numpy()
+               for start in range(0, len(chunks), chunk)]
+    np.testing.assert_array_equal(np.concatenate(windows), expected)
+
+
+@pytest.mark.parametrize('increment', [333, 640, 640 * 7 + 11])
+def test_streaming_audio_mel_windows(speech, increment):
+    wav_path, coeff_path = speech
+    expected = mel_windows_of(wav_path)
+    wav = audio.load_wav(wav_path, 16000)
+
+    stream = StreamingAudio(coeff_path, 'cpu')
+    windows = []
+
+    def take():
+        # the frames that became final, the samples before them are dropped
+        done = sum(w.shape[0] for w in windows)
+        if len(stream) > done:
+            windows.append(stream.mel_windows(done, len(stream)))
+            stream.trim(len(stream))
+
+    for start in range(0, len(wav), increment):
+        stream.push(wav[start:start + increment])
+        take()
+    stream.finish()
+    take()
+
+    assert len(stream) == expected.shape[0]
+    np.testing.assert_array_equal(np.concatenate(windows), expected)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('facexlib')
+from src.face3d.extract_kp_videos_safe import KeypointExtractor
+
+
+class Detector():
+    def get_landmarks_batch(self, crops):
+        return [np.full((98, 2), crop.mean()) for crop in crops], [1.0] * len(crops)
+
+
+def extractor(detections):
+    kp_extractor = object.__new__(KeypointExtractor)
+    kp_extractor.detector = Detector()
+    def detect_face(image):
+        # frame i is filled with i, frame 0 has no face
+        detections.append(int(image.mean()))
+        return None if image.mean() == 0 else [0, 0, 8, 8]
+    kp_extractor.detect_face = detect_face
+    return kp_extractor
+
+
+def test_track_keypoints_reads_the_frames_lazily():
+    read = []
+    def frames(n):
+        for i in range(n):
+            read.append(i)
+            yield np.full((8, 8, 3), i, dtype=np.uint8)
+
+    detections = []
+    tracked = extractor(detections).iter_keypoints(frames(30), info=False, detect_interval=10, batch_size=4)
+    _, kp = next(tracked)
+    assert np.all(kp == -1)
+    _, kp = next(tracked)
+    assert len(read) <= 1 + 4
+
+    keypoints = [kp] + [kp for _, kp in tracked]
+    assert len(keypoints) == 29
+    assert [kp[0, 0] for kp in keypoints] == list(range(1, 30))
+    assert detections == [0, 1, 11, 21]
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+
+from src.facerender.modules.mapping import MappingNet
+from src.utils.onnx_helper import onnx_specs
+
+
+def animate_from_coeff(coeff_nc):
+    generator = SimpleNamespace(encode_source=lambda image: torch.zeros(image.shape[0], 32, 16, 64, 64))
+    return SimpleNamespace(device='cpu', generator=generator, kp_extractor=nn.Identity(),
+                           mapping=MappingNet(coeff_nc, 64, 3, 15, 66))
+
+
+@pytest.mark.parametrize('coeff_nc', [70, 73])
+def test_mapping_spec_follows_the_coefficient_count(coeff_nc):
+    audio2pose = SimpleNamespace(seq_len=32, latent_dim=64, audio_encoder=SimpleNamespace(audio_encoder=nn.Identity()),
+                                 netG=SimpleNamespace(decoder=nn.Identity()))
+    audio_to_coeff = SimpleNamespace(audio2pose_model=audio2pose, audio2exp_model=SimpleNamespace(netG=nn.Identity()))
+    specs = onnx_specs(SimpleNamespace(net_recon=nn.Identity()), audio_to_coeff, animate_from_coeff(coeff_nc), 64)
+
+    module, inputs = specs['mapping'][:2]
+    assert inputs[0].shape == (2, coeff_nc, 27)
+    with torch.no_grad():
+        yaw = module(*inputs)[0]
+    assert yaw.shape == (2, 66)
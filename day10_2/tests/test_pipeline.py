@@ -0,0 +1,180 @@
+import threading
+import time
+
+import pytest
+
+from src.utils.pipeline import FrameChannel, Stage, StagePipeline, background, fan_out, streaming
+
+
+def produce(job):
+    job['frames'] = iter(range(job['n']))
+    return job
+
+
+def consume(job):
+    if job.get('fail'):
+        raise RuntimeError('encode failed')
+    job['total'] = sum(job['frames'])
+    return job
+
+
+def test_results_in_submission_order():
+    with StagePipeline([Stage('double', lambda job: dict(job, x=job['x'] * 2)),
+                        Stage('inc', lambda job: dict(job, x=job['x'] + 1))]) as pipeline:
+        futures = [pipeline.submit({'x': i}) for i in range(10)]
+        assert [future.result(timeout=5)['x'] for future in futures] == [2 * i + 1 for i in range(10)]
+
+
+def test_failure_stays_with_its_job():
+    def stage(job):
+        if job['x'] == 1:
+            raise ValueError('job 1')
+        return job
+
+    with StagePipeline([Stage('a', stage), Stage('b', lambda job: job)]) as pipeline:
+        futures = [pipeline.submit({'x': i}) for i in range(3)]
+        assert futures[0].result(timeout=5)['x'] == 0
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=5)
+        assert futures[2].result(timeout=5)['x'] == 2
+
+
+def test_cancelled_job_is_skipped():
+    gate = threading.Event()
+    ran = []
+
+    def slow(job):
+        gate.wait(5)
+        return job
+
+    def record(job):
+        ran.append(job['x'])
+        return job
+
+    with StagePipeline([Stage('slow', slow), Stage('record', record)]) as pipeline:
+        futures = [pipeline.submit({'x': i}) for i in range(3)]
+        assert futures[1].cancel()
+        gate.set()
+        assert futures[2].result(timeout=5)['x'] == 2
+    assert ran == [0, 2]
+
+
+def test_streaming_stage_feeds_the_next_one():
+    with StagePipeline([Stage('render', streaming(produce, maxsize=4)), Stage('encode', consume)]) as pipeline:
+        futures = [pipeline.submit({'n': n}) for n in (10, 1000, 3)]
+        assert [future.result(timeout=10)['total'] for future in futures] == [45, 499500, 3]
+
+
+def test_failed_consumer_releases_the_producer():
+    # the encode stage fails before reading the frames of job 1, the render worker must not wait for it
+    # no context manager: a wedged render worker would make close() hang instead of the test fail
+    pipeline = StagePipeline([Stage('render', streaming(produce, maxsize=4)), Stage('encode', consume)])
+    futures = [pipeline.submit({'n': 1000, 'fail': i == 1}) for i in range(3)]
+    assert futures[0].result(timeout=5)['total'] == 499500
+    with pytest.raises(RuntimeError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5)['total'] == 499500
+    pipeline.close()
+
+
+def test_cancelled_consumer_releases_the_producer():
+    gate = threading.Event()
+    encoding = threading.Event()
+
+    def encode(job):
+        job = consume(job)
+        # job 0 is read, so the render worker goes on with job 1 while the encoder holds on to job 0
+        encoding.set()
+        gate.wait(5)
+        return job
+
+    pipeline = StagePipeline([Stage('render', streaming(produce, maxsize=4)), Stage('encode', encode)])
+    futures = [pipeline.submit({'n': 1000}) for i in range(3)]
+    assert encoding.wait(5)
+    time.sleep(0.2)
+    # job 1 waits for the encoder, its frames for a reader
+    assert futures[1].cancel()
+    gate.set()
+    assert futures[0].result(timeout=5)['total'] == 499500
+    assert futures[2].result(timeout=5)['total'] == 499500
+    pipeline.close()
+
+
+def test_stopped_channel_does_not_block():
+    channel = FrameChannel(maxsize=1)
+    assert channel.put(0)
+    channel.stop()
+    assert not channel.put(1)
+
+
+def test_background_yields_and_reraises():
+    assert list(background(iter(range(100)), maxsize=2)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise KeyError('producer')
+
+    with pytest.raises(KeyError):
+        list(background(failing()))
+
+
+def test_background_stops_its_worker_when_closed():
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    it = background(items(), maxsize=2)
+    assert next(it) == 0
+    it.close()
+    time.sleep(0.5)
+    assert len(produced) < 10
+
+
+def rows(n, width):
+    for i in range(n):
+        yield [i] * width
+
+
+def test_fan_out_returns_every_consumer_result():
+    assert fan_out(rows(1000, 3), [sum, lambda frames: len(list(frames)), max], maxsize=4) == [499500, 1000, 999]
+
+
+def test_fan_out_consumer_failing_before_reading():
+    # e.g. the audio export or ffmpeg failing before the first frame is read
+    def broken(frames):
+        raise OSError('no ffmpeg')
+
+    start = time.monotonic()
+    with pytest.raises(OSError):
+        fan_out(rows(1000, 2), [sum, broken], maxsize=4)
+    assert time.monotonic() - start < 5
+
+
+def test_fan_out_consumer_failing_while_reading():
+    produced = []
+
+    def counted():
+        for row in rows(100000, 2):
+            produced.append(row)
+            yield row
+
+    def two_frames(frames):
+        for i, _ in enumerate(frames):
+            if i == 2:
+                raise ValueError('encode failed')
+
+    with pytest.raises(ValueError):
+        fan_out(counted(), [sum, two_frames], maxsize=4)
+    assert len(produced) < 100000
+
+
+def test_fan_out_producer_failing():
+    def failing():
+        yield [1, 1]
+        raise RuntimeError('render failed')
+
+    with pytest.raises(RuntimeError):
+        fan_out(failing(), [sum, sum])
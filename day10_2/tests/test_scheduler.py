@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+import torch
+
+import src.facerender.scheduler as scheduler_module
+from src.facerender.scheduler import RenderScheduler, iter_scheduled_animation
+
+
+class Generator():
+    """ predicts source + driving value for every frame and records the batch sizes """
+
+    def __init__(self, fail=None, delay=0.):
+        self.fail = fail
+        self.delay = delay                      # seconds the first batch takes
+        self.batches = []
+
+    def forward_with_feature(self, source_feature, kp_source, kp_driving):
+        value = kp_driving['value']
+        if not self.batches:
+            time.sleep(self.delay)
+        self.batches.append(value.shape[0])
+        if self.fail is not None and (value == self.fail).any():
+            raise RuntimeError('generator failed')
+        prediction = source_feature.reshape(len(value), -1)[:, :1] + value.reshape(len(value), -1)[:, :1]
+        return {'prediction': prediction.view(-1, 1, 1, 1).expand(-1, 3, 2, 2)}
+
+
+def make_scheduler(generator, batch_size=8, deadline=10.):
+    return RenderScheduler(lambda precision: (generator, None, None), batch_size=batch_size, deadline=deadline)
+
+
+def submit(scheduler, values, source=0.):
+    """ one frame per value, all driven from a single source """
+    n = len(values)
+    kp_driving = torch.tensor(values, dtype=torch.float32).view(n, 1, 1).expand(n, 2, 3)
+    return scheduler.submit(torch.full((1, 1, 1, 1, 1), source), torch.zeros(1, 2, 3), kp_driving,
+                            torch.zeros(n, dtype=torch.long))
+
+
+def frames(predictions):
+    return predictions[:, 0, 0, 0].tolist()
+
+
+def test_concurrent_jobs_get_their_own_frames_in_order(monkeypatch):
+    def prepare_animation(source_image, *args, **kwargs):
+        # two sources per job, the job id goes into the source feature
+        bs, num_steps = 2, 11
+        source_feature = torch.full((bs, 1, 1, 1, 1), 1000. * source_image) + torch.arange(bs).view(bs, 1, 1, 1, 1) * 100
+        kp_driving = torch.arange(num_steps, dtype=torch.float32).view(1, num_steps, 1, 1).expand(bs, num_steps, 2, 3)
+        return source_feature, {'value': torch.zeros(bs, 2, 3)}, kp_driving
+    monkeypatch.setattr(scheduler_module, 'prepare_animation', prepare_animation)
+
+    generator = Generator()
+    scheduler = make_scheduler(generator, batch_size=8, deadline=0.01)
+    results = {}
+    def job(job_id):
+        steps = iter_scheduled_animation(scheduler, job_id, None, None, None, None, None, chunk_size=6)
+        results[job_id] = [step[:, 0, 0, 0].tolist() for step in steps]
+
+    threads = [threading.Thread(target=job, args=(job_id,)) for job_id in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    for job_id in (1, 2):
+        assert results[job_id] == [[1000. * job_id + step, 1000. * job_id + 100 + step] for step in range(11)]
+    assert set(generator.batches) == {8}
+
+
+def test_short_batches_are_padded():
+    generator = Generator()
+    scheduler = make_scheduler(generator, batch_size=8, deadline=0.)
+    assert frames(submit(scheduler, [1, 2, 3]).result(timeout=5)) == [1, 2, 3]
+    assert generator.batches == [8]
+
+
+def test_deadline_flushes_a_partial_batch():
+    generator = Generator()
+    scheduler = make_scheduler(generator, batch_size=8, deadline=0.2)
+    start = time.monotonic()
+    assert frames(submit(scheduler, [1, 2, 3]).result(timeout=5)) == [1, 2, 3]
+    assert time.monotonic() - start >= 0.2
+    assert generator.batches == [8]
+
+
+def test_rest_of_a_split_chunk_waits_for_the_deadline():
+    generator = Generator(delay=0.5)
+    scheduler = make_scheduler(generator, batch_size=8, deadline=0.5)
+    busy = submit(scheduler, list(range(8)))
+    # split only after it waited longer than the deadline
+    first = submit(scheduler, list(range(10, 20)))
+    while len(generator.batches) < 2:
+        time.sleep(0.001)
+    time.sleep(0.1)
+    # the last 2 frames of the first chunk share their batch with the second chunk
+    second = submit(scheduler, list(range(20, 26)))
+    assert frames(busy.result(timeout=5)) == list(range(8))
+    assert frames(first.result(timeout=5)) == list(range(10, 20))
+    assert frames(second.result(timeout=5)) == list(range(20, 26))
+    assert generator.batches == [8, 8, 8]
+
+
+def test_cancelled_chunk_is_dropped():
+    generator = Generator()
+    scheduler = make_scheduler(generator, batch_size=8)
+    cancelled = submit(scheduler, [1, 2, 3])
+    assert cancelled.cancel()
+    future = submit(scheduler, list(range(10, 18)))
+    assert frames(future.result(timeout=5)) == list(range(10, 18))
+    assert generator.batches == [8]
+
+
+def test_generator_failure_stays_with_its_chunks():
+    generator = Generator(fail=-1)
+    scheduler = make_scheduler(generator, batch_size=4)
+    # nothing is rendered before the first 4 frames are pending, they all go to the failing batch
+    failing = [submit(scheduler, [-1, 1]), submit(scheduler, [2, 3])]
+    future = submit(scheduler, [4, 5, 6, 7])
+    for chunk in failing:
+        with pytest.raises(RuntimeError):
+            chunk.result(timeout=5)
+    assert frames(future.result(timeout=5)) == [4, 5, 6, 7]
+    assert generator.batches == [4, 4]